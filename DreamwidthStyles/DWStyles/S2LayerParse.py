@@ -1,8 +1,18 @@
+import hashlib
+import json
+import os
 import re
+import tarfile
+from collections import Counter
+from multiprocessing import Pool
 
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.db import transaction
 
-from .models import ColorProperty, DWThemeColor, DWTheme
+from .bulk import chunks, query_chunk_size
+from .colorutil import iter_color_metrics
+from .models import (ColorProperty, DWThemeColor, DWTheme, RoundedColorCount,
+    adjust_rounded_color_counts, bump_data_version, clear_colorbars)
 
 class S2LayerParse(object):
     
@@ -11,62 +21,71 @@ class S2LayerParse(object):
     # layerinfo redist_uniq = "bases/beechy";
     find_redist_unique = re.compile(r'layerinfo\s+"?redist_uniq"?\s*=\s*"(?P<layername>[a-z/A-Z0-9_]+)"\s*;')
     
+    # the same patterns for scanning the whole layer at once, never matching across lines
+    layer_set_color = re.compile(set_color_variable.pattern.replace(r'\s', r'[^\S\n]'))
+    layer_redist_unique = re.compile(find_redist_unique.pattern.replace(r'\s', r'[^\S\n]'))
+    
     def __init__(self, text):
         
         self.load(text)
     
-    def standardize_hex(self, hex):
+    @staticmethod
+    def standardize_hex(hex):
         
         if len(hex) == 3:
             hex = "%s%s%s" % (hex[0]*2, hex[1]*2, hex[2]*2)
             
         return hex.lower()
     
-    def load(self, text):
-        self.layer = text
+    @classmethod
+    def parse(cls, text):
+        """Scans the layer once, returning its redist_uniq and a list of the
+        (variable, color) pairs it sets.  Doesn't touch the database.
         
-        self.color_variables = list()
-        self.redist_unique = None
+        Like the old line by line scan, only the first color set on each line
+        counts, and the line with the redist_uniq is skipped."""
         
-        # find all lines that set colors or have the redist_unique
-        for line in text.split('\n'):
-            
-            if not self.redist_unique:
-                m = self.find_redist_unique.search(line)
-                if m:
-                    self.redist_unique = m.groups()[0]
-                    continue
-            
-            m = self.set_color_variable.search(line)
-            if m:
-                self.color_variables.append(m.groups())
-
-        # gather all unique colors and their variables            
-        self.colors = dict()
-        for variable, color in self.color_variables:
+        redist_unique = None
+        skip_start = skip_end = -1
+        
+        m = cls.layer_redist_unique.search(text)
+        if m:
+            redist_unique = m.group("layername")
+            skip_start = text.rfind("\n", 0, m.start()) + 1
+            skip_end = line_end(text, m.start())
+        
+        color_variables = list()
+        last_line_end = -1
+        
+        for m in cls.layer_set_color.finditer(text):
+            if m.start() <= last_line_end:
+                continue
+            last_line_end = line_end(text, m.start())
             
-            # work off of the full six form, lowercase version of the hex
-            color = self.standardize_hex(color)
+            if skip_start <= m.start() <= skip_end:
+                continue
             
-            if not color in self.colors:
-                # create the list
-                self.colors[color] = [variable]
-        # top left = 0
-            else:
-                # add to the list
-                self.colors[color].append(variable)
+            color_variables.append((m.group("variable"), m.group("color")))
+        
+        return redist_unique, color_variables
+    
+    @classmethod
+    def gather_colors(cls, color_variables):
+        """Gathers all unique colors, in their full six form lowercase hex, and the
+        variables they are set to."""
         
-        self.existing_colors = {}
+        colors = dict()
+        for variable, color in color_variables:
+            colors.setdefault(cls.standardize_hex(color), []).append(variable)
         
-        for color in self.colors.keys():
-            color = self.standardize_hex(color)
-            
-            try:
-                self.existing_colors[color] = ColorProperty.objects.get(color_hex = color)
-            except:
-                color_model = ColorProperty(color_hex = color)
-                color_model.save()
-                self.existing_colors[color] = color_model
+        return colors
+    
+    def load(self, text):
+        self.layer = text
+        
+        self.redist_unique, self.color_variables = self.parse(text)
+        self.colors = self.gather_colors(self.color_variables)
+        self.digest, self.variable_digests = layer_digests(text, self.color_variables)
         
         # try to get the layer object; if it doesn't exist, will need to create it
 
@@ -78,23 +97,322 @@ class S2LayerParse(object):
             self.theme = None
 
         if self.theme == None:
+            # the colors are still worth having for attaching by hand
+            self.existing_colors = resolve_colors(self.colors.keys())
+            self.changed_variables = None
             return
         
-        self.existing_themecolors = {}
+        self.existing_colors, theme_colors, counts = import_theme_layers([(self.theme,
+            self.colors, self.digest, self.variable_digests)])
         
-        for color in self.colors.keys():
+        # None when the layer was identical and skipped outright
+        self.changed_variables = counts["changed_variables"] if counts["changed"] else None
+        self.existing_themecolors = theme_colors.get(self.theme.pk, {})
+
+def line_end(text, position):
+    """Where the line holding position ends."""
+    
+    end = text.find("\n", position)
+    
+    if end == -1:
+        return len(text)
+    else:
+        return end
+
+def layer_digests(text, color_variables):
+    """Returns the sha1 of the whole layer and a dictionary of each variable to the
+    sha1 of the color statements setting it, with the colors standardized so that
+    only real changes show."""
+    
+    statements = {}
+    for variable, color in color_variables:
+        statements.setdefault(variable, []).append(S2LayerParse.standardize_hex(color))
+    
+    variable_digests = dict((variable, hashlib.sha1("%s=%s" % (variable,
+        ",".join(colors))).hexdigest()) for variable, colors in statements.items())
+    
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    
+    return hashlib.sha1(text).hexdigest(), variable_digests
+
+def theme_color_category(variables):
+    """Backgrounds are feature colors, everything else is an accent."""
+    
+    if "color_entry_background" in variables or "color_page_background" in variables:
+        return "feature"
+    else:
+        return "accent"
+
+def resolve_colors(hexes):
+    """Returns a dictionary of hex to ColorProperty for the given standardized hexes,
+    fetching the existing ones in one query and bulk creating the rest with their
+    metrics already computed."""
+    
+    hexes = sorted(set(hexes))
+    colors = {}
+    
+    for chunk in chunks(hexes):
+        for color in ColorProperty.objects.filter(color_hex__in = chunk):
+            colors[color.color_hex] = color
+    
+    missing = [color_hex for color_hex in hexes if color_hex not in colors]
+    
+    if not missing:
+        return colors
+    
+    new_colors = [ColorProperty(color_hex = color_hex, **metrics)
+        for color_hex, metrics in zip(missing, iter_color_metrics(missing))]
+    
+    # a new color counts as in themes if its rounded color already is
+    rounded_in_themes = set()
+    for chunk in chunks(set(color.rounded_hex for color in new_colors)):
+        rounded_in_themes.update(RoundedColorCount.objects.filter(rounded_hex__in = chunk,
+            theme_colors__gt = 0).values_list('rounded_hex', flat = True))
+    
+    for color in new_colors:
+        color.in_themes = color.rounded_hex in rounded_in_themes
+    
+    with transaction.commit_on_success():
+        ColorProperty.objects.bulk_create(new_colors, batch_size = query_chunk_size)
+        bump_data_version()
+    
+    for chunk in chunks(missing):
+        for color in ColorProperty.objects.filter(color_hex__in = chunk):
+            colors[color.color_hex] = color
+    
+    return colors
+
+def sync_theme_colors(theme, colors, color_objects):
+    """Attaches colors (hex to list of variables) to the theme, updating the variables
+    of existing theme colors and bulk creating the missing ones.  Existing category
+    assignments are never changed.  Returns a dictionary of hex to the theme's
+    DWThemeColor rows for that color."""
+    
+    return sync_many_theme_colors([(theme, colors)], color_objects)[theme.pk]
+
+def sync_many_theme_colors(theme_layers, color_objects):
+    """Does what sync_theme_colors does for a list of (theme, colors) pairs at once,
+    fetching their existing theme colors together.  Returns a dictionary of theme
+    primary key to the dictionaries sync_theme_colors returns."""
+    
+    by_pk = dict((color.pk, color_hex) for color_hex, color in color_objects.items())
+    
+    theme_colors = dict((theme.pk, {}) for theme, colors in theme_layers)
+    for chunk in chunks(theme_colors.keys()):
+        for theme_color in DWThemeColor.objects.filter(theme__in = chunk):
+            if theme_color.color_id in by_pk:
+                theme_colors[theme_color.theme_id].setdefault(
+                    by_pk[theme_color.color_id], []).append(theme_color)
+    
+    # group updates by their new variables, which are mostly distinct anyway
+    updates = {}
+    new_theme_colors = []
+    changed_themes = set()
+    
+    for theme, colors in theme_layers:
+        existing = theme_colors[theme.pk]
         
-            variables = ", ".join(self.colors[color])
+        for color_hex, color_variables in colors.items():
+            variables = ", ".join(color_variables)
             
-            # don't change existing assignments
-            try:
-                themecolor_model = DWThemeColor.objects.get(color = self.existing_colors[color], theme = self.theme)
-                themecolor_model.variables = variables
-                themecolor_model.save()
-            except:
-                if "color_entry_background" in self.colors[color] or "color_page_background" in self.colors[color]:
-                    category = "feature"
-                else:
-                    category = "accent"
-                themecolor_model = DWThemeColor(color = self.existing_colors[color], theme = self.theme, variables = variables, category=category)
-                themecolor_model.save()
\ No newline at end of file
+            if color_hex in existing:
+                for theme_color in existing[color_hex]:
+                    if theme_color.variables != variables:
+                        theme_color.variables = variables
+                        updates.setdefault(variables, []).append(theme_color.pk)
+                        changed_themes.add(theme.pk)
+            else:
+                theme_color = DWThemeColor(color = color_objects[color_hex],
+                    theme = theme, variables = variables,
+                    category = theme_color_category(color_variables))
+                theme_color.copy_color_values()
+                new_theme_colors.append(theme_color)
+                changed_themes.add(theme.pk)
+    
+    with transaction.commit_on_success():
+        for variables, pks in updates.items():
+            for chunk in chunks(pks):
+                DWThemeColor.objects.filter(pk__in = chunk).update(variables = variables)
+        
+        DWThemeColor.objects.bulk_create(new_theme_colors, batch_size = query_chunk_size)
+        
+        # nor do they count the new theme colors towards their rounded colors
+        adjust_rounded_color_counts(Counter(theme_color.color.rounded_hex
+            for theme_color in new_theme_colors))
+        
+        # bulk writes skip the signals that mark the theme as changed
+        for chunk in chunks(sorted(changed_themes)):
+            DWTheme.objects.filter(pk__in = chunk).update(needs_contrast = True)
+        
+        if changed_themes:
+            bump_data_version()
+    
+    clear_colorbars(changed_themes)
+    
+    for theme_color in new_theme_colors:
+        theme_colors[theme_color.theme_id].setdefault(
+            theme_color.color.color_hex, []).append(theme_color)
+    
+    return theme_colors
+
+def layer_sources(path):
+    """Lists the .s2 layers in a directory tree or tarball as (name, text) pairs.
+    Layers in a directory are left for the parser to read, so their text is None."""
+    
+    if os.path.isdir(path):
+        sources = []
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".s2"):
+                    sources.append((os.path.join(directory, filename), None))
+        return sources
+    
+    archive = tarfile.open(path)
+    try:
+        return [(member.name, archive.extractfile(member).read())
+            for member in archive.getmembers()
+            if member.isfile() and member.name.endswith(".s2")]
+    finally:
+        archive.close()
+
+def parse_layer_source(source):
+    """Parses one (name, text) layer source, reading the text from disk if needed.
+    Runs in the worker processes, so it only returns plain data: the name, the
+    redist_uniq, the gathered colors and the layer digests."""
+    
+    name, text = source
+    
+    if text is None:
+        with open(name) as layer:
+            text = layer.read()
+    
+    redist_unique, color_variables = S2LayerParse.parse(text)
+    digest, variable_digests = layer_digests(text, color_variables)
+    
+    return (name, redist_unique, S2LayerParse.gather_colors(color_variables),
+        digest, variable_digests)
+
+def parse_layers(sources, processes = None):
+    """Parses the layer sources in a pool of worker processes, returning a list of
+    (name, redist_uniq, colors, digest, variable digests) in the same order."""
+    
+    pool = Pool(processes)
+    try:
+        return pool.map(parse_layer_source, sources, chunksize = 16)
+    finally:
+        pool.close()
+        pool.join()
+
+def import_theme_layers(theme_layers):
+    """Imports parsed layers into their themes, given a list of (theme, colors,
+    digest, variable digests).  Layers identical to the last one imported into the
+    theme are skipped without touching the database; for the others, only the
+    colors of variables whose statements changed, or that are on theme colors
+    holding a changed variable, are looked up and synced.  Saves the new digests.
+    
+    Returns a dictionary of hex to ColorProperty for the colors synced, one of theme
+    primary key to its synced theme colors like sync_many_theme_colors, and one of
+    counts: layers "skipped" and "changed", and "changed_variables"."""
+    
+    counts = dict(skipped = 0, changed = 0, changed_variables = 0)
+    
+    changed_layers = []
+    for theme, colors, digest, variable_digests in theme_layers:
+        if theme.layer_digest and theme.layer_digest == digest:
+            counts["skipped"] += 1
+        else:
+            changed_layers.append((theme, colors, digest, variable_digests))
+    
+    # the variables that changed in each theme with digests, None meaning all of them
+    changed_variables = {}
+    for theme, colors, digest, variable_digests in changed_layers:
+        if theme.layer_variable_digests:
+            old_digests = json.loads(theme.layer_variable_digests)
+            changed_variables[theme.pk] = set(variable
+                for variable in set(old_digests) | set(variable_digests)
+                if old_digests.get(variable) != variable_digests.get(variable))
+        else:
+            changed_variables[theme.pk] = None
+    
+    # the theme colors that hold a changed variable need their variables redone
+    holding = dict((pk, set()) for pk, variables in changed_variables.items() if variables)
+    for chunk in chunks(holding.keys()):
+        for theme_id, color_hex, variables in DWThemeColor.objects.filter(
+                theme__in = chunk).values_list("theme", "color__color_hex", "variables"):
+            if changed_variables[theme_id] & set(variables.split(", ")):
+                holding[theme_id].add(color_hex)
+    
+    sync_layers = []
+    for theme, colors, digest, variable_digests in changed_layers:
+        variables = changed_variables[theme.pk]
+        
+        if variables is None:
+            counts["changed_variables"] += len(variable_digests)
+        else:
+            counts["changed_variables"] += len(variables)
+            colors = dict((color_hex, color_variables)
+                for color_hex, color_variables in colors.items()
+                if color_hex in holding.get(theme.pk, ())
+                or variables.intersection(color_variables))
+        
+        sync_layers.append((theme, colors))
+    
+    color_objects = resolve_colors(color_hex for theme, colors in sync_layers
+        for color_hex in colors)
+    theme_colors = sync_many_theme_colors(sync_layers, color_objects)
+    
+    with transaction.commit_on_success():
+        for theme, colors, digest, variable_digests in changed_layers:
+            theme.layer_digest = digest
+            theme.layer_variable_digests = json.dumps(variable_digests, sort_keys = True)
+            DWTheme.objects.filter(pk = theme.pk).update(layer_digest = theme.layer_digest,
+                layer_variable_digests = theme.layer_variable_digests)
+    
+    counts["changed"] = len(changed_layers)
+    
+    return color_objects, theme_colors, counts
+
+def import_layers(layers, batch_size = 100):
+    """Writes parsed layers to the themes whose labelid matches their redist_uniq.
+    Layers without a redist_uniq, without a theme, or whose labelid is shared by
+    several layers or themes are skipped, like S2LayerParse skips them.  Each batch
+    of layers goes through import_theme_layers together, so identical layers cost
+    nothing and changed ones only touch the variables that changed.
+    
+    Returns a dictionary of the number of layers "unmatched" and "duplicate", and
+    the counts import_theme_layers returns, added up."""
+    
+    counts = dict(unmatched = 0, duplicate = 0, skipped = 0, changed = 0,
+        changed_variables = 0)
+    
+    by_label = {}
+    for name, redist_unique, colors, digest, variable_digests in layers:
+        if redist_unique is None:
+            counts["unmatched"] += 1
+        else:
+            by_label.setdefault(redist_unique, []).append(
+                (colors, digest, variable_digests))
+    
+    themes = {}
+    for chunk in chunks(sorted(by_label)):
+        for theme in DWTheme.objects.filter(labelid__in = chunk):
+            themes.setdefault(theme.labelid, []).append(theme)
+    
+    theme_layers = []
+    for label in sorted(by_label):
+        if label not in themes:
+            counts["unmatched"] += len(by_label[label])
+        elif len(themes[label]) > 1 or len(by_label[label]) > 1:
+            counts["duplicate"] += len(by_label[label])
+        else:
+            theme_layers.append((themes[label][0],) + by_label[label][0])
+    
+    for batch in chunks(theme_layers, batch_size):
+        color_objects, theme_colors, batch_counts = import_theme_layers(batch)
+        
+        for key, value in batch_counts.items():
+            counts[key] += value
+    
+    return counts
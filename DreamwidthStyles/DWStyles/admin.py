@@ -1,6 +1,11 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
 from DWStyles.models import *
+from DWStyles.jobs import enqueue_job, job_kinds
 from django.forms import ModelForm
+from django.forms.models import BaseInlineFormSet
 from DWStyles.forms import ColorForeignKeyRawIdWidget
 
 # Inline admin classes
@@ -14,11 +19,30 @@ class DWThemeColorForm(ModelForm):
         rel = DWThemeColor._meta.get_field('color').rel
         self.fields["color"].widget = ColorForeignKeyRawIdWidget(rel)
         
+class DWThemeColorInlineFormSet(BaseInlineFormSet):
+    """Gives the color widgets of every row the colors loaded with the rows."""
+
+    def colors(self):
+        if not hasattr(self, "_colors"):
+            self._colors = dict((theme_color.color_id, theme_color.color)
+                for theme_color in self.get_queryset() if theme_color.color_id)
+        return self._colors
+
+    def _construct_form(self, i, **kwargs):
+        form = super(DWThemeColorInlineFormSet, self)._construct_form(i, **kwargs)
+        form.fields["color"].widget.colors = self.colors()
+        return form
+
 class DWThemeColorInlineAdmin(admin.TabularInline):
     model = DWThemeColor
     extra = 1
     #raw_id_fields = ('color', )
     form = DWThemeColorForm
+    formset = DWThemeColorInlineFormSet
+
+    def queryset(self, request):
+        return super(DWThemeColorInlineAdmin, self).queryset(request).select_related(
+            'color', 'theme')
     
 class DWThemeInlineAdmin(admin.TabularInline):
     model = DWTheme
@@ -37,12 +61,42 @@ class DWLayoutForm(ModelForm):
 
 # actions
 
-def set_light_dark_contrast(modeladmin, request, queryset):
+def queue_batch_job(modeladmin, request, queryset, kind):
+    """Queues a batch job over the selected rows, for run_batch_jobs to do outside
+    of the request, and shows its progress."""
 
-    for obj in queryset:
-        obj.set_light_dark_contrast()
+    job = enqueue_job(kind, queryset.values_list('pk', flat = True))
+    modeladmin.message_user(request, "Queued %s for %d rows." % (
+        job_kinds[kind][0].lower(), job.total))
+
+    return HttpResponseRedirect(reverse("dwstyles:batch_job", args = (job.pk,)))
+
+def set_light_dark_contrast(modeladmin, request, queryset):
+    return queue_batch_job(modeladmin, request, queryset, "theme_contrast")
 set_light_dark_contrast.short_description = "Set light/dark contrast"
 
+def recategorize_colors(modeladmin, request, queryset):
+    return queue_batch_job(modeladmin, request, queryset, "categorize_colors")
+recategorize_colors.short_description = "Recategorize colors"
+
+def recompute_metrics(modeladmin, request, queryset):
+    return queue_batch_job(modeladmin, request, queryset, "color_metrics")
+recompute_metrics.short_description = "Recompute color metrics"
+
+def rebuild_distances(modeladmin, request, queryset):
+    return queue_batch_job(modeladmin, request, queryset, "color_distances")
+rebuild_distances.short_description = "Rebuild color distances"
+
+# change lists
+
+class DWThemeChangeList(ChangeList):
+    """Loads the colorbars of the whole page of themes at once."""
+    
+    def get_results(self, request):
+        super(DWThemeChangeList, self).get_results(request)
+        
+        prefetch_colorbars(self.result_list)
+
 # Main admin classes
 
 class DWLayoutAdmin(admin.ModelAdmin):
@@ -70,6 +124,9 @@ class DWThemeAdmin(admin.ModelAdmin):
     filter_horizontal = ('properties',)
     inlines = ( DWThemeColorInlineAdmin, )
     actions = [set_light_dark_contrast]
+    
+    def get_changelist(self, request, **kwargs):
+        return DWThemeChangeList
 admin.site.register(DWTheme, DWThemeAdmin)
 
 class StylePropertyAdmin(admin.ModelAdmin):
@@ -100,6 +157,7 @@ class ColorPropertyAdmin(admin.ModelAdmin):
     list_filter = ('groups', 'is_round', 'in_themes')
     search_fields = ('color_hex', 'label')
     filter_horizontal = ('groups',)
+    actions = [recategorize_colors, recompute_metrics, rebuild_distances]
 
     fieldsets = (
         (None, {
@@ -115,6 +173,26 @@ admin.site.register(ColorProperty, ColorPropertyAdmin)
 
 class ColorDistanceAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'small_color_box','distance')
+    # both colors of every row come with the page of rows
+    list_select_related = True
     fields = ('color_a', 'color_b')
     search_fields = ('color_a__color_hex', 'color_b__color_hex')
-admin.site.register(ColorDistance, ColorDistanceAdmin)
\ No newline at end of file
+admin.site.register(ColorDistance, ColorDistanceAdmin)
+
+class BatchJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', 'done', 'total', 'created', 'progress')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('kind', 'status', 'total', 'done', 'created', 'started',
+        'updated', 'finished', 'message')
+    exclude = ('object_ids',)
+
+    def progress(self, job):
+        return u'<a href="%s">%d%%, %.0f rows/s</a>' % (
+            reverse("dwstyles:batch_job", args = (job.pk,)), job.percent(),
+            job.rows_per_second())
+    progress.allow_tags = True
+
+    # jobs are only queued from the actions
+    def has_add_permission(self, request):
+        return False
+admin.site.register(BatchJob, BatchJobAdmin)
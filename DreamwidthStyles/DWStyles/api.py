@@ -0,0 +1,263 @@
+"""
+A read-only JSON API over the themes, layouts, colors and color groups.
+
+The lists page with the same keyset cursors as the HTML lists, and with
+format=ndjson stream every matching row as one JSON object per line instead,
+fetched a chunk at a time as the response is sent.  Every response carries the
+data version as its ETag, and in its body, so clients can tell when there's
+anything new to sync.
+"""
+
+import json
+
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+    StreamingHttpResponse)
+from django.views.generic import View
+
+from DWStyles.bulk import chunks
+from DWStyles.caching import VersionedCacheMixin
+from DWStyles.colorutil import canonical_hex
+from DWStyles.facets import get_facet_index
+from DWStyles.models import (ColorProperty, ColorPropertyGroup, DWLayout, DWTheme,
+    prefetch_palettes)
+from DWStyles.pagination import InvalidToken, KeysetPaginator, QuerySetKeyset
+from DWStyles.reports import ColorReport
+from DWStyles.views import ThemeFilterMixin
+
+# rows per page, unless a smaller limit is asked for
+api_page_size = 100
+# rows fetched at a time while streaming
+api_stream_chunk_size = 500
+
+def json_response(data, status = 200):
+
+    return HttpResponse(json.dumps(data), content_type = "application/json",
+        status = status)
+
+def iso_date(value):
+
+    return value.isoformat() if value else None
+
+def related_codenames(through, left_field, right_field, left_ids):
+    """The codenames on the right of a many to many through table for each id on
+    the left, in one query per chunk of ids."""
+
+    codenames = dict((pk, []) for pk in left_ids)
+
+    for chunk in chunks(left_ids):
+        for left_id, codename in through.objects.filter(**{
+                "%s__in" % left_field: chunk}).values_list(
+                left_field, "%s__codename" % right_field).order_by(
+                "%s__codename" % right_field):
+            codenames[left_id].append(codename)
+
+    return codenames
+
+def color_data(color):
+
+    return {
+        "hex": color.color_hex,
+        "label": color.label,
+        "rgb": [color.R, color.G, color.B],
+        "hsv": [color.H, color.S, color.V],
+        "rounded_hex": color.rounded_hex,
+        "is_round": color.is_round,
+        "in_themes": color.in_themes,
+    }
+
+def palette_data(theme_colors):
+
+    return [{"hex": theme_color.color.color_hex, "variables": theme_color.variables}
+        for theme_color in theme_colors]
+
+def serialize_themes(themes):
+
+    prefetch_palettes(themes)
+    properties = related_codenames(DWTheme.properties.through, "dwtheme",
+        "styleproperty", [theme.pk for theme in themes])
+
+    return [{
+        "id": theme.pk,
+        "name": theme.name,
+        "labelid": theme.labelid,
+        "sysid": theme.sysid,
+        "official": theme.official,
+        "date_added": iso_date(theme.date_added),
+        "layout": {"id": theme.layout_id, "name": theme.layout.name,
+            "sysid": theme.layout.sysid},
+        "properties": properties[theme.pk],
+        "contrast_ratio": theme.contrast_ratio,
+        "feature_colors": palette_data(theme._palette[0]),
+        "accent_colors": palette_data(theme._palette[1]),
+    } for theme in themes]
+
+def serialize_layouts(layouts):
+
+    properties = related_codenames(DWLayout.properties.through, "dwlayout",
+        "styleproperty", [layout.pk for layout in layouts])
+
+    return [{
+        "id": layout.pk,
+        "name": layout.name,
+        "codename": layout.codename,
+        "labelid": layout.labelid,
+        "sysid": layout.sysid,
+        "official": layout.official,
+        "date_added": iso_date(layout.date_added),
+        "example_theme": layout.example_theme_id,
+        "properties": properties[layout.pk],
+    } for layout in layouts]
+
+def serialize_colors(colors):
+
+    groups = related_codenames(ColorProperty.groups.through, "colorproperty",
+        "colorpropertygroup", [color.pk for color in colors])
+
+    return [dict(color_data(color), groups = groups[color.pk]) for color in colors]
+
+class ApiListView(VersionedCacheMixin, View):
+    """Pages through the rows from get_source, a QuerySetKeyset or a FacetResult,
+    serializing each page with serialize.  ?cursor= takes the next or previous
+    link from a page, ?limit= makes the pages smaller, and ?format=ndjson streams
+    all of them instead."""
+
+    def get_source(self):
+
+        raise NotImplementedError
+
+    def serialize(self, objects):
+
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+
+        source = self.get_source()
+
+        if request.GET.get("format") == "ndjson":
+            return StreamingHttpResponse(self.stream(source),
+                content_type = "application/x-ndjson")
+
+        try:
+            limit = min(max(int(request.GET.get("limit", api_page_size)), 1), api_page_size)
+        except ValueError:
+            return HttpResponseBadRequest("Bad limit.")
+
+        paginator = KeysetPaginator(source, limit)
+
+        try:
+            page = paginator.page(request.GET.get("cursor"))
+        except InvalidToken:
+            return HttpResponseBadRequest("Bad cursor.")
+
+        return json_response({
+            "version": self.data_version,
+            "next": self.cursor_url(page.next_token),
+            "previous": self.cursor_url(page.previous_token),
+            "results": self.serialize(page.object_list),
+        })
+
+    def cursor_url(self, token):
+
+        if not token:
+            return None
+
+        query = self.request.GET.copy()
+        query["cursor"] = token
+
+        return self.request.build_absolute_uri("?" + query.urlencode())
+
+    def stream(self, source):
+        """Every row, one line each, seeking on from the last row of each chunk so
+        that only a chunk is ever held in memory.  Only an empty chunk ends the
+        stream, since a short one doesn't always mean there are no more rows."""
+
+        values = None
+
+        while True:
+            objects = source.seek(values, False, api_stream_chunk_size)
+
+            if not objects:
+                break
+
+            for data in self.serialize(objects):
+                yield json.dumps(data) + "\n"
+
+            values = source.key(objects[-1])
+
+class ThemeApiView(ThemeFilterMixin, ApiListView):
+    """The themes, newest first, taking the same filters as the theme list."""
+
+    def get_source(self):
+
+        self.parse_filters()
+
+        return get_facet_index().result(**self.facet_filters())
+
+    def serialize(self, themes):
+
+        return serialize_themes(themes)
+
+class LayoutApiView(ApiListView):
+
+    def get_source(self):
+
+        return QuerySetKeyset(DWLayout.objects.all(), ("pk",))
+
+    def serialize(self, layouts):
+
+        return serialize_layouts(layouts)
+
+class ColorApiView(ApiListView):
+    """The colors in themes, by hue, saturation and value."""
+
+    def get_source(self):
+
+        return QuerySetKeyset(ColorProperty.objects.filter(in_themes = True),
+            ("H", "S", "V", "pk"))
+
+    def serialize(self, colors):
+
+        return serialize_colors(colors)
+
+class ColorDetailApiView(VersionedCacheMixin, View):
+    """One color, stored or not, with what the color page shows about it."""
+
+    def get(self, request, *args, **kwargs):
+
+        color_hex = canonical_hex(kwargs["slug"])
+
+        if color_hex is None:
+            raise Http404("Not a hex color: %s" % kwargs["slug"])
+
+        try:
+            color = ColorProperty.objects.get(color_hex = color_hex)
+        except ColorProperty.DoesNotExist:
+            color = ColorProperty.transient(color_hex)
+
+        report = ColorReport(color)
+
+        return json_response({
+            "version": self.data_version,
+            "color": dict(color_data(color),
+                groups = [group.codename for group in report.groups]),
+            "similar_colors": [similar.color_hex for similar in report.similar_colors],
+            "near_colors": [near.color_hex for near in report.near_colors],
+            "feature_themes": [theme.pk for theme in report.feature_themes],
+            "accent_themes": [theme.pk for theme in report.accent_themes],
+        })
+
+class ColorGroupApiView(VersionedCacheMixin, View):
+    """All of the color groups; there are only a few dozen."""
+
+    def get(self, request, *args, **kwargs):
+
+        return json_response({
+            "version": self.data_version,
+            "results": [{
+                "id": group.pk,
+                "codename": group.codename,
+                "label": group.label,
+                "category": group.category,
+                "display_color": group.display_color,
+            } for group in ColorPropertyGroup.objects.order_by('codename')],
+        })
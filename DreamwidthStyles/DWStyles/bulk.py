@@ -0,0 +1,40 @@
+"""
+Helpers for writing many rows at once, for the batch jobs.
+"""
+
+from django.db import transaction
+
+# keeps IN lists under SQLite's limit on query parameters
+query_chunk_size = 500
+
+def chunks(items, size = query_chunk_size):
+    """Splits a sequence into lists of at most size items."""
+
+    items = list(items)
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def sync_through_table(through, left_field, right_field, desired, current):
+    """Brings a many to many through table from the current set of (left id,
+    right id) pairs to the desired one, inserting and deleting only the difference,
+    all in one transaction.  Returns the number of rows added and removed."""
+
+    added = desired - current
+    removed = current - desired
+
+    # group the removals by the right side, which has the fewest distinct values
+    removals = {}
+    for left_id, right_id in removed:
+        removals.setdefault(right_id, []).append(left_id)
+
+    with transaction.commit_on_success():
+        through.objects.bulk_create([through(**{left_field: left_id, right_field: right_id})
+            for left_id, right_id in sorted(added)], batch_size = query_chunk_size)
+
+        for right_id, left_ids in removals.items():
+            for chunk in chunks(left_ids):
+                through.objects.filter(**{right_field: right_id,
+                    "%s__in" % left_field: chunk}).delete()
+
+    return len(added), len(removed)
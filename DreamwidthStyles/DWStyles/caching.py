@@ -0,0 +1,93 @@
+"""
+Caching for the public pages.  What the site shows only changes when an admin
+edits or imports something, and every change like that bumps the data version,
+so cached pages and fragments are keyed on it and never need clearing: a bump
+moves every page on to new keys, and the old ones expire on their own.  The
+same version is the pages' ETag, so browsers and crawlers asking again get a
+304 without the page being built or even read from the cache.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.views.decorators.http import condition
+
+from DWStyles.models import get_data_version_stamp
+
+# how long a cached page or fragment lives, in seconds; zero turns them off
+page_cache_timeout = getattr(settings, "DWSTYLES_PAGE_CACHE_TIMEOUT", 60 * 60 * 24)
+
+# which of the CACHES the whole pages go to
+page_cache_alias = getattr(settings, "DWSTYLES_PAGE_CACHE", "default")
+
+def page_cache_key(request, version):
+
+    return "dwstyles:page:%d:%s" % (version,
+        hashlib.md5(request.build_absolute_uri().encode("utf-8")).hexdigest())
+
+def page_etag(version, staff):
+
+    # staff pages have edit links, so they can't stand in for anyone else's
+    return "dwstyles-%d%s" % (version, "-staff" if staff else "")
+
+class VersionedCacheMixin(object):
+    """Serves anonymous GET requests from a cache of whole pages keyed on the
+    data version and the URL.  Staff always get the page built fresh, since it
+    has edit links.  Requests with no_page_cache set skip the page cache too.
+    Every page gets the version as its ETag and the time it was bumped as its
+    Last-Modified, and conditional requests that still match are answered
+    with a 304.  The templates get editlinks, and data_version and
+    fragment_cache_timeout for keying their own fragments."""
+
+    def dispatch(self, request, *args, **kwargs):
+
+        self.data_version, modified = get_data_version_stamp()
+        staff = request.user.is_staff
+        etag = page_etag(self.data_version, staff)
+
+        # a login doesn't change the time, so staff only go by the ETag
+        if staff:
+            modified = None
+
+        respond = condition(etag_func = lambda request, *args, **kwargs: etag,
+            last_modified_func = lambda request, *args, **kwargs: modified)(
+            self.cached_dispatch)
+
+        return respond(request, *args, **kwargs)
+
+    def cached_dispatch(self, request, *args, **kwargs):
+
+        if (not page_cache_timeout or request.method not in ("GET", "HEAD") or
+                request.user.is_staff or getattr(request, "no_page_cache", False)):
+            return super(VersionedCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        cache = get_cache(page_cache_alias)
+        key = page_cache_key(request, self.data_version)
+
+        response = cache.get(key)
+        if response is not None:
+            return response
+
+        response = super(VersionedCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        if response.status_code == 200 and not response.cookies and not getattr(
+                response, "streaming", False):
+            store = lambda response: cache.set(key, response, page_cache_timeout)
+            if hasattr(response, "render") and not response.is_rendered:
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super(VersionedCacheMixin, self).get_context_data(**kwargs)
+
+        context.update({
+            "editlinks": self.request.user.is_staff,
+            "data_version": self.data_version,
+            "fragment_cache_timeout": page_cache_timeout,
+        })
+
+        return context
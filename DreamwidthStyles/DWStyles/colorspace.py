@@ -0,0 +1,292 @@
+"""
+Precomputed distances between the colors of the rounding grid.
+
+The CMC distances between every pair of rounded colors only depend on the grid,
+so they are computed once with numpy and saved as a dense float32 matrix.  Each
+worker memory-maps the file read-only, which lets the operating system share one
+copy between all of them, and looking up the colors near a rounded color is
+just a read of one row.
+
+A dense matrix grows with the square of the grid, so finer grids (16 or 8 RGB
+units) instead keep a sparse graph of only the k nearest neighbours of each
+color under a distance cutoff, built in chunks across a process pool.
+"""
+
+import os
+from multiprocessing import Pool
+
+import numpy
+from django.conf import settings
+from numpy.lib.format import open_memmap
+
+from DWStyles.colorutil import (delta_e_cmc_array, max_color_value, rgb_array_to_hex,
+    rgb_to_lab_array, round_color_segment)
+
+# colors further away than this aren't "near"
+near_color_distance = 10
+
+# rows computed at once when building a matrix, to bound the temporary arrays
+matrix_chunk_rows = 256
+
+# default size of the nearest neighbour graph
+neighbour_graph_k = 64
+
+_matrices = {}
+_graphs = {}
+_labs = {}
+
+def grid_values(segment = round_color_segment):
+    """The values each RGB channel can take on a rounding grid, ending with 255."""
+
+    values = range(0, max_color_value, segment)
+
+    if values[-1] != max_color_value - 1:
+        values.append(max_color_value - 1)
+
+    return numpy.array(values, dtype=numpy.int64)
+
+def grid_rgb(segment = round_color_segment):
+    """All of the colors of a rounding grid as an (n, 3) array, in the same
+    (alphabetical by hex) order generate_rounded_colors uses."""
+
+    values = grid_values(segment)
+    r, g, b = numpy.meshgrid(values, values, values, indexing="ij")
+
+    return numpy.column_stack((r.ravel(), g.ravel(), b.ravel()))
+
+def grid_hexes(segment = round_color_segment):
+
+    return rgb_array_to_hex(grid_rgb(segment))
+
+def grid_index(rounded_hex, segment = round_color_segment):
+    """Returns the position of a rounded color in the grid, or None if the hex is
+    not on the grid."""
+
+    values = grid_values(segment)
+    index = 0
+
+    for i in (0, 2, 4):
+        value = int(rounded_hex[i:i + 2], 16)
+        position = numpy.searchsorted(values, value)
+        if position >= len(values) or values[position] != value:
+            return None
+        index = index * len(values) + int(position)
+
+    return index
+
+def grid_lab(segment = round_color_segment):
+
+    if segment not in _labs:
+        _labs[segment] = rgb_to_lab_array(grid_rgb(segment))
+
+    return _labs[segment]
+
+def cmc_distance_rows(lab, start, end):
+    """Distances from the grid colors start to end to every grid color.
+
+    CMC isn't symmetric, so like create_rounded_distances always did, the
+    alphabetically first color of each pair is used as the reference color."""
+
+    rows = numpy.arange(start, end)[:, None]
+    columns = numpy.arange(len(lab))[None, :]
+
+    forward = delta_e_cmc_array(lab[start:end, None, :], lab[None, :, :])
+    backward = delta_e_cmc_array(lab[None, :, :], lab[start:end, None, :])
+
+    distances = numpy.where(columns > rows, forward, backward)
+    distances[rows == columns] = 0
+
+    return distances
+
+class DistanceMatrixMissing(IOError):
+    pass
+
+def distance_matrix_path(segment = round_color_segment):
+
+    return os.path.join(settings.DWSTYLES_DATA_ROOT, "color_distances_%d.npy" % segment)
+
+def build_distance_matrix(segment = round_color_segment):
+    """Computes the dense float32 CMC distance matrix for a rounding grid into the
+    file get_distance_matrix maps, a chunk of rows at a time, so the whole matrix
+    is never in memory.  Writes to a temporary file first so running workers
+    never map a half written file.  Returns the path."""
+
+    lab = grid_lab(segment)
+    path = distance_matrix_path(segment)
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    matrix = open_memmap(temporary, mode="w+", dtype=numpy.float32,
+        shape=(len(lab), len(lab)))
+
+    for start in range(0, len(lab), matrix_chunk_rows):
+        end = min(start + matrix_chunk_rows, len(lab))
+        matrix[start:end] = cmc_distance_rows(lab, start, end)
+
+    matrix.flush()
+    del matrix
+    os.rename(temporary, path)
+
+    _matrices.pop(segment, None)
+
+    return path
+
+def get_distance_matrix(segment = round_color_segment):
+    """Returns the distance matrix for the grid, memory-mapped read-only from the
+    file build_distance_matrix wrote.  Raises DistanceMatrixMissing if it hasn't
+    been built for this grid, rather than building gigabytes of it in memory."""
+
+    if segment not in _matrices:
+        size = len(grid_values(segment)) ** 3
+        path = distance_matrix_path(segment)
+
+        if not os.path.exists(path):
+            raise DistanceMatrixMissing("No color distance matrix at %s; run "
+                "the build_color_distances command." % path)
+
+        matrix = numpy.load(path, mmap_mode="r")
+        if matrix.shape != (size, size):
+            raise DistanceMatrixMissing("The color distance matrix at %s is for "
+                "another grid; run the build_color_distances command." % path)
+
+        _matrices[segment] = matrix
+
+    return _matrices[segment]
+
+def distance_row(index, segment = round_color_segment):
+    """Distances from one grid color to all of the others, read from the saved
+    matrix if there is one and computed directly otherwise."""
+
+    if segment in _matrices or os.path.exists(distance_matrix_path(segment)):
+        return numpy.asarray(get_distance_matrix(segment)[index])
+
+    return cmc_distance_rows(grid_lab(segment), index, index + 1)[0]
+
+# Nearest neighbour graphs
+
+def neighbour_chunk_rows(segment = round_color_segment):
+    """Rows per chunk, keeping each chunk's temporary arrays at a few megabytes."""
+
+    return max(1, 2 ** 19 // len(grid_values(segment)) ** 3)
+
+def neighbour_chunk(arguments):
+    """Finds the k nearest neighbours closer than max_distance for the grid colors
+    start to end.  Runs in the worker processes."""
+
+    segment, start, end, k, max_distance = arguments
+
+    distances = cmc_distance_rows(grid_lab(segment), start, end)
+    neighbours = []
+
+    for i, row in enumerate(distances):
+        near = numpy.nonzero(row < max_distance)[0]
+        near = near[near != start + i]
+        near = near[numpy.argsort(row[near], kind="mergesort")][:k]
+        neighbours.append((near.astype(numpy.int32), row[near].astype(numpy.float32)))
+
+    return neighbours
+
+def build_neighbour_graph(segment = round_color_segment, k = neighbour_graph_k,
+    max_distance = near_color_distance, processes = None):
+    """Builds a compressed sparse row graph of the k nearest neighbours of every
+    grid color, as a dictionary of "indptr", "indices" and "distances" arrays:
+    the neighbours of color i are indices[indptr[i]:indptr[i + 1]], closest first."""
+
+    size = len(grid_values(segment)) ** 3
+    step = neighbour_chunk_rows(segment)
+    chunks = [(segment, start, min(start + step, size), k, max_distance)
+        for start in range(0, size, step)]
+
+    pool = Pool(processes)
+    try:
+        rows = [row for chunk in pool.imap(neighbour_chunk, chunks) for row in chunk]
+    finally:
+        pool.close()
+        pool.join()
+
+    indptr = numpy.zeros(size + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum([len(indices) for indices, distances in rows])
+
+    return {
+        "indptr": indptr,
+        "indices": numpy.concatenate([indices for indices, distances in rows]),
+        "distances": numpy.concatenate([distances for indices, distances in rows]),
+        "max_distance": numpy.float32(max_distance),
+    }
+
+def neighbour_graph_path(segment = round_color_segment):
+
+    return os.path.join(settings.DWSTYLES_DATA_ROOT, "color_neighbours_%d.npz" % segment)
+
+def save_neighbour_graph(graph, segment = round_color_segment):
+
+    path = neighbour_graph_path(segment)
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temporary = "%s.%d.tmp.npz" % (path[:-len(".npz")], os.getpid())
+    numpy.savez(temporary, **graph)
+    os.rename(temporary, path)
+
+    _graphs.pop(segment, None)
+
+    return path
+
+def get_neighbour_graph(segment = round_color_segment):
+    """Returns the saved neighbour graph for the grid, or None if it hasn't been built."""
+
+    if segment not in _graphs:
+        path = neighbour_graph_path(segment)
+        graph = None
+
+        if os.path.exists(path):
+            data = numpy.load(path)
+            try:
+                graph = dict((name, data[name]) for name in data.files)
+            finally:
+                data.close()
+
+        _graphs[segment] = graph
+
+    return _graphs[segment]
+
+def graph_nbytes(graph):
+
+    return sum(graph[name].nbytes for name in ("indptr", "indices", "distances"))
+
+def near_rounded_colors(rounded_hex, max_distance = near_color_distance,
+    segment = round_color_segment):
+    """Returns (hex, distance) tuples for the grid colors closer than max_distance
+    to the given rounded color, closest first, not including the color itself.
+
+    Uses the neighbour graph when it has been built with a large enough cutoff,
+    and a row of the distance matrix otherwise."""
+
+    index = grid_index(rounded_hex, segment)
+
+    if index is None:
+        return []
+
+    graph = get_neighbour_graph(segment)
+
+    if graph is not None and graph["max_distance"] >= max_distance:
+        start, end = graph["indptr"][index], graph["indptr"][index + 1]
+        near = graph["indices"][start:end].astype(numpy.int64)
+        distances = graph["distances"][start:end]
+        near = near[distances < max_distance]
+        distances = distances[distances < max_distance]
+    else:
+        row = distance_row(index, segment)
+        near = numpy.nonzero(row < max_distance)[0]
+        near = near[near != index]
+        near = near[numpy.argsort(row[near], kind="mergesort")]
+        distances = row[near]
+
+    hexes = rgb_array_to_hex(grid_rgb(segment)[near])
+
+    return zip(hexes, distances.tolist())
@@ -1,6 +1,16 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from colormath import color_constants
+from django.conf import settings
+
 # Colors
 
-round_color_segment = 32
+# the size of the rounding grid, in RGB units; must divide 256
+round_color_segment = getattr(settings, "DWSTYLES_ROUND_COLOR_SEGMENT", 32)
 max_color_value = 256
 
 def contrast_ratio(color_a, color_b):
@@ -22,10 +32,27 @@ def channel_value(v):
 
 def relative_luminance(c):
     
-    (r, g, b) = [channel_value(v) for v in (c.R, c.G, c.B)]
+    # WCAG works on 0.0 - 1.0 channel values
+    (r, g, b) = [channel_value(v / 255.0) for v in (c.R, c.G, c.B)]
     
     return 0.2126 * r + 0.7152 * g + 0.0722 * b
 
+def relative_luminance_array(rgb):
+    """Array version of relative_luminance, for an (n, 3) array of 0 - 255 RGB values."""
+    
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+    linear = numpy.where(rgb <= 0.03928, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    
+    return numpy.dot(linear, [0.2126, 0.7152, 0.0722])
+
+def contrast_ratio_array(rgb_a, rgb_b):
+    """Array version of contrast_ratio, for two (n, 3) arrays of RGB values."""
+    
+    rla = relative_luminance_array(rgb_a)
+    rlb = relative_luminance_array(rgb_b)
+    
+    return (numpy.maximum(rla, rlb) + 0.05) / (numpy.minimum(rla, rlb) + 0.05)
+
 def round_rgb_colorvalue(cv):
     
     # returns the RGB color value rounded to the nearest segment
@@ -38,132 +65,306 @@ def round_rgb_colorvalue(cv):
     else:
         return value
 
+class ColorValues(object):
+    """Holds arrays of H, S and V values, so that the ColorCategorizer rules can be
+    checked against many colors at once."""
+    
+    def __init__(self, H, S, V):
+        
+        self.H = numpy.asarray(H)
+        self.S = numpy.asarray(S)
+        self.V = numpy.asarray(V)
+
 class ColorCategorizer(object):
+    """The rules are combined with & and | instead of and/or, so they work both on
+    a single color and on a ColorValues of numpy arrays."""
+    
+    # bump this whenever a rule changes, so every color gets recategorized
+    version = 1
     
     def is_red(self, c):
         """Returns a boolean on whether or not to consider this color red."""
         
-        if c.V <= 10:
-            return False
-        
-        # red is in these regions
-        if not (( c.H >= 0 and c.H <= 14) or (c.H >= 342 and c.H <= 359)):
-            return False
-        
-        # if the saturation is low, probably pink
-        if not c.S >= 50:
-            return False
-        
-        return True
+        # red is in these regions, and if the saturation is low, probably pink
+        return ((c.V > 10) 
+            & (((c.H >= 0) & (c.H <= 14)) | ((c.H >= 342) & (c.H <= 359))) 
+            & (c.S >= 50))
         
     def is_green(self, c):
         
-        if c.V <= 10:
-            return False
-        
-        if not (c.H >= 69 and c.H <= 170):
-            return False
-        
-        return True
+        return (c.V > 10) & (c.H >= 69) & (c.H <= 170)
     
     def is_blue(self, c):
         
-        if c.V <= 10:
-            return False
-        
-        if not (c.H >=167 and c.H <= 250):
-            return False
-        
-        return True
+        return (c.V > 10) & (c.H >= 167) & (c.H <= 250)
         
     def is_yellow(self, c):
         
-        if c.V <= 10:
-            return False
-            
-        if not (c.H <=72 and c.H >= 50):
-            return False
-        
-        return True
+        return (c.V > 10) & (c.H <= 72) & (c.H >= 50)
         
     def is_orange(self, c):
         
-        if not (c.H <= 50 and c.H >= 25):
-            return False
-        
-        return True
+        return (c.H <= 50) & (c.H >= 25)
     
     def is_purple(self, c):
         
-        if c.V <= 10:
-            return False
-        
-        if not (c.H >= 270 and c.H <= 290):
-            return False
-        
-        return True
+        return (c.V > 10) & (c.H >= 270) & (c.H <= 290)
     
     def is_pink(self, c):
         
-        if not (c.H > 290 and c.H <= 340):
-            return False
-        
-        return True
+        return (c.H > 290) & (c.H <= 340)
         
     def is_brown(self, c):
         
-        return False
+        return numpy.zeros_like(c.V, dtype=bool)
     
     def is_gray(self, c):
         
-        if c.V <= 10 or c.V >= 95:
-            return False
-        
-        if c.S <= 5:
-            return True
-        
-        return False
+        return (c.V > 10) & (c.V < 95) & (c.S <= 5)
     
     def is_black(self, c):
         
-        if c.V <= 10:
-            return True
-        
-        return False
+        return c.V <= 10
     
     def is_white(self, c):
         
-        if c.S < 5 and c.V > 95:
-            return True
-        
-        return False
+        return (c.S < 5) & (c.V > 95)
     
     # Characteristics
     
     def is_dark(self, c):
         
-        if c.V < 30:
-            return True
-        
-        return False
+        return c.V < 30
     
     def is_light(self, c):
         
-        if c.V > 95 and c.S < 30:
-            return True
-        
-        return False
+        return (c.V > 95) & (c.S < 30)
     
     def is_bright(self, c):
         
-        if c.V > 95 and c.S > 90:
-            return True
-        
-        return False
+        return (c.V > 95) & (c.S > 90)
     
     def is_muted(self, c):
         
-        if c.V > 50 and c.V < 85 and c.S > 5 and c.S < 85:
-            return True
-        
-        return False
\ No newline at end of file
+        return (c.V > 50) & (c.V < 85) & (c.S > 5) & (c.S < 85)
+
+# Batch color metrics
+#
+# These mirror ColorProperty.refresh_values, but work on whole arrays of colors
+# at once instead of building colormath objects one color at a time.
+
+def round_half_up(values):
+    """Rounds like Python 2's round() does for positive values, which is
+    half away from zero instead of numpy's round half to even."""
+
+    return numpy.floor(numpy.asarray(values, dtype=numpy.float64) + 0.5)
+
+def hex_to_rgb_array(hexes):
+    """Turns a sequence of six digit hex strings into an (n, 3) array of 0 - 255
+    RGB values."""
+
+    hexes = [hex_value.lstrip("#") for hex_value in hexes]
+
+    for hex_value in hexes:
+        if len(hex_value) != 6:
+            raise ValueError("input #%s is not in #RRGGBB format" % hex_value)
+
+    if not hexes:
+        return numpy.zeros((0, 3), dtype=numpy.int64)
+
+    packed = numpy.array([int(hex_value, 16) for hex_value in hexes], dtype=numpy.int64)
+
+    return numpy.column_stack(((packed >> 16) & 0xff, (packed >> 8) & 0xff, packed & 0xff))
+
+def rgb_array_to_hex(rgb):
+    """Turns an (n, 3) array of RGB values into a list of lowercase hex strings."""
+
+    return ["%02x%02x%02x" % (r, g, b) for r, g, b in numpy.asarray(rgb).tolist()]
+
+def rgb_to_hsv_array(rgb):
+    """Converts an (n, 3) array of 0 - 255 RGB values to HSV the same way
+    colormath does: H is 0 to 360 degrees, S and V are 0.0 to 1.0."""
+
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+
+    var_max = rgb.max(axis=1)
+    var_min = rgb.min(axis=1)
+    delta = var_max - var_min
+
+    # avoid dividing by zero for grays, which get a hue of 0 anyway
+    safe_delta = numpy.where(delta == 0, 1.0, delta)
+    safe_max = numpy.where(var_max == 0, 1.0, var_max)
+
+    # colormath checks red, then green, then blue for the maximum
+    hue = numpy.where(var_max == r, (60.0 * ((g - b) / safe_delta) + 360) % 360.0,
+        numpy.where(var_max == g, 60.0 * ((b - r) / safe_delta) + 120,
+            60.0 * ((r - g) / safe_delta) + 240.0))
+    hue = numpy.where(delta == 0, 0.0, hue)
+
+    saturation = numpy.where(var_max == 0, 0.0, 1.0 - (var_min / safe_max))
+
+    return hue, saturation, var_max
+
+def round_rgb_array(values):
+    """Array version of round_rgb_colorvalue."""
+
+    values = numpy.asarray(values, dtype=numpy.int64)
+    rounded = (values // round_color_segment
+        + (values % round_color_segment * 2 >= round_color_segment)) * round_color_segment
+
+    # don't return 256, return 255
+    return numpy.where(rounded == max_color_value, max_color_value - 1, rounded)
+
+def color_metrics(hexes):
+    """Computes every derived ColorProperty column for a sequence of hex strings
+    in one pass.  Returns a dictionary of field name to numpy array (or list,
+    for rounded_hex), in the same order as the hexes given.
+
+    The values match what ColorProperty.refresh_values would set, including
+    the rounded HSV values being left unscaled."""
+
+    rgb = hex_to_rgb_array(hexes)
+    hue, saturation, value = rgb_to_hsv_array(rgb)
+
+    rounded_rgb = round_rgb_array(rgb)
+    rounded_hue, rounded_saturation, rounded_value = rgb_to_hsv_array(rounded_rgb)
+
+    return {
+        "R": rgb[:, 0],
+        "G": rgb[:, 1],
+        "B": rgb[:, 2],
+        "H": round_half_up(hue).astype(numpy.int64),
+        # need to multiply by 100 to get the percent
+        "S": round_half_up(saturation * 100.0).astype(numpy.int64),
+        "V": round_half_up(value * 100.0).astype(numpy.int64),
+        "rR": rounded_rgb[:, 0],
+        "rG": rounded_rgb[:, 1],
+        "rB": rounded_rgb[:, 2],
+        "rH": rounded_hue,
+        "rS": rounded_saturation,
+        "rV": rounded_value,
+        "rounded_hex": rgb_array_to_hex(rounded_rgb),
+        "is_round": (rgb == rounded_rgb).all(axis=1),
+    }
+
+COLOR_METRIC_FIELDS = ("R", "G", "B", "H", "S", "V", "rR", "rG", "rB", "rH", "rS", "rV",
+    "rounded_hex", "is_round")
+
+def iter_color_metrics(hexes):
+    """Runs color_metrics and yields one dictionary of plain Python values per hex,
+    ready to be assigned to a ColorProperty or passed to a queryset update."""
+
+    metrics = color_metrics(hexes)
+    columns = [(field, list(metrics[field])) for field in COLOR_METRIC_FIELDS]
+
+    for i in range(len(hexes)):
+        values = {}
+        for field, column in columns:
+            value = column[i]
+            if isinstance(value, numpy.bool_):
+                value = bool(value)
+            elif isinstance(value, numpy.integer):
+                value = int(value)
+            elif isinstance(value, numpy.floating):
+                value = float(value)
+            values[field] = value
+        yield values
+
+# how many colors cached_color_metrics remembers
+color_metrics_cache_size = getattr(settings, "DWSTYLES_COLOR_METRICS_CACHE_SIZE", 4096)
+
+_color_metrics_cache = OrderedDict()
+_color_metrics_lock = threading.Lock()
+
+def cached_color_metrics(color_hex):
+    """The color_metrics values for a single hex, as iter_color_metrics gives
+    them, remembering the most recently used ones."""
+
+    with _color_metrics_lock:
+        values = _color_metrics_cache.pop(color_hex, None)
+        if values is None:
+            values = next(iter_color_metrics([color_hex]))
+        _color_metrics_cache[color_hex] = values
+
+        while len(_color_metrics_cache) > color_metrics_cache_size:
+            _color_metrics_cache.popitem(last = False)
+
+    return dict(values)
+
+def canonical_hex(color_hex):
+    """The lowercase six digit form of a three or six digit hex color, or None
+    if it's neither."""
+
+    color_hex = color_hex.lstrip("#").lower()
+
+    if not re.match(r"^([0-9a-f]{3}|[0-9a-f]{6})$", color_hex):
+        return None
+
+    if len(color_hex) == 3:
+        color_hex = "".join(digit * 2 for digit in color_hex)
+
+    return color_hex
+
+# Batch color distances
+
+def rgb_to_lab_array(rgb):
+    """Converts an (n, 3) array of 0 - 255 sRGB values to an (n, 3) array of Lab
+    values, using the same constants (D65, 2 degree observer) colormath does."""
+
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+    linear = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+
+    xyz = numpy.dot(linear, color_constants.RGB_SPECS["srgb"]["conversions"]["rgb_to_xyz"])
+
+    illum = color_constants.ILLUMINANTS["2"][color_constants.RGB_SPECS["srgb"]["native_illum"]]
+    xyz = xyz / numpy.array(illum)
+
+    xyz = numpy.where(xyz > color_constants.CIE_E, xyz ** (1.0 / 3.0),
+        (7.787 * xyz) + (16.0 / 116.0))
+
+    return numpy.column_stack(((116.0 * xyz[:, 1]) - 16.0,
+        500.0 * (xyz[:, 0] - xyz[:, 1]),
+        200.0 * (xyz[:, 1] - xyz[:, 2])))
+
+def delta_e_cmc_array(lab1, lab2, pl = 1, pc = 1):
+    """Vectorized colormath delta_e_cmc.  lab1 and lab2 are arrays whose last axis
+    is L, a, b and which broadcast against each other, so an (n, 1, 3) array
+    against a (1, m, 3) array gives an (n, m) distance matrix.
+
+    Like colormath, this is not symmetric: the weighting comes from lab1."""
+
+    lab1 = numpy.asarray(lab1, dtype=numpy.float64)
+    lab2 = numpy.asarray(lab2, dtype=numpy.float64)
+
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    delta_L = L1 - L2
+    delta_a = a1 - a2
+    delta_b = b1 - b2
+
+    C_1 = numpy.sqrt(a1 ** 2 + b1 ** 2)
+    C_2 = numpy.sqrt(a2 ** 2 + b2 ** 2)
+
+    H_1 = numpy.degrees(numpy.arctan2(b1, a1))
+    H_1 = numpy.where(H_1 < 0, H_1 + 360, H_1)
+
+    F = numpy.sqrt(C_1 ** 4 / (C_1 ** 4 + 1900.0))
+    T = numpy.where((164 <= H_1) & (H_1 <= 345),
+        0.56 + numpy.abs(0.2 * numpy.cos(numpy.radians(H_1 + 168))),
+        0.36 + numpy.abs(0.4 * numpy.cos(numpy.radians(H_1 + 35))))
+
+    S_L = numpy.where(L1 < 16, 0.511, (0.040975 * L1) / (1 + 0.01765 * L1))
+    S_C = ((0.0638 * C_1) / (1 + 0.0131 * C_1)) + 0.638
+    S_H = S_C * (F * T + 1 - F)
+
+    delta_C = C_1 - C_2
+    # colormath falls back to 0 when rounding makes this negative
+    delta_H = numpy.sqrt(numpy.maximum(delta_a ** 2 + delta_b ** 2 - delta_C ** 2, 0.0))
+
+    L_group = delta_L / (pl * S_L)
+    C_group = delta_C / (pc * S_C)
+    H_group = delta_H / S_H
+
+    return numpy.sqrt(L_group ** 2 + C_group ** 2 + H_group ** 2)
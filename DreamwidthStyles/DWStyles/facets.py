@@ -0,0 +1,253 @@
+"""
+A per-process index of the theme list filters.
+
+Every theme property, layout, layout property and feature color group gets one
+bitset of the themes that have it, over the themes in list order.  Filtering
+the theme list is then a matter of intersecting bitsets, and the database only
+has to fetch the page of themes being shown.  The index is rebuilt the first
+time it's used after the data version changes.
+"""
+
+import threading
+
+import numpy
+
+from DWStyles.models import (ColorPropertyGroup, DWLayout, DWTheme, DWThemeColor,
+    StyleProperty, get_data_version)
+
+_index = None
+_index_lock = threading.Lock()
+
+# the theme list filter form field for each kind of option
+facet_fields = {
+    "theme_property": "themefilter",
+    "layout_property": "layoutfilter",
+    "layout": "layoutselect",
+    "color_group": "colorfilter",
+}
+
+class FacetIndex(object):
+
+    def __init__(self, version):
+
+        self.version = version
+
+        # newest first, with undated themes last on every database
+        rows = sorted(DWTheme.objects.values_list('pk', 'layout', 'contrast_ratio',
+            'date_added'), key = lambda row: theme_sort_key(row[3], row[0]), reverse = True)
+
+        self.size = len(rows)
+        self.theme_ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        self.sort_keys = numpy.array([combined_sort_key(theme_sort_key(row[3], row[0]))
+            for row in rows], dtype=numpy.int64)
+        # themes without a ratio never pass a minimum
+        self.contrast_ratios = numpy.array([-1.0 if row[2] is None else row[2]
+            for row in rows], dtype=numpy.float64)
+
+        position = dict((pk, i) for i, pk in enumerate(self.theme_ids.tolist()))
+
+        positions = {}
+        for i, (pk, layout, ratio, date_added) in enumerate(rows):
+            positions.setdefault(("layout", layout), []).append(i)
+
+        # themes added since the list was read are left for the next rebuild
+        for theme, style_property in DWTheme.properties.through.objects.values_list(
+                'dwtheme', 'styleproperty'):
+            if theme in position:
+                positions.setdefault(("theme_property", style_property), []).append(
+                    position[theme])
+
+        for layout, style_property in DWLayout.properties.through.objects.values_list(
+                'dwlayout', 'styleproperty'):
+            positions.setdefault(("layout_property", style_property), []).extend(
+                positions.get(("layout", layout), []))
+
+        for theme, group in DWThemeColor.objects.filter(category = "feature",
+                color__groups__isnull = False).values_list(
+                'theme', 'color__groups').distinct():
+            if theme in position:
+                positions.setdefault(("color_group", group), []).append(position[theme])
+
+        self.bitsets = dict((key, self.bitset(theme_positions))
+            for key, theme_positions in positions.items())
+
+        # the value each option has in the filter form, for every option there
+        # is, whether or not any themes have it yet
+        self.choice_values = {}
+        for pk, codename, layout_use, theme_use in StyleProperty.objects.values_list(
+                'pk', 'codename', 'layout_use', 'theme_use'):
+            if layout_use:
+                self.choice_values[("layout_property", pk)] = codename
+            if theme_use:
+                self.choice_values[("theme_property", pk)] = codename
+        for pk, sysid in DWLayout.objects.values_list('pk', 'sysid'):
+            self.choice_values[("layout", pk)] = sysid
+        for pk, codename in ColorPropertyGroup.objects.values_list('pk', 'codename'):
+            self.choice_values[("color_group", pk)] = codename
+
+        # the same memberships unpacked into one row per option, for counting
+        self.keys = sorted(self.choice_values)
+        self.matrix = numpy.zeros((len(self.keys), self.size), dtype=numpy.float32)
+        for row, key in enumerate(self.keys):
+            if key in self.bitsets:
+                self.matrix[row] = numpy.unpackbits(self.bitsets[key])[:self.size]
+
+    def bitset(self, positions):
+
+        mask = numpy.zeros(self.size, dtype=bool)
+        mask[positions] = True
+
+        return numpy.packbits(mask)
+
+    def empty(self):
+
+        return numpy.zeros((self.size + 7) // 8, dtype=numpy.uint8)
+
+    def mask(self, theme_properties = (), layout_properties = (), layouts = (),
+        color_groups = (), min_contrast = None):
+        """The themes, as a boolean array in list order, that have all of the theme
+        properties, layout properties and feature color groups, are in any of the
+        layouts if any are given, and have at least the minimum contrast ratio.
+        Everything is given by primary key."""
+
+        bits = numpy.packbits(numpy.ones(self.size, dtype=bool))
+
+        for kind, pks in (("theme_property", theme_properties),
+            ("layout_property", layout_properties), ("color_group", color_groups)):
+            for pk in pks:
+                bits &= self.bitsets.get((kind, pk), self.empty())
+
+        if layouts:
+            any_layout = self.empty()
+            for pk in layouts:
+                any_layout |= self.bitsets.get(("layout", pk), self.empty())
+            bits &= any_layout
+
+        mask = numpy.unpackbits(bits)[:self.size].astype(bool)
+
+        if min_contrast is not None:
+            mask &= self.contrast_ratios >= min_contrast
+
+        return mask
+
+    def counts(self, **filters):
+        """How many themes would match if each option were added to the filters,
+        as a dictionary of filter form field to option value to count.  Worked out
+        in one product of the membership matrix with the matching themes, plus
+        one more when layouts are chosen, since choosing another widens the match."""
+
+        mask = self.mask(**filters)
+        counts = self.matrix.dot(mask.astype(numpy.float32))
+
+        if filters.get("layouts"):
+            # the themes only held back by the layouts already chosen
+            held_back = self.mask(**dict(filters, layouts = ())) & ~mask
+            widened = mask.sum() + self.matrix.dot(held_back.astype(numpy.float32))
+        else:
+            widened = counts
+
+        result = dict((field, {}) for field in facet_fields.values())
+
+        for row, key in enumerate(self.keys):
+            kind = key[0]
+            count = widened[row] if kind == "layout" else counts[row]
+            result[facet_fields[kind]][self.choice_values[key]] = int(count)
+
+        return result
+
+    def filter(self, **filters):
+        """The primary keys of the themes matching the filters, newest first."""
+
+        return self.theme_ids[self.mask(**filters)]
+
+    def result(self, **filters):
+        """The themes matching the filters, as a FacetResult."""
+
+        mask = self.mask(**filters)
+
+        return FacetResult(self.theme_ids[mask], self.sort_keys[mask])
+
+def theme_sort_key(date_added, pk):
+    """What the theme list is sorted by, newest first, as a pair of numbers."""
+
+    return (date_added.toordinal() if date_added else 0, pk)
+
+def combined_sort_key(key):
+
+    return key[0] * 2 ** 32 + key[1]
+
+class FacetResult(object):
+    """The themes matching a filter, as a sequence the paginator can slice, only
+    fetching the themes on the page asked for.  Can also be paged through with
+    a KeysetPaginator, seeking on the themes' sort keys."""
+
+    keys = ("date_added", "pk")
+
+    def __init__(self, theme_ids, sort_keys = None):
+
+        self.theme_ids = theme_ids
+        self.sort_keys = sort_keys
+
+    def __len__(self):
+
+        return len(self.theme_ids)
+
+    def __iter__(self):
+
+        return iter(self[:])
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, slice):
+            return self[key:key + 1 or None][0]
+
+        theme_ids = self.theme_ids[key].tolist()
+        themes = DWTheme.objects.select_related('layout').in_bulk(theme_ids)
+
+        return [themes[pk] for pk in theme_ids if pk in themes]
+
+    def key(self, theme):
+
+        return theme_sort_key(theme.date_added, theme.pk)
+
+    def seek(self, values, backwards, limit):
+
+        if values is None:
+            position = 0
+        else:
+            # the keys are descending, so search their negatives
+            position = numpy.searchsorted(-self.sort_keys, -combined_sort_key(values),
+                side = "left" if backwards else "right")
+
+        if backwards:
+            return self[max(0, position - limit):position]
+
+        # themes deleted since the index was built are left out of the slices, so
+        # read on past them, only coming up short at the end of the themes
+        themes = []
+        while len(themes) < limit and position < len(self.theme_ids):
+            end = position + limit - len(themes)
+            themes.extend(self[position:end])
+            position = end
+
+        return themes
+
+def get_facet_index():
+    """The facet index, rebuilt first if the data changed since it was built."""
+
+    global _index
+
+    version = get_data_version()
+
+    if _index is None or _index.version != version:
+        with _index_lock:
+            if _index is None or _index.version != version:
+                _index = FacetIndex(version)
+
+    return _index
+
+def clear_facet_index():
+
+    global _index
+
+    _index = None
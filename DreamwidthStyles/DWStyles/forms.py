@@ -3,38 +3,109 @@ import inspect
 from django import forms
 from django.conf import settings
 from django.contrib.admin.sites import site
+from django.core.cache import cache
 from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 from django.forms.formsets import formset_factory
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
+from django.utils.text import Truncator
 from django.utils.translation import ugettext as _
 
 from DWStyles.models import *
 
-class LayoutPropertyFilterForm(forms.Form):
+# where the options of each filter field come from
+filter_choice_providers = {
+    "layout_property": StyleProperty.get_layout_property_choices,
+    "theme_property": StyleProperty.get_theme_property_choices,
+    "layout": DWLayout.get_layout_choices,
+    "color_group": ColorPropertyGroup.get_colorgroup_choices,
+}
+
+choices_cache_timeout = 60 * 60 * 24
+
+def get_filter_choices(name, version = None):
+    """The options of a filter field, kept in the cache until the data version
+    changes, so building a form doesn't take any queries of its own."""
+
+    if version is None:
+        version = get_data_version()
+
+    key = "dwstyles:choices:%s:%d" % (name, version)
+    choices = cache.get(key)
+
+    if choices is None:
+        choices = filter_choice_providers[name]()
+        cache.set(key, choices, choices_cache_timeout)
+
+    return choices
+
+class FilterChoicesForm(forms.Form):
+    """A form whose filter_fields get their choices when it's made, rather than
+    when the module is imported.  Takes the data version as data_version, if
+    the caller already has it."""
+
+    filter_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        version = kwargs.pop("data_version", None)
+        super(FilterChoicesForm, self).__init__(*args, **kwargs)
+
+        if version is None:
+            version = get_data_version()
+
+        for field, name in self.filter_fields.items():
+            self.fields[field].choices = get_filter_choices(name, version)
+
+class LayoutPropertyFilterForm(FilterChoicesForm):
     
     filter = forms.ChoiceField(widget=forms.CheckboxSelectMultiple,
-        choices = StyleProperty.get_layout_property_choices(), required = False, 
-        label="Layout Properties")
+        required = False, label="Layout Properties")
+
+    filter_fields = {"filter": "layout_property"}
 
-class ThemePropertyFilterForm(forms.Form):
+# WCAG contrast levels for normal sized text
+MIN_CONTRAST_CHOICES = (
+    ('', 'Any'),
+    ('3', 'At least 3:1'),
+    ('4.5', 'WCAG AA (4.5:1) or better'),
+    ('7', 'WCAG AAA (7:1) or better'),
+)
+
+class ThemePropertyFilterForm(FilterChoicesForm):
 
     layoutfilter = forms.ChoiceField(widget=forms.CheckboxSelectMultiple,
-        choices = StyleProperty.get_layout_property_choices(), required = False, 
-        label="Layout Properties")
+        required = False, label="Layout Properties")
     layoutselect = forms.ChoiceField(widget=forms.CheckboxSelectMultiple,
-        choices = DWLayout.get_layout_choices(), required = False,
-        label="Layouts")
+        required = False, label="Layouts")
     themefilter = forms.ChoiceField(widget=forms.CheckboxSelectMultiple,
-        choices = StyleProperty.get_theme_property_choices(), required = False,
-        label="Theme Properties")
+        required = False, label="Theme Properties")
     colorfilter = forms.ChoiceField(widget=forms.CheckboxSelectMultiple,
-        choices = ColorPropertyGroup.get_colorgroup_choices(), required = False,
-        label="Color Groups")
+        required = False, label="Color Groups")
+    min_contrast = forms.ChoiceField(choices = MIN_CONTRAST_CHOICES, required = False,
+        label="Entry Text Contrast")
+
+    filter_fields = {
+        "layoutfilter": "layout_property",
+        "layoutselect": "layout",
+        "themefilter": "theme_property",
+        "colorfilter": "color_group",
+    }
+
+    def set_facet_counts(self, counts):
+        """Adds how many themes each option would match to its label, given a
+        dictionary of field name to option value to count."""
+        
+        for name, field_counts in counts.items():
+            field = self.fields[name]
+            field.choices = [(value, "%s (%d)" % (label, field_counts.get(value, 0)))
+                for value, label in field.choices]
     
 class ColorForeignKeyRawIdWidget(ForeignKeyRawIdWidget):
 
     # https://github.com/jonasundderwolf/django-image-cropping/pull/3
     def __init__(self, *args, **kwargs):
+        # colors already loaded, by primary key, so rendering doesn't query
+        self.colors = kwargs.pop('colors', {})
         if 'admin_site' in inspect.getargspec(ForeignKeyRawIdWidget.__init__)[0]:  # Django 1.4
             kwargs['admin_site'] = site
         super(ColorForeignKeyRawIdWidget, self).__init__(*args, **kwargs)
@@ -63,16 +134,35 @@ class ColorForeignKeyRawIdWidget(ForeignKeyRawIdWidget):
             output.append(self.label_for_value(value))
         return mark_safe(u''.join(output))
 
-    def color_for_value(self, value):
+    def get_color(self, value):
+        """The color for a value, from the colors given if it's there."""
+
+        try:
+            return self.colors[int(value)]
+        except (KeyError, TypeError, ValueError):
+            pass
+
         key = self.rel.get_related_field().name
+        return self.rel.to._default_manager.using(self.db).get(**{key: value})
+
+    def color_for_value(self, value):
+        if not value:
+            return ""
         try:
-            obj = self.rel.to._default_manager.using(self.db).get(**{key: value})
+            obj = self.get_color(value)
             return '&nbsp;<span style="display: block; width: 2em; height: 2em; border: 1px solid black; background-color: #%s;"></span>' % obj.color_hex
         except ValueError:
             return ""
         except self.rel.to.DoesNotExist:
             return ''
 
+    def label_for_value(self, value):
+        try:
+            obj = self.get_color(value)
+            return '&nbsp;<strong>%s</strong>' % escape(Truncator(obj).words(14, truncate='...'))
+        except (ValueError, self.rel.to.DoesNotExist):
+            return ''
+
 class CopyLayerForm(forms.Form):
     """Shows the paste made, initial entry form."""
     paste = forms.CharField(widget=forms.Textarea, 
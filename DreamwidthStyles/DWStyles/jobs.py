@@ -0,0 +1,172 @@
+"""
+The batch jobs queued by the admin actions.
+
+Each kind of job has a runner, a generator given the job's ids and a dictionary
+of totals to add to, which does the work a batch at a time and yields how many
+rows each batch covered, or 0 before any other long step.  The worker saves the job's progress between batches,
+so the progress page can show how far along it is and how fast it's going, and
+when the runner is done the totals fill in the job's summary.
+
+Jobs are run by the run_batch_jobs command, from cron or left running with
+--forever.  A running job that stops saving progress for longer than
+DWSTYLES_BATCH_JOB_TIMEOUT lost its worker, and is failed the next time the
+command runs.
+"""
+
+import datetime
+import traceback
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from DWStyles.bulk import chunks, query_chunk_size
+from DWStyles.models import (BatchJob, ColorProperty, DWTheme,
+    categorize_color_properties, copy_theme_color_values, rebuild_color_distances,
+    rebuild_rounded_color_counts, recompute_color_metrics, theme_light_on_dark_contrast)
+
+# rows per batch, and so how often the progress is saved
+batch_job_size = query_chunk_size
+
+# seconds a running job can go without saving any progress before it's taken
+# to have lost its worker
+batch_job_timeout = getattr(settings, "DWSTYLES_BATCH_JOB_TIMEOUT", 30 * 60)
+
+def run_categorize_colors(ids, totals):
+
+    for chunk in chunks(ids, batch_job_size):
+        added, removed = categorize_color_properties(
+            ColorProperty.objects.filter(pk__in = chunk))
+        totals["added"] += added
+        totals["removed"] += removed
+        yield len(chunk)
+
+def run_color_metrics(ids, totals):
+
+    for chunk in chunks(ids, batch_job_size):
+        totals["changed"] += recompute_color_metrics(chunk)
+        yield len(chunk)
+
+    # the updates skip the signals, so bring everything kept from the colors back
+    # in line once at the end.  These can take a while, so save the progress
+    # time before each, or the job would look like it lost its worker
+    yield 0
+    totals["copied"] = copy_theme_color_values()
+    if totals["changed"]:
+        yield 0
+        rebuild_rounded_color_counts()
+
+def run_theme_contrast(ids, totals):
+
+    for chunk in chunks(ids, batch_job_size):
+        themes, added, removed = theme_light_on_dark_contrast(
+            DWTheme.objects.filter(pk__in = chunk))
+        totals["added"] += added
+        totals["removed"] += removed
+        yield len(chunk)
+
+def run_color_distances(ids, totals):
+
+    # each color is paired with every round color, so these batches are smaller
+    for chunk in chunks(ids, batch_job_size // 10):
+        totals["distances"] += rebuild_color_distances(chunk)
+        yield len(chunk)
+
+# kind: (description, runner, summary of the totals)
+job_kinds = {
+    "categorize_colors": ("Recategorize colors", run_categorize_colors,
+        "Added %(added)d and removed %(removed)d color group memberships."),
+    "color_metrics": ("Recompute color metrics", run_color_metrics,
+        "Changed %(changed)d colors and %(copied)d theme colors."),
+    "theme_contrast": ("Set light/dark contrast", run_theme_contrast,
+        "Added %(added)d and removed %(removed)d properties."),
+    "color_distances": ("Rebuild color distances", run_color_distances,
+        "Wrote %(distances)d color distances."),
+}
+
+class Totals(dict):
+    """Counts that start at zero."""
+
+    def __missing__(self, key):
+        return 0
+
+def enqueue_job(kind, ids):
+    """Queues a job of the kind over the primary keys given."""
+
+    if kind not in job_kinds:
+        raise ValueError("Unknown batch job: %s" % kind)
+
+    job = BatchJob(kind = kind)
+    job.set_ids(sorted(ids))
+    job.save()
+
+    return job
+
+def claim_job():
+    """Takes the oldest queued job, marking it as running.  Returns None when
+    there's nothing queued.  The status is only changed if it's still queued, so
+    two workers never run the same job."""
+
+    for pk in BatchJob.objects.filter(status = "queued").order_by(
+            'created', 'pk').values_list('pk', flat = True):
+        now = timezone.now()
+        if BatchJob.objects.filter(pk = pk, status = "queued").update(
+                status = "running", started = now, updated = now):
+            return BatchJob.objects.get(pk = pk)
+
+    return None
+
+def fail_stale_jobs():
+    """Fails the running jobs that haven't saved any progress within the timeout,
+    whose worker was killed or restarted partway through, so their progress
+    pages stop waiting on them.  They aren't queued again, since a job that
+    took its worker down would only do it again.  Returns the number failed."""
+
+    now = timezone.now()
+
+    return BatchJob.objects.filter(status = "running",
+        updated__lt = now - datetime.timedelta(seconds = batch_job_timeout)).update(
+        status = "failed", finished = now,
+        message = "The worker stopped before finishing this job.")
+
+def run_job(job):
+    """Runs a claimed job to the end, saving its progress after every batch.
+    Any error fails the job with the traceback as its message, rather than
+    stopping the worker.  Every write is only made while the job is still
+    running, so one failed as stale stays failed, and is given up on."""
+
+    description, runner, summary = job_kinds[job.kind]
+    totals = Totals()
+    running = BatchJob.objects.filter(pk = job.pk, status = "running")
+
+    try:
+        for rows in runner(job.get_ids(), totals):
+            job.done += rows
+            if not running.update(done = job.done, updated = timezone.now()):
+                return BatchJob.objects.get(pk = job.pk)
+
+        job.status, job.message = "done", summary % totals
+    except Exception:
+        job.status, job.message = "failed", traceback.format_exc()
+        # some databases refuse anything else in a transaction that had an error
+        transaction.rollback_unless_managed()
+
+    job.finished = timezone.now()
+    if not running.update(status = job.status, message = job.message,
+            finished = job.finished):
+        return BatchJob.objects.get(pk = job.pk)
+
+    return job
+
+def run_queued_jobs():
+    """Fails any stale jobs, then runs jobs until none are queued.  Returns the
+    jobs run."""
+
+    fail_stale_jobs()
+    jobs = []
+
+    while True:
+        job = claim_job()
+        if job is None:
+            return jobs
+        jobs.append(run_job(job))
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from DWStyles.colorspace import build_distance_matrix, get_distance_matrix
+from DWStyles.models import create_rounded_distances
+
+class Command(BaseCommand):
+    help = ("Computes the CMC distance matrix of the rounded colors and saves it "
+        "for the workers to memory-map.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--export', action='store_true', dest='export', default=False,
+            help='Also fill the ColorDistance table from the matrix.'),
+    )
+
+    def handle(self, *args, **options):
+
+        path = build_distance_matrix()
+        matrix = get_distance_matrix()
+
+        self.stdout.write("Saved %dx%d distance matrix to %s\n" % (matrix.shape + (path,)))
+
+        if options["export"]:
+            created = create_rounded_distances()
+            self.stdout.write("Exported %d color distances.\n" % created)
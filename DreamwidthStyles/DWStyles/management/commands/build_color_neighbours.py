@@ -0,0 +1,44 @@
+import resource
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from DWStyles.colorspace import (build_neighbour_graph, graph_nbytes, grid_values,
+    near_color_distance, neighbour_graph_k, save_neighbour_graph)
+from DWStyles.colorutil import round_color_segment
+
+class Command(BaseCommand):
+    help = ("Builds the k nearest neighbour graph of the rounded colors for one or "
+        "more grid sizes, reporting the time and memory each one took.")
+    args = "[segment ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--k', action='store', type='int', dest='k',
+            default=neighbour_graph_k, help='Neighbours to keep for each color.'),
+        make_option('--max-distance', action='store', type='float', dest='max_distance',
+            default=near_color_distance, help='Only keep neighbours closer than this.'),
+        make_option('--processes', action='store', type='int', dest='processes',
+            default=None, help='Worker processes to use; defaults to one per CPU.'),
+    )
+
+    def handle(self, *segments, **options):
+
+        segments = [int(segment) for segment in segments] or [round_color_segment]
+
+        for segment in segments:
+            started = time.time()
+            graph = build_neighbour_graph(segment, k = options["k"],
+                max_distance = options["max_distance"], processes = options["processes"])
+            elapsed = time.time() - started
+
+            path = save_neighbour_graph(graph, segment)
+
+            # ru_maxrss is in kilobytes on Linux
+            parent = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+            self.stdout.write("Grid %d: %d colors, %d edges, %.1fs, graph %.1f MB, "
+                "peak memory %.1f MB (largest worker %.1f MB), saved to %s\n" % (
+                segment, len(grid_values(segment)) ** 3, len(graph["indices"]), elapsed,
+                graph_nbytes(graph) / 1048576.0, parent / 1024.0, worker / 1024.0, path))
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from DWStyles.models import categorize_color_properties, categorize_dirty_color_properties
+
+class Command(BaseCommand):
+    help = "Automatically sorts the colors in themes into their color groups."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dirty', action='store_true', dest='dirty', default=False,
+            help='Only recategorize colors that changed since they were last categorized.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if options["dirty"]:
+            colors, added, removed = categorize_dirty_color_properties()
+            self.stdout.write("Recategorized %d changed colors.\n" % colors)
+        else:
+            added, removed = categorize_color_properties()
+
+        self.stdout.write("Added %d and removed %d color group memberships.\n" % (
+            added, removed))
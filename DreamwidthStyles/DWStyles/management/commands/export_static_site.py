@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from DWStyles.static_export import export_static_site
+
+class Command(BaseCommand):
+    help = ("Renders every public page, with gzipped copies, into a directory that "
+        "a web server can serve on its own; see DWStyles/static_export.py for the "
+        "nginx setup.  Pages already exported at the current data version are "
+        "skipped, so it's cheap to run after every import.")
+    args = "<directory>"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', action='store', type='int', dest='processes',
+            default=None, help='Worker processes to render with; defaults to one per CPU.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Render every page again, even if the data has not changed.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Give one directory to export to.")
+
+        started = time.time()
+
+        try:
+            counts = export_static_site(args[0], processes = options["processes"],
+                force = options["force"])
+        except (IOError, OSError) as e:
+            raise CommandError("Couldn't write to %s: %s" % (args[0], e))
+
+        elapsed = time.time() - started
+
+        self.stdout.write("Rendered %d pages in %.1fs (%.0f pages/s): %d written, "
+            "%d unchanged; skipped %d at the current data version, removed %d gone "
+            "and %d failed.\n" % (counts["rendered"], elapsed,
+            counts["rendered"] / max(elapsed, 1e-6), counts["written"],
+            counts["rendered"] - counts["written"] - counts["failed"],
+            counts["skipped"], counts["removed"], counts["failed"]))
@@ -0,0 +1,48 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from DWStyles.S2LayerParse import import_layers, layer_sources, parse_layers
+
+class Command(BaseCommand):
+    help = ("Imports the colors of every .s2 theme layer in a directory tree or "
+        "tarball, such as a checkout of the Dreamwidth styles, into the themes whose "
+        "labelid matches the layer's redist_uniq.  Layers unchanged since the last "
+        "import are skipped, so it's cheap to run again.")
+    args = "<directory or tarball>"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', action='store', type='int', dest='processes',
+            default=None, help='Worker processes to parse with; defaults to one per CPU.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=100, help='Layers to write in each batch.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Give one directory or tarball of layers.")
+
+        started = time.time()
+
+        try:
+            sources = layer_sources(args[0])
+        except (IOError, OSError) as e:
+            raise CommandError("Couldn't read %s: %s" % (args[0], e))
+
+        layers = parse_layers(sources, processes = options["processes"])
+        parsed = time.time()
+
+        counts = import_layers(layers, batch_size = options["batch_size"])
+        finished = time.time()
+
+        self.stdout.write("Parsed %d layers in %.1fs (%.0f layers/s).\n" % (
+            len(layers), parsed - started, len(layers) / max(parsed - started, 1e-6)))
+        self.stdout.write("Imported %d layers in %.1fs (%.0f layers/s overall): "
+            "%d changed, touching %d variables, and %d skipped as unchanged; "
+            "skipped %d without a theme and %d with a shared redist_uniq.\n" % (
+            counts["changed"] + counts["skipped"], finished - started,
+            len(layers) / max(finished - started, 1e-6), counts["changed"],
+            counts["changed_variables"], counts["skipped"],
+            counts["unmatched"], counts["duplicate"]))
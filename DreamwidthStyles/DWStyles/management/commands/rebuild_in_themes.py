@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from DWStyles.models import rebuild_rounded_color_counts
+
+class Command(BaseCommand):
+    help = ("Recounts the theme colors of every rounded color in one grouped query, "
+        "then fixes in_themes on the colors that disagree with the counts.")
+
+    def handle(self, *args, **options):
+
+        rounded, changed = rebuild_rounded_color_counts()
+
+        self.stdout.write("Counted %d rounded colors in themes; changed in_themes on %d "
+            "colors.\n" % (rounded, changed))
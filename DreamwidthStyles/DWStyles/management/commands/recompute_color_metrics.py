@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from DWStyles.bulk import chunks
+from DWStyles.models import (ColorProperty, copy_theme_color_values,
+    rebuild_rounded_color_counts, recompute_color_metrics)
+
+class Command(BaseCommand):
+    help = ("Recomputes the RGB, HSV and rounded values of every color property "
+        "in batches, writing back only the rows that changed.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many rows to write per transaction.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Write every row, even ones whose values have not changed.'),
+    )
+
+    def handle(self, *args, **options):
+
+        pks = list(ColorProperty.objects.values_list("pk", flat = True))
+        changed = 0
+
+        for chunk in chunks(pks, options["batch_size"]):
+            changed += recompute_color_metrics(chunk, force = options["force"])
+
+        self.stdout.write("Recomputed %d colors, %d changed.\n" % (len(pks), changed))
+
+        # the theme colors keep copies of some of the values
+        copied = copy_theme_color_values()
+        self.stdout.write("Copied new values to %d theme colors.\n" % copied)
+
+        # the updates skip the signals, and may have moved colors to other rounded hexes
+        if changed:
+            rounded, flipped = rebuild_rounded_color_counts()
+            self.stdout.write("Recounted %d rounded colors in themes; changed in_themes "
+                "on %d colors.\n" % (rounded, flipped))
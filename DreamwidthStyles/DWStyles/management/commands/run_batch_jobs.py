@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from DWStyles.jobs import run_queued_jobs
+
+class Command(BaseCommand):
+    help = "Runs the batch jobs queued from the admin."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--forever', action='store_true', dest='forever', default=False,
+            help='Keep checking for new jobs instead of stopping when none are queued.'),
+        make_option('--sleep', action='store', type='int', dest='sleep', default=5,
+            help='Seconds to wait between checks with --forever.'),
+    )
+
+    def handle(self, *args, **options):
+
+        while True:
+            for job in run_queued_jobs():
+                self.stdout.write("%s: %s in %.1fs, %.0f rows/s. %s\n" % (job,
+                    job.status, job.elapsed(), job.rows_per_second(),
+                    job.message.strip().splitlines()[-1] if job.message else ""))
+
+            if not options["forever"]:
+                break
+
+            # don't hold a connection open while idle
+            connection.close()
+            time.sleep(options["sleep"])
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from DWStyles.models import dirty_theme_light_on_dark_contrast, theme_light_on_dark_contrast
+
+class Command(BaseCommand):
+    help = "Sets the light/dark and high/low contrast properties of themes."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dirty', action='store_true', dest='dirty', default=False,
+            help='Only look at themes whose colors changed since they were last set.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if options["dirty"]:
+            themes, added, removed = dirty_theme_light_on_dark_contrast()
+        else:
+            themes, added, removed = theme_light_on_dark_contrast()
+
+        self.stdout.write("Checked %d themes: added %d and removed %d properties.\n" % (
+            themes, added, removed))
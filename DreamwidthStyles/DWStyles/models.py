@@ -1,7 +1,17 @@
-from django.db import models
-import datetime, re
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.template import Context, loader
+from django.utils import timezone
+import datetime, json, re
+from collections import Counter
 from colormath.color_objects import HSVColor, RGBColor
+
+from DWStyles.bulk import chunks, query_chunk_size, sync_through_table
 from DWStyles.colorutil import *
+from DWStyles.colorspace import get_distance_matrix, grid_hexes, grid_index, near_rounded_colors
 
 class DWLayout(models.Model):
 
@@ -26,11 +36,11 @@ class DWLayout(models.Model):
     def __unicode__(self):
         return u"%s" % self.name
     
-    def save(self):
+    def save(self, *args, **kwargs):
         """This save function exists make add in the date if it's not made."""
        
         # save!
-        super(DWLayout, self).save()
+        super(DWLayout, self).save(*args, **kwargs)
     
     def number_themes(self):
         
@@ -83,113 +93,60 @@ class DWTheme(models.Model):
     properties = models.ManyToManyField('StyleProperty', blank = True, null = True,
         limit_choices_to = {"theme_use": True})
     colors = models.ManyToManyField('ColorProperty', through="DWThemeColor", blank = True, null = True)
+    
+    # set whenever the theme's colors change, so the light/dark and contrast
+    # properties can be recomputed for just these themes
+    needs_contrast = models.BooleanField(default = True, db_index = True)
+    
+    # WCAG contrast ratio between the entry text and background colors
+    contrast_ratio = models.FloatField(null = True, blank = True, db_index = True)
+    
+    # sha1 of the last S2 layer imported into the theme, and a JSON object of
+    # variable to sha1 of the color statements setting it, so re-imports can skip
+    # identical layers and only look at the variables that changed
+    layer_digest = models.CharField(max_length = 40, blank = True, default = "",
+        editable = False)
+    layer_variable_digests = models.TextField(blank = True, default = "", editable = False)
 
     def __unicode__(self):
         return u"Theme: %s (Layout: %s)" % ( self.name, self.layout.name )
         
-    def save(self):
+    def save(self, *args, **kwargs):
         """This save function exists make add in the date if it's not made."""
         
         #if not self.date_added:
         #    self.date_added = datetime.date.today()
         
         # save!
-        super(DWTheme, self).save()
+        super(DWTheme, self).save(*args, **kwargs)
     
     def color_boxes(self):
-        """Returns HTML for color boxes for this theme."""
+        """Returns HTML for color boxes for this theme, from the cache if it's there.
+        Use prefetch_colorbars to get the boxes of a whole list of themes at once."""
         
-        main_colors = self.get_feature_colors()
-        accent_colors = self.get_accent_colors()
-        main_width = 2
-        accent_width = 1
+        if not hasattr(self, "_colorbar"):
+            prefetch_colorbars([self])
         
-        if len(main_colors) == 0 and len(accent_colors) == 0:
-            return ""
-        
-        c = {"feature_colors": main_colors, "accent_colors": accent_colors, "feature_width": 2, 
-            "accent_width": 1, "border_color": "black"}
-        c["colorbar_width"] = len(main_colors) * 2 + len(accent_colors)
-        
-        from django.template import Context, Template, loader
-        t = loader.get_template("colorbar.html")
-        return t.render(Context(c))
+        return self._colorbar
     color_boxes.allow_tags = True
     color_boxes.short_description = "Colors"
     
     def get_accent_colors(self):
-        return self.dwthemecolor_set.select_related().filter(category="accent").order_by('color__H', 'color__S', 'color__V')
+        return self.dwthemecolor_set.select_related().filter(category="accent").order_by('H', 'S', 'V')
         
     def get_feature_colors(self):
-        return self.dwthemecolor_set.select_related().filter(category="feature").order_by('color__H', 'color__S', 'color__V')
+        return self.dwthemecolor_set.select_related().filter(category="feature").order_by('H', 'S', 'V')
     
     def get_colors(self):
         return self.dwthemecolor_set.select_related()
     
     def get_entry_colors(self):
         
-        page_entry = dict()
-        
-        for color in self.get_colors():
-            if not color.variables:
-                continue
-        
-            if re.search("color_entry_background([^_a-z]|$)", color.variables):
-                page_entry["color_entry_background"] = color
-            if re.search("color_page_text([^_a-z]|$)", color.variables):
-                page_entry["color_page_text"] = color
-            if re.search("color_entry_text([^_a-z]|$)", color.variables):
-                page_entry["color_entry_text"] = color
-            if re.search("color_page_background([^_a-z]|$)", color.variables):
-                page_entry["color_page_background"] = color
-        
-        fg_bg = {"foreground": None, "background": None }
-        
-        if "color_entry_text" in page_entry:
-            fg_bg["foreground"] = page_entry["color_entry_text"]
-        elif "color_page_text" in page_entry:
-            fg_bg["foreground"] = page_entry["color_page_text"]
-        
-        if "color_entry_background" in page_entry:
-            fg_bg["background"] = page_entry["color_entry_background"]
-        elif "color_page_background" in page_entry:
-            fg_bg["background"] = page_entry["color_page_background"]
-        
-        return fg_bg
+        return pick_entry_colors((color.variables, color) for color in self.get_colors())
     
     def set_light_dark_contrast(self):
         
-        fb = self.get_entry_colors()
-        
-        if not fb["foreground"] or not fb["background"]:
-            return
-        
-        dol = StyleProperty.objects.get(codename="dark-on-light")
-        lod = StyleProperty.objects.get(codename="light-on-dark")
-        
-        if fb["foreground"].color.V < fb["background"].color.V:
-            self.properties.add(dol)
-            self.properties.remove(lod)
-        else:            
-            self.properties.add(lod)
-            self.properties.remove(dol)
-        
-        # define high and low contrast
-        cr = contrast_ratio(fb["foreground"].color, fb["background"].color)
-        
-        hc = StyleProperty.objects.get(codename="high-contrast")
-        lc = StyleProperty.objects.get(codename="low-contrast")
-        
-        if cr >= 7:
-            self.properties.add(hc)
-            self.properties.remove(lc)
-        elif cr <= 5:
-            self.properties.add(lc)
-            self.properties.remove(hc)
-        else:
-            self.properties.remove(lc)
-            self.properties.remove(hc)
-        
+        theme_light_on_dark_contrast([self])
         
     @models.permalink
     def get_absolute_url(self):
@@ -200,11 +157,265 @@ class DWTheme(models.Model):
         verbose_name_plural = "DW themes"
         ordering = ["layout", "name"]
 
-def theme_light_on_dark_contrast():
-    """Automatically sets light on dark or dark on light properties."""
+# the variables that hold a theme's text and background colors
+entry_color_variables = re.compile(
+    r"(color_entry_background|color_page_text|color_entry_text|color_page_background)([^_a-z]|$)")
+
+contrast_property_codenames = ("dark-on-light", "light-on-dark", "high-contrast", "low-contrast")
+
+_colorbar_template = None
+
+# rendered colorbars are dropped whenever their theme's colors change, so they
+# can be kept a long time
+colorbar_cache_timeout = getattr(settings, "DWSTYLES_COLORBAR_CACHE_TIMEOUT", 60 * 60 * 24)
+
+def render_colorbar(main_colors, accent_colors):
+    """Returns HTML for color boxes of the given feature and accent theme colors."""
+    
+    global _colorbar_template
+    
+    if len(main_colors) == 0 and len(accent_colors) == 0:
+        return ""
+    
+    c = {"feature_colors": main_colors, "accent_colors": accent_colors, "feature_width": 2, 
+        "accent_width": 1, "border_color": "black"}
+    c["colorbar_width"] = len(main_colors) * 2 + len(accent_colors)
+    
+    # only load the template once per process
+    if _colorbar_template is None:
+        _colorbar_template = loader.get_template("colorbar.html")
+    
+    return _colorbar_template.render(Context(c))
+
+def prefetch_palettes(themes):
+    """Loads the feature and accent colors of all of the themes in one query, as the
+    _palette of each, in the order get_feature_colors and get_accent_colors use."""
+    
+    palettes = dict((theme.pk, ([], [])) for theme in themes)
+    
+    for chunk in chunks(palettes.keys()):
+        for theme_color in DWThemeColor.objects.filter(theme__in = chunk).select_related(
+                'color').order_by('theme', 'H', 'S', 'V'):
+            feature, accent = palettes[theme_color.theme_id]
+            if theme_color.category == "feature":
+                feature.append(theme_color)
+            elif theme_color.category == "accent":
+                accent.append(theme_color)
+    
+    for theme in themes:
+        theme._palette = palettes[theme.pk]
+    
+    return themes
+
+def colorbar_cache_key(theme_pk):
+    
+    return "dwstyles:colorbar:%d" % theme_pk
+
+def prefetch_colorbars(themes):
+    """Sets the _colorbar HTML that color_boxes returns on all of the themes, reading
+    it from the cache in one go and rendering the rest from one palette query."""
+    
+    themes = [theme for theme in themes if theme is not None]
+    
+    keys = dict((theme.pk, colorbar_cache_key(theme.pk)) for theme in themes)
+    
+    cached = cache.get_many(keys.values())
+    missing = dict((theme.pk, theme) for theme in themes
+        if keys[theme.pk] not in cached)
+    
+    prefetch_palettes(missing.values())
+    rendered = dict((keys[pk], render_colorbar(*theme._palette))
+        for pk, theme in missing.items())
+    cache.set_many(rendered, colorbar_cache_timeout)
+    cached.update(rendered)
+    
+    for theme in themes:
+        theme._colorbar = cached[keys[theme.pk]]
+    
+    return themes
+
+def clear_colorbars(theme_pks):
+    """Drops the cached colorbars of the themes, after their colors changed."""
+    
+    cache.delete_many([colorbar_cache_key(pk) for pk in theme_pks])
+
+def pick_entry_colors(theme_colors):
+    """Picks the entry text and background colors out of (variables, color) pairs,
+    preferring the entry colors over the page ones."""
+    
+    page_entry = dict()
+    
+    for variables, color in theme_colors:
+        if not variables:
+            continue
+        
+        for match in entry_color_variables.finditer(variables):
+            page_entry[match.group(1)] = color
+    
+    return {
+        "foreground": page_entry.get("color_entry_text", page_entry.get("color_page_text")),
+        "background": page_entry.get("color_entry_background", 
+            page_entry.get("color_page_background")),
+    }
+
+def theme_color_rows(theme_pks):
+    """Loads the colors of many themes in one query, as a dictionary of theme pk to a
+    list of (variables, category, color pk, (R, G, B, V)) tuples in display order."""
     
-    for theme in DWTheme.objects.all():
-        theme.set_light_dark_contrast()
+    rows = DWThemeColor.objects.filter(theme__in = theme_pks).order_by(
+        '-category', 'color__color_hex').values_list('theme', 'variables', 'category',
+        'color', 'color__R', 'color__G', 'color__B', 'color__V')
+    
+    theme_colors = {}
+    for row in rows:
+        theme_colors.setdefault(row[0], []).append((row[1], row[2], row[3], row[4:]))
+    
+    return theme_colors
+
+def theme_entry_colors(theme_colors):
+    """Picks the entry text and background colors out of theme_color_rows, as a
+    dictionary of theme pk to {"foreground": (R, G, B, V), "background": (R, G, B, V)}.
+    Themes missing either color are left out."""
+    
+    entry_colors = {}
+    for theme_pk, colors in theme_colors.items():
+        fg_bg = pick_entry_colors((variables, values) 
+            for variables, category, color_pk, values in colors)
+        if fg_bg["foreground"] and fg_bg["background"]:
+            entry_colors[theme_pk] = fg_bg
+    
+    return entry_colors
+
+def theme_color_contrasts(theme_colors):
+    """Builds DWThemeColorContrast rows for the contrast between every feature and
+    every accent color of each theme in theme_color_rows."""
+    
+    contrasts = []
+    
+    for theme_pk, colors in theme_colors.items():
+        features = dict((color_pk, values[:3]) for variables, category, color_pk, values
+            in colors if category == "feature")
+        accents = dict((color_pk, values[:3]) for variables, category, color_pk, values
+            in colors if category == "accent")
+        
+        if not features or not accents:
+            continue
+        
+        feature_luminance = relative_luminance_array(features.values())
+        accent_luminance = relative_luminance_array(accents.values())
+        
+        ratios = ((numpy.maximum.outer(feature_luminance, accent_luminance) + 0.05) 
+            / (numpy.minimum.outer(feature_luminance, accent_luminance) + 0.05))
+        
+        for i, feature_pk in enumerate(features):
+            for j, accent_pk in enumerate(accents):
+                contrasts.append(DWThemeColorContrast(theme_id = theme_pk,
+                    feature_id = feature_pk, accent_id = accent_pk, 
+                    ratio = float(ratios[i, j])))
+    
+    return contrasts
+
+def theme_light_on_dark_contrast(themes = None):
+    """Automatically sets light on dark or dark on light properties, high or low
+    contrast properties, the stored contrast ratio and the feature/accent contrasts.
+    
+    The colors of each chunk of themes are loaded in one query, classified as
+    arrays, and only the property and ratio changes are written.  Returns the
+    number of themes looked at and the number of properties added and removed."""
+    
+    if themes is None:
+        themes = DWTheme.objects.all()
+    
+    if isinstance(themes, models.query.QuerySet):
+        theme_pks = list(themes.values_list('pk', flat = True))
+    else:
+        theme_pks = [theme.pk for theme in themes]
+    
+    properties = dict(StyleProperty.objects.filter(
+        codename__in = contrast_property_codenames).values_list('codename', 'pk'))
+    missing = set(contrast_property_codenames) - set(properties)
+    if missing:
+        raise StyleProperty.DoesNotExist("Missing style properties: %s" % 
+            ", ".join(sorted(missing)))
+    
+    through = DWTheme.properties.through
+    added = removed = ratios_changed = 0
+    
+    for chunk in chunks(theme_pks):
+        theme_colors = theme_color_rows(chunk)
+        entry_colors = theme_entry_colors(theme_colors)
+        pks = numpy.array(sorted(entry_colors), dtype=numpy.int64)
+        ratios = numpy.zeros(0)
+        
+        if len(pks):
+            foreground = numpy.array([entry_colors[pk]["foreground"] for pk in pks])
+            background = numpy.array([entry_colors[pk]["background"] for pk in pks])
+            
+            dark_on_light = foreground[:, 3] < background[:, 3]
+            ratios = contrast_ratio_array(foreground[:, :3], background[:, :3])
+            
+            desired = set()
+            for codename, mask in (("dark-on-light", dark_on_light), 
+                ("light-on-dark", ~dark_on_light), ("high-contrast", ratios >= 7),
+                ("low-contrast", ratios <= 5)):
+                desired.update((int(pk), properties[codename]) for pk in pks[mask])
+            
+            current = set(through.objects.filter(dwtheme__in = list(pks),
+                styleproperty__in = properties.values()).values_list(
+                'dwtheme_id', 'styleproperty_id'))
+            
+            chunk_added, chunk_removed = sync_through_table(through, 'dwtheme_id',
+                'styleproperty_id', desired, current)
+            added += chunk_added
+            removed += chunk_removed
+        
+        new_ratios = dict((pk, None) for pk in chunk)
+        new_ratios.update(zip(pks.tolist(), ratios.tolist()))
+        
+        with transaction.commit_on_success():
+            for pk, ratio in DWTheme.objects.filter(pk__in = chunk).values_list(
+                'pk', 'contrast_ratio'):
+                if ratio != new_ratios[pk]:
+                    DWTheme.objects.filter(pk = pk).update(contrast_ratio = new_ratios[pk])
+                    ratios_changed += 1
+            
+            DWThemeColorContrast.objects.filter(theme__in = chunk).delete()
+            DWThemeColorContrast.objects.bulk_create(theme_color_contrasts(theme_colors),
+                batch_size = query_chunk_size)
+            
+            DWTheme.objects.filter(pk__in = chunk).update(needs_contrast = False)
+    
+    if added or removed or ratios_changed:
+        bump_data_version()
+    
+    return len(theme_pks), added, removed
+
+def dirty_theme_light_on_dark_contrast():
+    """Sets the light/dark and contrast properties of only the themes whose colors
+    changed since they were last set."""
+    
+    return theme_light_on_dark_contrast(DWTheme.objects.filter(needs_contrast = True))
+
+class DWThemeColorContrast(models.Model):
+    """The contrast ratio between one of a theme's feature colors and one of its
+    accent colors, filled in by theme_light_on_dark_contrast."""
+    
+    theme = models.ForeignKey('DWTheme', db_index = True)
+    feature = models.ForeignKey('ColorProperty', db_index = True, 
+        related_name = "feature_contrasts")
+    accent = models.ForeignKey('ColorProperty', db_index = True,
+        related_name = "accent_contrasts")
+    ratio = models.FloatField(db_index = True)
+    
+    def __unicode__(self):
+        return u"%s: #%s on #%s" % (self.theme.name, self.accent.color_hex, 
+            self.feature.color_hex)
+    
+    class Meta:
+        verbose_name = "DW theme color contrast"
+        verbose_name_plural = "DW theme color contrasts"
+        ordering = ["theme", "-ratio"]
+        unique_together = (("theme", "feature", "accent"),)
 
 class StyleProperty(models.Model):
     
@@ -269,6 +480,31 @@ class DWThemeColor(models.Model):
         db_index = True)
     variables = models.TextField(blank = True, null = True)
     
+    # copied from the color, so the color page and colorbars can filter and sort
+    # theme colors from an index without joining to the colors
+    rounded_hex = models.CharField(max_length=6, blank = True, default = "", editable = False)
+    H = models.PositiveSmallIntegerField(default = 0, editable = False)
+    S = models.PositiveSmallIntegerField(default = 0, editable = False)
+    V = models.PositiveSmallIntegerField(default = 0, editable = False)
+    
+    def __init__(self, *args, **kwargs):
+        super(DWThemeColor, self).__init__(*args, **kwargs)
+        
+        # remember the color loaded, to move the rounded color counts if it changes
+        self._saved_color_id = self.color_id
+    
+    def save(self, *args, **kwargs):
+        """Copies the color's values before saving."""
+        
+        self.copy_color_values()
+        
+        super(DWThemeColor, self).save(*args, **kwargs)
+    
+    def copy_color_values(self):
+        
+        for field in theme_color_value_fields:
+            setattr(self, field, getattr(self.color, field))
+    
     def __unicode__(self):
         if self.color.label:
             return u"%s: %s" % (self.theme.name, self.color.label)            
@@ -286,6 +522,80 @@ class DWThemeColor(models.Model):
         ordering = ["theme", "-category", "color"]
         # each theme can only have a color once for each category
         unique_together = (("theme", "color", "category"),)
+        index_together = [
+            ["rounded_hex", "category", "theme"],
+            ["theme", "category", "H", "S", "V"],
+        ]
+
+# the color fields copied onto each theme color
+theme_color_value_fields = ("rounded_hex", "H", "S", "V")
+
+def copy_theme_color_values():
+    """Brings the values copied onto theme colors back in line with their colors,
+    only writing the ones that differ.  Returns the number of theme colors changed."""
+    
+    value_fields = ["color__%s" % field for field in theme_color_value_fields]
+    
+    updates = {}
+    themes = set()
+    for row in DWThemeColor.objects.values_list('pk', 'theme', *(value_fields + 
+            list(theme_color_value_fields))):
+        pk, theme, values, copied = row[0], row[1], row[2:6], row[6:]
+        if values != copied:
+            updates.setdefault(values, []).append(pk)
+            themes.add(theme)
+    
+    changed = 0
+    
+    with transaction.commit_on_success():
+        for values, pks in updates.items():
+            for chunk in chunks(pks):
+                changed += DWThemeColor.objects.filter(pk__in = chunk).update(
+                    **dict(zip(theme_color_value_fields, values)))
+    
+    # the colorbars are sorted and linked by these values
+    clear_colorbars(themes)
+    
+    if changed:
+        bump_data_version()
+    
+    return changed
+
+def recompute_color_metrics(color_pks, force = False):
+    """Recomputes the RGB, HSV and rounded values of the given colors, writing back
+    only the rows that changed, or every row with force, in one transaction.
+    The updates skip the signals, so once every batch is done the copied values
+    and counts need bringing back in line with copy_theme_color_values and
+    rebuild_rounded_color_counts.  Returns the number of colors changed."""
+    
+    fields = ("color_hex",) + COLOR_METRIC_FIELDS
+    # compare the values as they would be stored, since the unscaled rounded
+    # HSV floats end up in integer columns
+    prep = dict((field, ColorProperty._meta.get_field(field).get_prep_value)
+        for field in fields)
+    
+    rows = []
+    for chunk in chunks(color_pks):
+        rows.extend(ColorProperty.objects.filter(pk__in = chunk).values_list("pk", *fields))
+    hexes = [row[1].lower() for row in rows]
+    
+    changed = []
+    
+    for row, hex_value, metrics in zip(rows, hexes, iter_color_metrics(hexes)):
+        metrics["color_hex"] = hex_value
+        current = dict(zip(fields, row[1:]))
+        stored = dict((field, prep[field](value)) for field, value in metrics.items())
+        if force or current != stored:
+            changed.append((row[0], metrics))
+    
+    with transaction.commit_on_success():
+        for pk, metrics in changed:
+            ColorProperty.objects.filter(pk = pk).update(**metrics)
+    
+    if changed:
+        bump_data_version()
+    
+    return len(changed)
 
 class ColorPropertyGroup(models.Model):
     
@@ -370,6 +680,20 @@ class ColorProperty(models.Model):
     rS = models.PositiveSmallIntegerField(db_index = True, default = 0)
     rV = models.PositiveSmallIntegerField(db_index = True, default = 0)
     
+    # dirty tracking for categorize_color_properties: set when the hex or in_themes
+    # changes, and compared against ColorCategorizer.version for rule changes
+    needs_categorize = models.BooleanField(default = True, db_index = True)
+    categorized_version = models.PositiveSmallIntegerField(null = True, blank = True,
+        db_index = True)
+    
+    def __init__(self, *args, **kwargs):
+        super(ColorProperty, self).__init__(*args, **kwargs)
+        
+        # remember what was loaded, to tell what a save changes
+        self._saved_color_hex = self.color_hex
+        self._saved_rounded_hex = self.rounded_hex
+        self._saved_in_themes = self.in_themes
+    
     def __unicode__(self):
         if self.label:
             return u"#%s (%s)" % (self.color_hex, self.label)
@@ -391,18 +715,46 @@ class ColorProperty(models.Model):
         
         return color_distance(self, color)
         
-    def save(self):
+    def save(self, *args, **kwargs):
         """This save function exists to update all of the many different automatically
-        calculated values of a given color."""
+        calculated values of a given color, which only happens when the hex changed.
+        in_themes comes from the counts of theme colors per rounded color, which the
+        theme color signals keep up to date."""
         
-        self.refresh_values()
+        hex_changed = self.color_hex != self._saved_color_hex
         
-        if self.themes_in().count() > 0:
-            self.in_themes = True
-        else:
-            self.in_themes = False
+        if not self.pk or hex_changed:
+            self.refresh_values()
+            
+            # this color's own theme colors move to the new rounded color with it
+            if self.pk:
+                moved = DWThemeColor.objects.filter(color = self).count()
+            else:
+                moved = 0
+            
+            self.in_themes = moved > 0 or RoundedColorCount.objects.filter(
+                rounded_hex = self.rounded_hex, theme_colors__gt = 0).exists()
+            self.needs_categorize = True
+        
+        if self.in_themes != self._saved_in_themes:
+            self.needs_categorize = True
+        
+        super(ColorProperty, self).save(*args, **kwargs)
+        
+        if hex_changed:
+            DWTheme.objects.filter(dwthemecolor__color = self).update(needs_contrast = True)
+            clear_colorbars(DWThemeColor.objects.filter(color = self).values_list(
+                'theme', flat = True))
+            DWThemeColor.objects.filter(color = self).update(**dict((field,
+                getattr(self, field)) for field in theme_color_value_fields))
+            
+            if moved and self._saved_rounded_hex != self.rounded_hex:
+                adjust_rounded_color_counts({self._saved_rounded_hex: -moved,
+                    self.rounded_hex: moved})
         
-        super(ColorProperty, self).save()
+        self._saved_color_hex = self.color_hex
+        self._saved_rounded_hex = self.rounded_hex
+        self._saved_in_themes = self.in_themes
     
     def refresh_values(self):
         
@@ -443,6 +795,18 @@ class ColorProperty(models.Model):
         else:
             self.is_round = False
             
+    @classmethod
+    def transient(cls, color_hex):
+        """An unsaved color with all of its values worked out, for showing a hex
+        that isn't in the database without adding it.  Colors are only stored
+        once they're in a theme."""
+        
+        color = cls(color_hex = color_hex)
+        for field, value in cached_color_metrics(color_hex).items():
+            setattr(color, field, value)
+        
+        return color
+    
     def contrast_text(self):
         """Returns hex code of a color that contrasts with this one, for 
         overlaying text. Includes the #."""
@@ -474,7 +838,7 @@ class ColorProperty(models.Model):
         """Gets all the "rounded" colors with nearby colors in themes."""
         
         return ColorProperty.objects.filter(in_themes = True, is_round = True).order_by(
-            'H', 'S', 'V')
+            'H', 'S', 'V', 'pk')
     
     def get_rounded_color(self):
         """Returns a pointer to the rounded color."""
@@ -492,42 +856,27 @@ class ColorProperty(models.Model):
     def near_colors(self): 
         """This gets all of the colors that are *near* to this one."""
         
-        # work off of the rounded color
-        if self.is_round:
-            rounded = self
-        else:
-            rounded = self.get_rounded_color()
-        
-        if not rounded:
+        # work off of the rounded color, reading its row of the distance matrix
+        if not self.rounded_hex:
             return []
         
-        near = ColorDistance.objects.filter(
-            # color_a or color_b should be equal to rounded
-            models.Q(color_a = rounded) | models.Q(color_b = rounded)
-            # order by the distance, only include things with a distance less than 10
-            ).order_by('distance').filter(distance__lt = 10).filter(
-            # filter by colors in themes only
-            color_a__in_themes = True, color_b__in_themes = True)
+        near = near_rounded_colors(self.rounded_hex)
         
-        near_colors = []
+        # filter by colors in themes only
+        colors = ColorProperty.objects.filter(in_themes = True,
+            color_hex__in = [color_hex for color_hex, distance in near])
+        colors = dict((color.color_hex, color) for color in colors)
         
-        # get the colors that are near the rounded color
-        for color in near:
-            if color.color_a == rounded:
-                near_colors.append(color.color_b)
-            else:
-                near_colors.append(color.color_a)
-        
-        return near_colors
+        return [colors[color_hex] for color_hex, distance in near if color_hex in colors]
         
     def themes_in(self, category = None):
         """This gets all of the themes in the rounded version of the color, 
         with optional category."""
         
         if category:
-            return DWThemeColor.objects.filter(color__rounded_hex = self.rounded_hex, category = category)
+            return DWThemeColor.objects.filter(rounded_hex = self.rounded_hex, category = category)
         else:
-            return DWThemeColor.objects.filter(color__rounded_hex = self.rounded_hex )
+            return DWThemeColor.objects.filter(rounded_hex = self.rounded_hex )
     
     def feature_in_themes(self):
         return self.themes_in(category="feature").select_related()
@@ -546,46 +895,187 @@ class ColorProperty(models.Model):
     class Meta:
         ordering = ["color_hex"]
         verbose_name_plural = "color properties"
+        # the color list seeks through this one page after another
+        index_together = [["in_themes", "is_round", "H", "S", "V"]]
 
-def categorize_color_properties():
-    """Automatically categorize color properties."""
+def categorize_color_properties(colors = None):
+    """Automatically categorize color properties.
+    
+    Every group rule is checked against the H, S and V values of all of the colors
+    at once, and only the group memberships that changed are written.  The colors
+    are then marked as categorized, so the next dirty run skips them.  Returns the
+    number of memberships added and removed."""
     
     ccat = ColorCategorizer()
-    colors = ColorProperty.objects.filter(in_themes = True)
-    categories = ColorPropertyGroup.objects.all()
+    
+    if colors is None:
+        colors = ColorProperty.objects.filter(in_themes = True)
+    
     categorizer = {}
     
-    for category in categories:
+    for category in ColorPropertyGroup.objects.all():
         
         # try to get function from the color categorizer by codename
         try:
-            categorizer[category.codename] = getattr(ccat, "is_%s" % category.codename)
+            categorizer[category.pk] = getattr(ccat, "is_%s" % category.codename)
         # no automatic categorizer for this function
         except AttributeError:
             continue
     
-    for color in colors:
-        color_groups = color.groups.all()
-        change = False
-        for category in categories:
-            if category.codename in categorizer:
-                in_category = categorizer[category.codename](color)
-                if in_category and category not in color_groups:
-                    # add if we get a true!
-                    print "Adding %s to %s" % (category, color)
-                    color.groups.add(category)
-                    change = True
-                elif not in_category and category in color_groups:
-                    # remove if it doesn't match the criteria
-                    print "REMOVING %s from %s" % (category, color)
-                    color.groups.remove(category)
-                    change = True
-        
-        if change:
-            color.save()
+    rows = list(colors.values_list('pk', 'H', 'S', 'V'))
+    
+    if not rows:
+        return (0, 0)
+    
+    if not categorizer:
+        mark_categorized([row[0] for row in rows])
+        return (0, 0)
+    
+    pks, H, S, V = [numpy.array(column) for column in zip(*rows)]
+    values = ColorValues(H, S, V)
+    
+    desired = set()
+    for category_pk, in_category in categorizer.items():
+        desired.update((int(pk), category_pk) for pk in pks[in_category(values)])
+    
+    through = ColorProperty.groups.through
+    current = set(through.objects.filter(colorproperty__in = colors,
+        colorpropertygroup__in = categorizer.keys()).values_list(
+        'colorproperty_id', 'colorpropertygroup_id'))
+    
+    added, removed = sync_through_table(through, 'colorproperty_id',
+        'colorpropertygroup_id', desired, current)
+    
+    mark_categorized(pks.tolist())
+    
+    if added or removed:
+        bump_data_version()
+    
+    return added, removed
+
+def mark_categorized(pks):
+    """Marks the colors as categorized with the current rules."""
+    
+    for chunk in chunks(pks):
+        ColorProperty.objects.filter(pk__in = chunk).update(needs_categorize = False,
+            categorized_version = ColorCategorizer.version)
+
+def dirty_color_properties():
+    """Colors that changed, or were categorized with older rules, since they were
+    last categorized."""
+    
+    return ColorProperty.objects.filter(models.Q(needs_categorize = True) 
+        | models.Q(categorized_version__isnull = True)
+        | ~models.Q(categorized_version = ColorCategorizer.version))
+
+def categorize_dirty_color_properties():
+    """Recategorizes only the dirty colors.  Returns the number of colors looked at
+    and the number of memberships added and removed."""
+    
+    pks = list(dirty_color_properties().values_list('pk', flat = True))
+    added = removed = 0
+    
+    for chunk in chunks(pks):
+        chunk_added, chunk_removed = categorize_color_properties(
+            ColorProperty.objects.filter(pk__in = chunk, in_themes = True))
+        added += chunk_added
+        removed += chunk_removed
+        
+        # the colors not in themes aren't categorized, but aren't dirty either
+        mark_categorized(chunk)
+    
+    return len(pks), added, removed
+
+class RoundedColorCount(models.Model):
+    """How many theme colors have a color with this rounded hex.  The colors
+    sharing a rounded hex are in themes whenever this is above zero."""
+    
+    rounded_hex = models.CharField(max_length=6, unique = True)
+    theme_colors = models.PositiveIntegerField(default = 0)
+    
+    def __unicode__(self):
+        return u"#%s: %d theme colors" % (self.rounded_hex, self.theme_colors)
+
+def adjust_rounded_color_counts(deltas):
+    """Adds the deltas, a dictionary of rounded hex to change in theme colors, to
+    the counts, then flips in_themes on the colors of any rounded hex that went
+    to or from zero.  Returns the number of colors flipped."""
+    
+    by_delta = {}
+    for rounded_hex, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(rounded_hex)
+    
+    if not by_delta:
+        return 0
+    
+    rounded_hexes = [rounded_hex for hexes in by_delta.values() for rounded_hex in hexes]
+    
+    with transaction.commit_on_success():
+        existing = set()
+        for chunk in chunks(rounded_hexes):
+            existing.update(RoundedColorCount.objects.filter(
+                rounded_hex__in = chunk).values_list('rounded_hex', flat = True))
+        
+        RoundedColorCount.objects.bulk_create([RoundedColorCount(rounded_hex = rounded_hex)
+            for rounded_hex in rounded_hexes if rounded_hex not in existing],
+            batch_size = query_chunk_size)
+        
+        for delta, hexes in by_delta.items():
+            for chunk in chunks(hexes):
+                RoundedColorCount.objects.filter(rounded_hex__in = chunk).update(
+                    theme_colors = models.F('theme_colors') + delta)
+        
+        return set_in_themes(rounded_hexes)
+
+def set_in_themes(rounded_hexes):
+    """Brings in_themes on the colors with these rounded hexes in line with their
+    counts, only writing the colors that change.  Returns how many did."""
+    
+    used = set()
+    for chunk in chunks(rounded_hexes):
+        used.update(RoundedColorCount.objects.filter(rounded_hex__in = chunk,
+            theme_colors__gt = 0).values_list('rounded_hex', flat = True))
+    
+    changed = 0
+    
+    with transaction.commit_on_success():
+        for in_themes, hexes in ((True, used), (False, set(rounded_hexes) - used)):
+            for chunk in chunks(hexes):
+                changed += ColorProperty.objects.filter(rounded_hex__in = chunk,
+                    in_themes = not in_themes).update(in_themes = in_themes,
+                    needs_categorize = True)
+    
+    if changed:
+        bump_data_version()
+    
+    return changed
+
+def rebuild_rounded_color_counts():
+    """Recounts the theme colors of every rounded hex in one grouped query and
+    fixes in_themes on any color that disagrees.  Returns the number of rounded
+    hexes in themes and the number of colors changed."""
+    
+    counts = dict(DWThemeColor.objects.order_by().values_list(
+        'color__rounded_hex').annotate(models.Count('pk')))
+    
+    with transaction.commit_on_success():
+        RoundedColorCount.objects.all().delete()
+        RoundedColorCount.objects.bulk_create([RoundedColorCount(rounded_hex = rounded_hex,
+            theme_colors = count) for rounded_hex, count in sorted(counts.items())],
+            batch_size = query_chunk_size)
+    
+    # every rounded hex that is counted, or that has colors marked as in themes
+    rounded_hexes = set(counts) | set(ColorProperty.objects.filter(
+        in_themes = True).values_list('rounded_hex', flat = True).distinct())
+    
+    return len(counts), set_in_themes(rounded_hexes)
 
 class ColorDistance(models.Model):
-    """Represents the distance between two colors. Start with (5*5)^2."""
+    """Represents the distance between two colors. Start with (5*5)^2.
+    
+    Near colors are read from the precomputed matrix in DWStyles.colorspace;
+    this table is only filled in as an optional export of it."""
     
     # color a will always be "alphabetically" before color_b
     color_a = models.ForeignKey('ColorProperty', db_index = True, related_name="color_a")
@@ -600,27 +1090,23 @@ class ColorDistance(models.Model):
     small_color_box.allow_tags = True
     small_color_box.short_description = "Color"
     
-    def save(self):
+    def save(self, *args, **kwargs):
         """This save function exists to update all of the many different automatically
         calculated values of a given color."""
         
         self.distance = color_distance(self.color_a, self.color_b)
 
-        super(ColorDistance, self).save()
+        super(ColorDistance, self).save(*args, **kwargs)
     
     class Meta:
         ordering = ["distance"]
         unique_together = (("color_a", "color_b"),)
 
 def generate_rounded_colors():
-    """Hardcoded to generate rounded colors, with a distance of 32RGB in between."""
+    """Generates the rounded colors, with a distance of round_color_segment RGB in between."""
     
-    values = ["00", "20", "40", "60", "80", "a0", "c0", "e0", "ff"]
-    
-    for r_val in values:
-        for g_val in values:
-            for b_val in values:
-                yield "%s%s%s" % (r_val, g_val, b_val)
+    for color in grid_hexes():
+        yield color
 
 def create_rounded_colors():
     
@@ -628,23 +1114,72 @@ def create_rounded_colors():
         cp, created = ColorProperty.objects.get_or_create(color_hex = color)
         cp.save()
 
-def create_rounded_distances():
-    """Generate the distances for all round colors we have."""
-    round_colors = ColorProperty.objects.filter(is_round = True)
+def create_rounded_distances(batch_size = 1000):
+    """Export the distances for all round colors we have from the distance matrix."""
+    
+    matrix = get_distance_matrix()
+    round_colors = sorted(ColorProperty.objects.filter(is_round = True).values_list(
+        'color_hex', 'pk'))
+    existing = set(ColorDistance.objects.values_list('color_a', 'color_b'))
     
-    for color_a in round_colors:
-        for color_b in round_colors:
-            # don't calculate the distance for equal colors
-            if color_a.pk == color_b.pk:
+    distances = []
+    
+    # first color is always lexographically before the second
+    for i, (hex_a, pk_a) in enumerate(round_colors):
+        index_a = grid_index(hex_a)
+        for hex_b, pk_b in round_colors[i + 1:]:
+            if (pk_a, pk_b) in existing:
+                continue
+            distances.append(ColorDistance(color_a_id = pk_a, color_b_id = pk_b,
+                distance = float(matrix[index_a, grid_index(hex_b)])))
+    
+    ColorDistance.objects.bulk_create(distances, batch_size = batch_size)
+    
+    return len(distances)
+
+def rebuild_color_distances(color_pks, batch_size = 1000):
+    """Rewrites the distances between each of the given colors and every other
+    round color from the distance matrix.  Colors that aren't round have no
+    distances and are skipped.  Returns the number of distances written."""
+    
+    matrix = get_distance_matrix()
+    indexes = {}
+    round_colors = []
+    for color_hex, pk in sorted(ColorProperty.objects.filter(is_round = True).values_list(
+            'color_hex', 'pk')):
+        indexes[color_hex] = grid_index(color_hex)
+        # colors rounded on an older grid aren't in the matrix
+        if indexes[color_hex] is not None:
+            round_colors.append((color_hex, pk))
+    
+    color_pks = set(color_pks)
+    selected = [(hex_a, pk_a) for hex_a, pk_a in round_colors if pk_a in color_pks]
+    
+    pairs = set()
+    distances = []
+    
+    # first color is always lexographically before the second
+    for hex_a, pk_a in selected:
+        for hex_b, pk_b in round_colors:
+            if pk_b == pk_a:
                 continue
-            # first color is always lexographically before the second
-            if color_a.color_hex > color_b.color_hex:
+            pair = (pk_a, pk_b) if hex_a < hex_b else (pk_b, pk_a)
+            if pair in pairs:
                 continue
-            new_distance, created = ColorDistance.objects.get_or_create(color_a = color_a, color_b = color_b)
-            if created:
-                distance = color_distance(color_a, color_b)
-                new_distance.distance = distance
-                new_distance.save()
+            pairs.add(pair)
+            # the matrix is symmetric, so the order of the lookup doesn't matter
+            distances.append(ColorDistance(color_a_id = pair[0], color_b_id = pair[1],
+                distance = float(matrix[indexes[hex_a], indexes[hex_b]])))
+    
+    selected_pks = [pk for color_hex, pk in selected]
+    
+    with transaction.commit_on_success():
+        for chunk in chunks(selected_pks):
+            ColorDistance.objects.filter(models.Q(color_a__in = chunk) |
+                models.Q(color_b__in = chunk)).delete()
+        ColorDistance.objects.bulk_create(distances, batch_size = batch_size)
+    
+    return len(distances)
 
 def color_distance(color_a, color_b):
     
@@ -655,3 +1190,161 @@ def color_distance(color_a, color_b):
     
     return colora.delta_e(colorb, mode='cmc', pl=1, pc=1)
     
+
+# Dirty tracking
+
+class DataVersion(models.Model):
+    """A counter bumped whenever the data behind the site's pages changes, so that
+    anything built from that data, like the theme facet index, can tell it's
+    stale with one query."""
+    
+    name = models.CharField(max_length = 50, unique = True)
+    version = models.PositiveIntegerField(default = 0)
+    modified = models.DateTimeField(default = timezone.now)
+    
+    def __unicode__(self):
+        return u"%s: %d" % (self.name, self.version)
+
+def get_data_version(name = "styles"):
+    
+    try:
+        return DataVersion.objects.values_list('version', flat = True).get(name = name)
+    except DataVersion.DoesNotExist:
+        return 0
+
+def get_data_version_stamp(name = "styles"):
+    """The data version and when it was last bumped, or None for the time if it
+    never has been."""
+    
+    try:
+        return DataVersion.objects.values_list('version', 'modified').get(name = name)
+    except DataVersion.DoesNotExist:
+        return 0, None
+
+def bump_data_version(name = "styles"):
+    
+    if not DataVersion.objects.filter(name = name).update(
+            version = models.F('version') + 1, modified = timezone.now()):
+        DataVersion(name = name, version = 1).save()
+
+# Batch jobs
+
+class BatchJob(models.Model):
+    """A slow change to many rows, queued from an admin action and done in batches
+    by the run_batch_jobs command, so the admin doesn't wait on it.  What each
+    kind of job does is in DWStyles.jobs."""
+    
+    STATUS_CHOICES = (
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    )
+    
+    kind = models.CharField(max_length = 50)
+    object_ids = models.TextField(help_text = "The primary keys to work on, as JSON.")
+    status = models.CharField(max_length = 10, choices = STATUS_CHOICES,
+        default = "queued", db_index = True)
+    total = models.PositiveIntegerField(default = 0)
+    done = models.PositiveIntegerField(default = 0)
+    created = models.DateTimeField(default = timezone.now)
+    started = models.DateTimeField(null = True, blank = True)
+    updated = models.DateTimeField(null = True, blank = True,
+        help_text = "When the worker last saved its progress.")
+    finished = models.DateTimeField(null = True, blank = True)
+    message = models.TextField(blank = True)
+    
+    def __unicode__(self):
+        return u"%s #%d" % (self.kind, self.pk)
+    
+    def get_ids(self):
+        return json.loads(self.object_ids)
+    
+    def set_ids(self, ids):
+        self.object_ids = json.dumps(list(ids))
+        self.total = len(ids)
+    
+    def elapsed(self):
+        """Seconds spent running so far, or in all if it's finished."""
+        
+        if not self.started:
+            return 0.0
+        
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+    
+    def rows_per_second(self):
+        
+        elapsed = self.elapsed()
+        
+        return self.done / elapsed if elapsed else 0.0
+    
+    def percent(self):
+        
+        return 100 * self.done // self.total if self.total else 100
+    
+    def is_finished(self):
+        return self.status in ("done", "failed")
+    
+    class Meta:
+        ordering = ["-created"]
+
+@receiver(post_save, sender=DWThemeColor)
+@receiver(post_delete, sender=DWThemeColor)
+def theme_colors_changed(sender, instance, **kwargs):
+    """A theme's colors changed, so its contrast properties need to be set again.
+    The layer digests no longer describe the theme either, so the next import of
+    its layer shouldn't be skipped, and its colorbar needs rendering again."""
+    
+    DWTheme.objects.filter(pk = instance.theme_id).update(needs_contrast = True,
+        layer_digest = "", layer_variable_digests = "")
+    clear_colorbars([instance.theme_id])
+
+@receiver(post_save, sender=DWThemeColor)
+def theme_color_saved(sender, instance, created, **kwargs):
+    """Counts a new theme color, or moves it between rounded colors if its color
+    changed."""
+    
+    if created:
+        adjust_rounded_color_counts({instance.color.rounded_hex: 1})
+    elif instance.color_id != instance._saved_color_id:
+        deltas = Counter({instance.color.rounded_hex: 1})
+        deltas.subtract(ColorProperty.objects.filter(
+            pk = instance._saved_color_id).values_list('rounded_hex', flat = True))
+        adjust_rounded_color_counts(deltas)
+    
+    instance._saved_color_id = instance.color_id
+
+@receiver(post_delete, sender=DWThemeColor)
+def theme_color_deleted(sender, instance, **kwargs):
+    """Stops counting a deleted theme color, by the rounded hex copied onto it."""
+    
+    if instance.rounded_hex:
+        adjust_rounded_color_counts({instance.rounded_hex: -1})
+
+@receiver(post_save, sender=ColorPropertyGroup)
+@receiver(post_delete, sender=ColorPropertyGroup)
+def color_groups_changed(sender, instance, **kwargs):
+    """Groups decide which categorizer rules apply, so every color needs another look."""
+    
+    ColorProperty.objects.update(needs_categorize = True)
+
+@receiver(post_save, sender=DWTheme)
+@receiver(post_delete, sender=DWTheme)
+@receiver(post_save, sender=DWLayout)
+@receiver(post_delete, sender=DWLayout)
+@receiver(post_save, sender=DWThemeColor)
+@receiver(post_delete, sender=DWThemeColor)
+@receiver(post_save, sender=StyleProperty)
+@receiver(post_delete, sender=StyleProperty)
+@receiver(post_save, sender=ColorProperty)
+@receiver(post_delete, sender=ColorProperty)
+@receiver(post_save, sender=ColorPropertyGroup)
+@receiver(post_delete, sender=ColorPropertyGroup)
+@receiver(m2m_changed, sender=DWTheme.properties.through)
+@receiver(m2m_changed, sender=DWLayout.properties.through)
+@receiver(m2m_changed, sender=ColorProperty.groups.through)
+def styles_changed(sender, **kwargs):
+    """Anything the pages are built from changed."""
+    
+    if kwargs.get("action", "post_").startswith("post_"):
+        bump_data_version()
@@ -0,0 +1,238 @@
+"""
+Keyset pagination: instead of counting rows and skipping an offset, each page
+seeks past the sort keys of the last row of the page before, so deep pages cost
+the same as the first and no page needs a COUNT.  The pages link to each other
+with opaque tokens holding those keys.
+"""
+
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404
+
+from DWStyles.models import get_data_version
+
+# how long a cached count lives; the data version in the key drops it sooner
+# whenever anything changes
+count_cache_timeout = 60 * 60
+
+class InvalidToken(ValueError):
+    pass
+
+def encode_token(values, backwards = False):
+    """Packs the sort keys of a row and the direction to seek from it."""
+
+    token = json.dumps({"k": list(values), "b": int(backwards)}, separators = (",", ":"))
+
+    return base64.urlsafe_b64encode(token).rstrip("=")
+
+def decode_token(token, length):
+    """Unpacks a token, checking it holds the given number of sort keys.  Raises
+    InvalidToken if it doesn't."""
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(token) + "=" * (-len(token) % 4)))
+        values, backwards = data["k"], bool(data["b"])
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        raise InvalidToken("Bad page token.")
+
+    if not isinstance(values, list) or len(values) != length or not all(
+            isinstance(value, (int, long, float)) for value in values):
+        raise InvalidToken("Bad page token.")
+
+    return tuple(values), backwards
+
+class QuerySetKeyset(object):
+    """Seeks through a queryset ordered by the given fields, each one optionally
+    prefixed with "-" for descending.  The fields must never be null, and must
+    end with one that's unique, like "pk"."""
+
+    def __init__(self, queryset, keys):
+
+        self.queryset = queryset
+        self.keys = keys
+
+    def fields(self):
+
+        return [(key.lstrip("-"), key.startswith("-")) for key in self.keys]
+
+    def key(self, obj):
+
+        return tuple(getattr(obj, field) for field, descending in self.fields())
+
+    def seek(self, values, backwards, limit):
+        """The limit rows right after the values in the ordering, or right before
+        them when going backwards, in the ordering either way."""
+
+        queryset = self.queryset
+        fields = self.fields()
+
+        if values is not None:
+            # (a, b) after (x, y) is a > x, or a = x and b > y
+            after = None
+            for i, (field, descending) in enumerate(fields):
+                lookup = "lt" if descending != backwards else "gt"
+                q = Q(**dict([(f, v) for (f, d), v in zip(fields[:i], values[:i])] +
+                    [("%s__%s" % (field, lookup), values[i])]))
+                after = q if after is None else after | q
+            queryset = queryset.filter(after)
+
+        ordering = [("-" if descending != backwards else "") + field
+            for field, descending in fields]
+        rows = list(queryset.order_by(*ordering)[:limit])
+
+        if backwards:
+            rows.reverse()
+
+        return rows
+
+class KeysetPage(object):
+    """One page of a keyset paginator, answering enough of what Django's Page
+    does for the list views."""
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+        source = paginator.source
+        self.next_token = encode_token(source.key(object_list[-1])) if has_next else None
+        self.previous_token = encode_token(source.key(object_list[0]),
+            backwards = True) if has_previous else None
+
+    def __len__(self):
+
+        return len(self.object_list)
+
+    def __iter__(self):
+
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+
+        return self.object_list[index]
+
+    def has_next(self):
+
+        return self._has_next
+
+    def has_previous(self):
+
+        return self._has_previous
+
+    def has_other_pages(self):
+
+        return self._has_next or self._has_previous
+
+class KeysetPaginator(object):
+    """Pages through a source, either a QuerySetKeyset or anything else with the
+    same key and seek methods.  The count is only worked out if it's asked for,
+    by calling the count function given, if any."""
+
+    def __init__(self, source, per_page, count = None):
+
+        self.source = source
+        self.per_page = per_page
+        self._count = count
+
+    @property
+    def count(self):
+
+        if self._count is None:
+            return None
+
+        if callable(self._count):
+            self._count = self._count()
+
+        return self._count
+
+    def page(self, token = None):
+        """The page a token points to, or the first page without one.  Raises
+        InvalidToken for a token that doesn't hold this source's keys."""
+
+        if token:
+            values, backwards = decode_token(token, len(self.source.keys))
+        else:
+            values, backwards = None, False
+
+        # one more than a page tells whether there's another page after it
+        objects = self.source.seek(values, backwards, self.per_page + 1)
+        more = len(objects) > self.per_page
+
+        if backwards:
+            objects = objects[-self.per_page:]
+            has_next, has_previous = True, more
+        else:
+            objects = objects[:self.per_page]
+            has_next, has_previous = more, values is not None
+
+        if not objects:
+            has_next = has_previous = False
+
+        return KeysetPage(objects, self, has_next, has_previous)
+
+def cached_count(queryset):
+    """The queryset's count, kept in the cache until the data changes, so crawlers
+    walking every page only count once.  It can be a little behind a change
+    that's still being written."""
+
+    sql, params = queryset.query.sql_with_params()
+    key = "dwstyles:count:%d:%s" % (get_data_version(),
+        hashlib.md5(repr((sql, params))).hexdigest())
+
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, count_cache_timeout)
+
+    return count
+
+class KeysetPaginationMixin(object):
+    """Makes a list view page with cursor tokens, seeking on keyset_keys, unless
+    it's asked for a page number.  The templates get next_query and
+    previous_query, the query strings of the pages either side."""
+
+    keyset_keys = ("pk",)
+
+    def get_keyset_source(self, queryset):
+
+        return QuerySetKeyset(queryset, self.keyset_keys)
+
+    def get_keyset_count(self, queryset):
+
+        return lambda: cached_count(queryset)
+
+    def paginate_queryset(self, queryset, page_size):
+
+        if "page" in self.request.GET or "page" in self.kwargs:
+            return super(KeysetPaginationMixin, self).paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(self.get_keyset_source(queryset), page_size,
+            count = self.get_keyset_count(queryset))
+
+        try:
+            page = paginator.page(self.request.GET.get("cursor"))
+        except InvalidToken:
+            raise Http404("Invalid page token.")
+
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super(KeysetPaginationMixin, self).get_context_data(**kwargs)
+
+        page = context.get("page_obj")
+
+        if isinstance(page, KeysetPage):
+            for name, token in (("next_query", page.next_token),
+                ("previous_query", page.previous_token)):
+                if token:
+                    query = self.request.GET.copy()
+                    query["cursor"] = token
+                    context[name] = query.urlencode()
+
+        return context
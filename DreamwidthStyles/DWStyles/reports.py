@@ -0,0 +1,60 @@
+"""
+Everything a page shows about one object, collected up front in a fixed number
+of queries, so the templates only loop over plain lists and never query.
+"""
+
+from django.db.models import Q
+
+from DWStyles.colorspace import near_rounded_colors
+from DWStyles.models import ColorProperty, DWThemeColor, prefetch_colorbars
+
+class ColorReport(object):
+    """What the color detail page shows about a color, saved or transient:
+
+    similar_colors, the other colors in themes that round to the same color;
+    near_colors, the colors in themes near the rounded color, closest first;
+    groups, the color groups it's in; and feature_themes and accent_themes,
+    the themes with a color that rounds to it in each category, with their
+    layouts and colorbars already loaded.
+
+    Takes three queries, four when the colorbars aren't cached, whatever the
+    number of colors and themes."""
+
+    def __init__(self, color):
+
+        self.color = color
+
+        near = near_rounded_colors(color.rounded_hex) if color.rounded_hex else []
+        near_hexes = [color_hex for color_hex, distance in near]
+
+        # the similar and near colors in one query, then split apart
+        colors = ColorProperty.objects.filter(Q(rounded_hex = color.rounded_hex) |
+            Q(color_hex__in = near_hexes), in_themes = True) if color.rounded_hex else []
+
+        self.similar_colors = []
+        near_colors = {}
+        for other in colors:
+            if other.rounded_hex == color.rounded_hex and other.pk != color.pk:
+                self.similar_colors.append(other)
+            if other.color_hex in near_hexes:
+                near_colors[other.color_hex] = other
+        self.similar_colors.sort(key = lambda other: other.color_hex)
+        self.near_colors = [near_colors[color_hex] for color_hex in near_hexes
+            if color_hex in near_colors]
+
+        self.groups = list(color.groups.all()) if color.pk else []
+
+        # one theme color per theme in each category is enough
+        themes = {"feature": [], "accent": []}
+        seen = set()
+        for theme_color in DWThemeColor.objects.filter(rounded_hex = color.rounded_hex,
+                category__in = themes.keys()).select_related(
+                'theme', 'theme__layout').order_by('category', 'theme'):
+            if (theme_color.category, theme_color.theme_id) not in seen:
+                seen.add((theme_color.category, theme_color.theme_id))
+                themes[theme_color.category].append(theme_color.theme)
+
+        self.feature_themes = themes["feature"]
+        self.accent_themes = themes["accent"]
+
+        prefetch_colorbars(self.feature_themes + self.accent_themes)
@@ -0,0 +1,215 @@
+"""
+Renders the public pages to static files, so a web server can serve the site
+without running any Python between admin edits.
+
+Every page is written to <path>/index.html, or to <path>/index@<query>.html
+when it has a query string, next to a gzipped copy, so nginx can serve them
+with:
+
+    gzip_static on;
+    try_files $uri/index@$args.html $uri/index.html @django;
+
+A manifest records the data version each page was rendered at and the pages
+it links on to, so exporting again only renders pages when the data changed,
+and files for pages that are gone are removed.  A page that fails to render
+keeps its last good file.
+"""
+
+import gzip
+import json
+import os
+from multiprocessing import Pool
+from urllib import urlencode
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import resolve
+from django.db import connection
+from django.test.client import RequestFactory
+
+from DWStyles.models import (ColorProperty, ColorPropertyGroup, DWLayout, DWTheme,
+    StyleProperty, get_data_version)
+
+manifest_name = "manifest.json"
+
+def export_paths():
+    """The pages to start from: every layout, theme, color group and color in
+    themes, and the first page of each list, including the theme list with each
+    filter on its own.  The later pages of the lists are found by following
+    their next links."""
+
+    paths = ["/", "/stats", "/colorgroups", "/layouts", "/themes", "/colors"]
+
+    paths.extend("/layout/%d" % pk for pk in DWLayout.objects.values_list('pk', flat = True))
+    paths.extend("/theme/%d" % pk for pk in DWTheme.objects.values_list('pk', flat = True))
+    paths.extend("/color/%s" % color_hex for color_hex in ColorProperty.objects.filter(
+        in_themes = True).values_list('color_hex', flat = True))
+
+    for codename in ColorPropertyGroup.objects.values_list('codename', flat = True):
+        paths.append("/colorgroup/%s" % codename)
+        paths.append("/themes?" + urlencode({"colorfilter": codename}))
+
+    for codename, layout_use, theme_use in StyleProperty.objects.values_list(
+            'codename', 'layout_use', 'theme_use'):
+        if layout_use:
+            paths.append("/layouts?" + urlencode({"filter": codename}))
+            paths.append("/themes?" + urlencode({"layoutfilter": codename}))
+        if theme_use:
+            paths.append("/themes?" + urlencode({"themefilter": codename}))
+
+    for sysid in DWLayout.objects.filter(sysid__isnull = False).values_list(
+            'sysid', flat = True):
+        paths.append("/themes?" + urlencode({"layoutselect": sysid}))
+
+    return paths
+
+def page_filename(path):
+    """Where a page's file goes, relative to the export directory."""
+
+    path, _, query = path.partition("?")
+    name = "index@%s.html" % query if query else "index.html"
+
+    return os.path.join(path.strip("/"), name)
+
+def render_page(path):
+    """Renders a page as an anonymous visitor would see it.  Returns the path,
+    the status code, the content, and the paths of the pages it links on to."""
+
+    url = path.partition("?")[0]
+    request = RequestFactory().get(path)
+    request.user = AnonymousUser()
+    # the next links come from the context, which a cached page doesn't have
+    request.no_page_cache = True
+
+    match = resolve(url)
+
+    # one broken page shouldn't stop the rest from being exported
+    try:
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, "render"):
+            response.render()
+    except Exception as e:
+        return path, 500, str(e), []
+
+    links = []
+    context = getattr(response, "context_data", None) or {}
+    if context.get("next_query"):
+        links.append("%s?%s" % (url, context["next_query"]))
+
+    return path, response.status_code, response.content, links
+
+def start_worker():
+
+    # each process needs its own database connection.  Closing the copy of the
+    # parent's would tell the server to end the parent's session too, so only
+    # forget it, and let the first query open a new one
+    connection.connection = None
+
+def write_page(directory, path, content):
+    """Writes the page and its gzipped copy, unless they're already the same."""
+
+    filename = os.path.join(directory, page_filename(path))
+
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            if f.read() == content:
+                return False
+
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    with open(filename, "wb") as f:
+        f.write(content)
+
+    # no name or time in the header, so the same page always gzips the same
+    with open(filename + ".gz", "wb") as raw:
+        with gzip.GzipFile(filename = "", mode = "wb", fileobj = raw, mtime = 0) as f:
+            f.write(content)
+
+    return True
+
+def remove_page(directory, path):
+
+    filename = os.path.join(directory, page_filename(path))
+
+    for name in (filename, filename + ".gz"):
+        if os.path.exists(name):
+            os.remove(name)
+
+def read_manifest(directory):
+
+    try:
+        with open(os.path.join(directory, manifest_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def export_static_site(directory, processes = None, force = False):
+    """Exports every page to the directory, rendering them across a pool of
+    processes, or in this one if processes is 1.  Pages already exported at the
+    current data version are skipped unless force is given.  Returns counts of
+    the pages rendered, written, skipped, removed and failed."""
+
+    version = get_data_version()
+    old_manifest = read_manifest(directory)
+    manifest = {}
+    counts = {"rendered": 0, "written": 0, "skipped": 0, "removed": 0, "failed": 0}
+
+    pool = None
+    if processes != 1:
+        # nothing open to be copied into the workers, and the parent reconnects
+        connection.close()
+        pool = Pool(processes, initializer = start_worker)
+
+    try:
+        queue = export_paths()
+        seen = set(queue)
+
+        while queue:
+            to_render = []
+            links = []
+
+            for path in queue:
+                entry = old_manifest.get(path)
+                if (not force and entry and entry["version"] == version and
+                        os.path.exists(os.path.join(directory, page_filename(path)))):
+                    manifest[path] = entry
+                    links.extend(entry["links"])
+                    counts["skipped"] += 1
+                else:
+                    to_render.append(path)
+
+            results = (pool.imap_unordered(render_page, to_render, chunksize = 8)
+                if pool else (render_page(path) for path in to_render))
+
+            for path, status, content, page_links in results:
+                counts["rendered"] += 1
+                if status != 200:
+                    counts["failed"] += 1
+                    # keep the last good export of the page, and the pages it
+                    # led to, until it renders again; its older version has it
+                    # tried again next time
+                    entry = old_manifest.get(path)
+                    if entry:
+                        manifest[path] = entry
+                        links.extend(entry["links"])
+                    continue
+                if write_page(directory, path, content):
+                    counts["written"] += 1
+                manifest[path] = {"version": version, "links": page_links}
+                links.extend(page_links)
+
+            queue = [path for path in links if path not in seen]
+            seen.update(queue)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    for path in set(old_manifest) - set(manifest):
+        remove_page(directory, path)
+        counts["removed"] += 1
+
+    with open(os.path.join(directory, manifest_name), "w") as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+
+    return counts
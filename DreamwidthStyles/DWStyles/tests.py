@@ -5,7 +5,78 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from contextlib import closing
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from DWStyles.S2LayerParse import S2LayerParse
+from DWStyles import colorspace
+from DWStyles.colorspace import (DistanceMatrixMissing, build_distance_matrix,
+    get_distance_matrix, grid_hexes, grid_index, neighbour_chunk, near_rounded_colors)
+from DWStyles import colorutil
+from DWStyles.colorutil import (COLOR_METRIC_FIELDS, canonical_hex, cached_color_metrics,
+    iter_color_metrics)
+from DWStyles.colorutil import ColorCategorizer
+from DWStyles.facets import FacetResult, clear_facet_index, get_facet_index
+from DWStyles import jobs
+from DWStyles.jobs import (batch_job_timeout, claim_job, enqueue_job, fail_stale_jobs,
+    run_job, run_queued_jobs)
+from DWStyles import api
+from DWStyles.forms import ThemePropertyFilterForm, get_filter_choices
+from DWStyles.reports import ColorReport
+from DWStyles.static_export import export_static_site, page_filename, read_manifest
+from DWStyles.views import (ColorPropertyListView, DWThemeDetailView, DWThemeListView,
+    StatsView)
+from DWStyles.pagination import (InvalidToken, KeysetPaginator, QuerySetKeyset,
+    decode_token, encode_token)
+from DWStyles.models import (BatchJob, ColorDistance, ColorProperty, ColorPropertyGroup,
+    DataVersion, DWLayout, DWTheme, DWThemeColor, RoundedColorCount, StyleProperty,
+    categorize_color_properties, categorize_dirty_color_properties, color_distance,
+    dirty_color_properties, get_data_version, prefetch_colorbars, render_colorbar,
+    theme_light_on_dark_contrast)
+
+def make_theme(name, layout = None, **kwargs):
+    if layout is None:
+        layout = DWLayout(name = "Layout", codename = "layout")
+        layout.save()
+    theme = DWTheme(name = name, layout = layout, thumbnail_width = 0,
+        thumbnail_height = 0, **kwargs)
+    theme.save()
+    return theme
+
+def add_theme_color(theme, hex_value, variables, category = "accent"):
+    try:
+        color = ColorProperty.objects.get(color_hex = hex_value)
+    except ColorProperty.DoesNotExist:
+        color = ColorProperty(color_hex = hex_value)
+        color.save()
+    theme_color = DWThemeColor(theme = theme, color = color, category = category,
+        variables = variables)
+    theme_color.save()
+    return theme_color
+
+def use_distance_matrix(test):
+    """Builds the distance matrix into a data root of its own for the test."""
+
+    directory = tempfile.mkdtemp()
+    data_root = override_settings(DWSTYLES_DATA_ROOT = directory)
+    data_root.enable()
+    test.addCleanup(shutil.rmtree, directory)
+    test.addCleanup(data_root.disable)
+    test.addCleanup(colorspace._matrices.clear)
+    build_distance_matrix()
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +85,1188 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class ColorMetricsTest(TestCase):
+
+    hexes = ["000000", "ffffff", "808080", "ff0000", "00ff00", "0000ff", "10f0e0",
+        "fe0102", "7f7f80", "c0ffee", "badbad", "0f0f0f", "f0f00f", "e0e0e1"]
+
+    def test_batch_matches_refresh_values(self):
+        """The batch engine gives the same values as the per-row path."""
+
+        for hex_value, metrics in zip(self.hexes, iter_color_metrics(self.hexes)):
+            color = ColorProperty(color_hex = hex_value)
+            color.refresh_values()
+            for field in COLOR_METRIC_FIELDS:
+                self.assertEqual(getattr(color, field), metrics[field],
+                    "%s differs for #%s" % (field, hex_value))
+
+    def test_recompute_command(self):
+        for hex_value in self.hexes:
+            ColorProperty(color_hex = hex_value).save()
+        expected = dict((c.color_hex, c.H) for c in ColorProperty.objects.all())
+
+        ColorProperty.objects.update(H = 0, rounded_hex = "")
+        call_command("recompute_color_metrics", stdout = StringIO())
+
+        for color in ColorProperty.objects.all():
+            self.assertEqual(color.H, expected[color.color_hex])
+            self.assertNotEqual(color.rounded_hex, "")
+
+        output = StringIO()
+        call_command("recompute_color_metrics", stdout = output)
+        self.assertIn("0 changed", output.getvalue())
+
+class ColorDistanceMatrixTest(TestCase):
+
+    def setUp(self):
+        use_distance_matrix(self)
+
+    def test_missing_matrix(self):
+        colorspace._matrices.clear()
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(DWSTYLES_DATA_ROOT = directory):
+                self.assertRaises(DistanceMatrixMissing, get_distance_matrix)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_matrix_matches_color_distance(self):
+        matrix = get_distance_matrix()
+        hexes = grid_hexes()
+        self.assertEqual(len(hexes), 729)
+
+        for hex_a, hex_b in [("000000", "ffffff"), ("202020", "4060ff"),
+            ("e0c000", "ff0020"), ("006040", "a0a0a0")]:
+            color_a = ColorProperty(color_hex = hex_a)
+            color_a.refresh_values()
+            color_b = ColorProperty(color_hex = hex_b)
+            color_b.refresh_values()
+            self.assertAlmostEqual(matrix[grid_index(hex_a), grid_index(hex_b)],
+                color_distance(color_a, color_b), places = 3)
+            self.assertEqual(matrix[grid_index(hex_a), grid_index(hex_b)],
+                matrix[grid_index(hex_b), grid_index(hex_a)])
+
+    def test_near_colors(self):
+        for hex_value in ("ff0000", "e00000", "ff2000", "0000ff"):
+            ColorProperty(color_hex = hex_value).save()
+        ColorProperty.objects.update(in_themes = True)
+
+        color = ColorProperty(color_hex = "fe0101")
+        color.refresh_values()
+        near = [c.color_hex for c in color.near_colors()]
+
+        self.assertEqual(near, ["ff2000", "e00000"])
+
+class NeighbourGraphTest(TestCase):
+
+    def test_chunk_matches_matrix(self):
+        """The sparse neighbours are the closest entries of the dense row."""
+
+        index = grid_index("ff0000")
+        indices, distances = neighbour_chunk((32, index, index + 1, 5, 10))[0]
+        near = near_rounded_colors("ff0000")[:5]
+
+        self.assertEqual([grid_hexes()[i] for i in indices],
+            [color_hex for color_hex, distance in near])
+        for distance, (color_hex, expected) in zip(distances, near):
+            self.assertAlmostEqual(distance, expected, places = 4)
+
+    def test_finer_grid(self):
+        self.assertEqual(len(grid_hexes(16)), 4913)
+        self.assertEqual(near_rounded_colors("ff0000", segment = 16)[0][0], "ff1000")
+
+class CategorizeColorsTest(TestCase):
+
+    def setUp(self):
+        for codename in ("red", "blue", "dark", "favorite"):
+            ColorPropertyGroup.objects.create(label = codename, codename = codename,
+                display_color = "000000", category = "color")
+        for hex_value in ("ff0000", "0000ff", "200000", "00ff00"):
+            ColorProperty(color_hex = hex_value).save()
+        ColorProperty.objects.update(in_themes = True)
+
+    def groups(self, hex_value):
+        color = ColorProperty.objects.get(color_hex = hex_value)
+        return sorted(group.codename for group in color.groups.all())
+
+    def test_categorize(self):
+        blue = ColorPropertyGroup.objects.get(codename = "blue")
+        favorite = ColorPropertyGroup.objects.get(codename = "favorite")
+        ColorProperty.objects.get(color_hex = "ff0000").groups.add(blue, favorite)
+
+        self.assertEqual(categorize_color_properties(), (4, 1))
+
+        # groups without a rule are left alone
+        self.assertEqual(self.groups("ff0000"), ["favorite", "red"])
+        self.assertEqual(self.groups("0000ff"), ["blue"])
+        self.assertEqual(self.groups("200000"), ["dark", "red"])
+        self.assertEqual(self.groups("00ff00"), [])
+
+        self.assertEqual(categorize_color_properties(), (0, 0))
+
+    def test_full_run_clears_dirty_colors(self):
+        self.assertEqual(categorize_color_properties(), (4, 0))
+        self.assertFalse(dirty_color_properties().exists())
+        self.assertEqual(categorize_dirty_color_properties(), (0, 0, 0))
+
+    def test_dirty_colors(self):
+        self.assertEqual(categorize_dirty_color_properties(), (4, 4, 0))
+        self.assertEqual(categorize_dirty_color_properties(), (0, 0, 0))
+
+        color = ColorProperty.objects.get(color_hex = "00ff00")
+        color.color_hex = "0000f0"
+        color.save()
+        ColorProperty.objects.filter(pk = color.pk).update(in_themes = True)
+        self.assertEqual(categorize_dirty_color_properties(), (1, 1, 0))
+        self.assertEqual(self.groups("0000f0"), ["blue"])
+
+        # a rule change makes everything dirty
+        ColorCategorizer.version += 1
+        try:
+            self.assertEqual(categorize_dirty_color_properties()[0], 4)
+        finally:
+            ColorCategorizer.version -= 1
+
+class InThemesTest(TestCase):
+
+    def in_themes(self):
+        return dict(ColorProperty.objects.values_list("color_hex", "in_themes"))
+
+    def test_create_through_manager(self):
+        layout, created = DWLayout.objects.get_or_create(name = "Layout", codename = "layout")
+        theme = DWTheme.objects.create(name = "Test", layout = layout,
+            thumbnail_width = 0, thumbnail_height = 0)
+        color, created = ColorProperty.objects.get_or_create(color_hex = "abcdef")
+        self.assertTrue(created)
+
+        theme_color = DWThemeColor.objects.create(theme = theme, color = color,
+            category = "accent", variables = "color_a")
+        self.assertEqual((theme_color.rounded_hex, theme_color.H), (color.rounded_hex, color.H))
+        self.assertTrue(ColorProperty.objects.get(pk = color.pk).in_themes)
+
+        distance = ColorDistance.objects.create(color_a = color,
+            color_b = ColorProperty.objects.create(color_hex = "123456"))
+        self.assertTrue(distance.distance > 0)
+
+    def test_counts_follow_theme_colors(self):
+        for color_hex in ("abcdef", "abcdee", "123456"):
+            ColorProperty(color_hex = color_hex).save()
+        theme = make_theme("Test")
+
+        theme_color = add_theme_color(theme, "abcdef", "color_a")
+        self.assertEqual(self.in_themes(), {"abcdef": True, "abcdee": True, "123456": False})
+        # a color created later picks the count up too
+        ColorProperty(color_hex = "abcded").save()
+        self.assertTrue(ColorProperty.objects.get(color_hex = "abcded").in_themes)
+
+        # changing the theme color's color moves its count
+        theme_color.color = ColorProperty.objects.get(color_hex = "123456")
+        theme_color.save()
+        self.assertEqual(self.in_themes(), {"abcdef": False, "abcdee": False,
+            "abcded": False, "123456": True})
+
+        # and so does changing the hex of a color in a theme
+        color = ColorProperty.objects.get(color_hex = "123456")
+        color.color_hex = "abcdef"
+        self.assertRaises(IntegrityError, color.save)
+        color.color_hex = "abcdec"
+        color.save()
+        self.assertEqual(self.in_themes(), {"abcdef": True, "abcdee": True,
+            "abcded": True, "abcdec": True})
+
+        # deleting goes by the rounded hex copied onto the row, so not this stale copy
+        theme_color = DWThemeColor.objects.get(pk = theme_color.pk)
+        with override_settings(DEBUG = True):
+            connection.queries = []
+            theme_color.delete()
+            self.assertFalse([query for query in connection.queries
+                if 'FROM "DWStyles_colorproperty"' in query["sql"]
+                and query["sql"].startswith("SELECT")])
+        self.assertEqual(set(self.in_themes().values()), set([False]))
+        self.assertEqual(RoundedColorCount.objects.filter(theme_colors__gt = 0).count(), 0)
+
+    def test_theme_colors_copy_values(self):
+        theme = make_theme("Test")
+        add_theme_color(theme, "0000ff", "color_a")
+        add_theme_color(theme, "ff0000", "color_b")
+        self.assertEqual([tc.color.color_hex for tc in theme.get_accent_colors()],
+            ["ff0000", "0000ff"])
+
+        color = ColorProperty.objects.get(color_hex = "ff0000")
+        color.color_hex = "ffff00"
+        color.save()
+        self.assertEqual(list(theme.dwthemecolor_set.values_list("rounded_hex", "H", "S",
+            "V")), [("0000ff", 240, 100, 100), ("ffff00", 60, 100, 100)])
+        self.assertEqual(ColorProperty.objects.get(color_hex = "0000ff").themes_in().count(), 1)
+
+        DWThemeColor.objects.update(H = 0, rounded_hex = "")
+        call_command("recompute_color_metrics", stdout = StringIO())
+        self.assertEqual([tc.color.color_hex for tc in theme.get_accent_colors()],
+            ["ffff00", "0000ff"])
+        self.assertEqual(ColorProperty.objects.get(color_hex = "0000ff").themes_in().count(), 1)
+
+    @override_settings(DEBUG = True)
+    def test_label_save_skips_metrics(self):
+        ColorProperty(color_hex = "abcdef").save()
+        color = ColorProperty.objects.get(color_hex = "abcdef")
+        color.label = "Blue"
+        start = len(connection.queries)
+        color.save()
+        # just the save itself and the data version bump
+        self.assertEqual(len(connection.queries) - start, 3)
+
+    def test_rebuild_command(self):
+        theme = make_theme("Test")
+        add_theme_color(theme, "abcdef", "color_a")
+        add_theme_color(theme, "123456", "color_b")
+        ColorProperty(color_hex = "ffffff").save()
+        expected = self.in_themes()
+
+        RoundedColorCount.objects.all().delete()
+        ColorProperty.objects.update(in_themes = False)
+        ColorProperty.objects.filter(color_hex = "ffffff").update(in_themes = True)
+
+        output = StringIO()
+        call_command("rebuild_in_themes", stdout = output)
+        self.assertEqual(output.getvalue(),
+            "Counted 2 rounded colors in themes; changed in_themes on 3 colors.\n")
+        self.assertEqual(self.in_themes(), expected)
+        self.assertEqual(sorted(RoundedColorCount.objects.values_list("theme_colors",
+            flat = True)), [1, 1])
+
+class ThemeContrastTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+        for codename in ("dark-on-light", "light-on-dark", "high-contrast", "low-contrast"):
+            StyleProperty.objects.create(label = codename, codename = codename, theme_use = True)
+
+    def properties(self, theme):
+        return sorted(p.codename for p in DWTheme.objects.get(pk = theme.pk).properties.all())
+
+    def test_batch_classification(self):
+        dark = make_theme("Dark")
+        add_theme_color(dark, "eeeeee", "color_page_text, color_entry_text")
+        add_theme_color(dark, "111111", "color_page_background", "feature")
+        add_theme_color(dark, "333333", "color_entry_background", "feature")
+
+        light = make_theme("Light", dark.layout)
+        add_theme_color(light, "777777", "color_page_text")
+        add_theme_color(light, "ffffff", "color_entry_background", "feature")
+
+        neither = make_theme("No text", dark.layout)
+        add_theme_color(neither, "ffffff", "color_entry_background_hover", "feature")
+
+        # a stale property that should go away
+        light.properties.add(StyleProperty.objects.get(codename = "high-contrast"))
+
+        self.assertEqual(theme_light_on_dark_contrast(), (3, 4, 1))
+
+        self.assertEqual(self.properties(dark), ["high-contrast", "light-on-dark"])
+        self.assertEqual(self.properties(light), ["dark-on-light", "low-contrast"])
+        self.assertEqual(self.properties(neither), [])
+        self.assertFalse(DWTheme.objects.filter(needs_contrast = True).exists())
+
+        dark = DWTheme.objects.get(pk = dark.pk)
+        self.assertAlmostEqual(dark.contrast_ratio, 10.89, places = 2)
+        self.assertEqual(DWTheme.objects.get(pk = neither.pk).contrast_ratio, None)
+        # two features against one accent
+        self.assertEqual(dark.dwthemecolorcontrast_set.count(), 2)
+        self.assertEqual(light.dwthemecolorcontrast_set.count(), 1)
+
+        response = self.client.get("/themes?min_contrast=7")
+        self.assertEqual([theme.pk for theme in response.context["theme_list"]], [dark.pk])
+
+        # the single theme method goes through the same path
+        light.set_light_dark_contrast()
+        self.assertEqual(self.properties(light), ["dark-on-light", "low-contrast"])
+
+class FacetIndexTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+
+        self.wide = StyleProperty.objects.create(label = "Wide", codename = "wide",
+            layout_use = True)
+        self.cute = StyleProperty.objects.create(label = "Cute", codename = "cute",
+            theme_use = True)
+        self.blue = ColorPropertyGroup.objects.create(label = "Blue", codename = "blue",
+            category = "color")
+
+        self.layouts = [DWLayout(name = name, codename = name.lower(), sysid = i)
+            for i, name in enumerate(("Wide", "Narrow"))]
+        for layout in self.layouts:
+            layout.save()
+        self.layouts[0].properties.add(self.wide)
+
+        self.themes = [make_theme("Theme %d" % i, self.layouts[i % 2],
+            date_added = datetime.date(2013, 1, i + 1)) for i in range(6)]
+        for theme in self.themes[:4]:
+            theme.properties.add(self.cute)
+
+        # blue as a feature color only counts for the feature
+        add_theme_color(self.themes[0], "0000ff", "color_page_background", "feature")
+        add_theme_color(self.themes[1], "0000ff", "color_page_link")
+        add_theme_color(self.themes[2], "0000ff", "color_page_background", "feature")
+        ColorProperty.objects.get(color_hex = "0000ff").groups.add(self.blue)
+
+    def theme_names(self, query):
+        response = self.client.get("/themes?" + query)
+        return [theme.name for theme in response.context["theme_list"]]
+
+    def test_filters(self):
+        self.assertEqual(self.theme_names(""), ["Theme %d" % i for i in range(5, -1, -1)])
+        self.assertEqual(self.theme_names("layoutfilter=wide&themefilter=cute"),
+            ["Theme 2", "Theme 0"])
+        self.assertEqual(self.theme_names("colorfilter=blue"), ["Theme 2", "Theme 0"])
+        self.assertEqual(self.theme_names("layoutselect=0&layoutselect=1&themefilter=cute"),
+            ["Theme 3", "Theme 2", "Theme 1", "Theme 0"])
+        self.assertEqual(self.theme_names("layoutselect=1&colorfilter=blue"), [])
+
+    def test_facet_counts(self):
+        response = self.client.get("/themes/facets.json?themefilter=cute&layoutselect=0")
+        counts = json.loads(response.content)
+        self.assertEqual(counts["total"], 2)
+        self.assertEqual(counts["facets"], {
+            "themefilter": {"cute": 2},
+            "layoutfilter": {"wide": 2},
+            # another layout widens the match instead
+            "layoutselect": {"0": 2, "1": 4},
+            "colorfilter": {"blue": 2},
+        })
+
+        counts = get_facet_index().counts(color_groups = [self.blue.pk])
+        self.assertEqual(counts["layoutselect"], {0: 2, 1: 0})
+
+        form = ThemePropertyFilterForm()
+        form.fields["layoutselect"].choices = [(0, "Wide"), (1, "Narrow")]
+        form.set_facet_counts(counts)
+        self.assertEqual(form.fields["layoutselect"].choices, [(0, "Wide (2)"),
+            (1, "Narrow (0)")])
+
+    def test_rebuilds_when_data_changes(self):
+        index = get_facet_index()
+        self.assertTrue(get_facet_index() is index)
+
+        self.themes[5].properties.add(self.cute)
+        self.assertFalse(get_facet_index() is index)
+        self.assertEqual(self.theme_names("themefilter=cute"),
+            ["Theme 5", "Theme 3", "Theme 2", "Theme 1", "Theme 0"])
+
+    def test_pages_only_fetch_their_themes(self):
+        result = FacetResult(get_facet_index().filter())
+        self.assertEqual(len(result), 6)
+        self.assertEqual([theme.name for theme in result[1:3]], ["Theme 4", "Theme 3"])
+        self.assertEqual(result[-1].name, "Theme 0")
+
+class ColorbarTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+
+    def make_themes(self, count):
+        themes = []
+        for i in range(count):
+            theme = make_theme("Theme %d" % i, labelid = "theme/t%d" % i)
+            add_theme_color(theme, "%02x0000" % (i * 10 + 1), "color_page_background", "feature")
+            add_theme_color(theme, "0000%02x" % (i * 10 + 1), "color_page_link")
+            add_theme_color(theme, "00%02x00" % (i * 10 + 1), "color_page_text")
+            themes.append(DWTheme.objects.get(pk = theme.pk))
+        return themes
+
+    @override_settings(DEBUG = True)
+    def test_prefetch(self):
+        themes = self.make_themes(4)
+        expected = [render_colorbar(list(theme.get_feature_colors()),
+            list(theme.get_accent_colors())) for theme in themes]
+
+        for queries in (1, 0):
+            start = len(connection.queries)
+            prefetch_colorbars(themes)
+            self.assertEqual(len(connection.queries) - start, queries)
+            self.assertEqual([theme.color_boxes() for theme in themes], expected)
+            themes = [DWTheme.objects.get(pk = theme.pk) for theme in themes]
+
+    @override_settings(DEBUG = True)
+    def test_list_queries_dont_grow(self):
+        counts = []
+        for count in (2, 5):
+            DWTheme.objects.all().delete()
+            self.make_themes(count)
+            # each request starts a fresh list of queries
+            self.client.get("/themes")
+            counts.append(len(connection.queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_invalidation(self):
+        theme = self.make_themes(1)[0]
+        self.assertNotIn("abcdef", theme.color_boxes())
+
+        add_theme_color(theme, "abcdef", "color_extra")
+        self.assertIn("abcdef", DWTheme.objects.get(pk = theme.pk).color_boxes())
+
+        # the bulk layer import drops them too
+        S2LayerParse(make_layer("theme/t0", ["123456"]))
+        self.assertIn("123456", DWTheme.objects.get(pk = theme.pk).color_boxes())
+
+        # and the other pages listing themes show the new colorbar
+        for url in ("/color/123456", "/layout/%d" % theme.layout.pk):
+            self.assertContains(self.client.get(url), 'title="#123456"')
+
+class PageCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+        self.theme = make_theme("Cached", labelid = "theme/cached")
+
+    @override_settings(DEBUG = True)
+    def test_anonymous_pages(self):
+        url = "/theme/%d" % self.theme.pk
+        self.assertContains(self.client.get(url), "Cached")
+
+        # only the data version is looked up the second time
+        self.client.get(url)
+        self.assertEqual(len(connection.queries), 1)
+
+        # and any change moves on to a fresh page
+        self.theme.name = "Renamed"
+        self.theme.save()
+        self.assertContains(self.client.get(url), "Renamed")
+
+    @override_settings(DEBUG = True)
+    def test_staff_bypass(self):
+        from django.contrib.auth.models import User
+        User.objects.create_user("admin", "admin@example.com", "password")
+        User.objects.filter(username = "admin").update(is_staff = True)
+        self.client.get("/themes")
+
+        self.client.login(username = "admin", password = "password")
+        for i in range(2):
+            response = self.client.get("/themes")
+            self.assertContains(response, 'class="editlink"')
+            self.assertTrue(len(connection.queries) > 1)
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.theme = make_theme("Conditional", labelid = "theme/conditional")
+        self.url = "/theme/%d" % self.theme.pk
+
+    @override_settings(DEBUG = True)
+    def test_etag(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(connection.queries), 1)
+
+        self.theme.name = "Changed"
+        self.theme.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH = etag)
+        self.assertContains(response, "Changed")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_last_modified(self):
+        for url in (self.url, "/themes", "/colors"):
+            response = self.client.get(url)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE =
+                response["Last-Modified"]).status_code, 304)
+
+    def test_staff_etag(self):
+        from django.contrib.auth.models import User
+        User.objects.create_user("admin", "admin@example.com", "password")
+        User.objects.filter(username = "admin").update(is_staff = True)
+        etag = self.client.get(self.url)["ETag"]
+
+        self.client.login(username = "admin", password = "password")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Last-Modified"))
+
+class TransientColorTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_canonical_urls(self):
+        self.assertEqual(canonical_hex("FFF"), "ffffff")
+        self.assertEqual(canonical_hex("#A1b2C3"), "a1b2c3")
+        self.assertEqual(canonical_hex("1234"), None)
+
+        for slug in ("ABC", "aabbcc".upper(), "abc"):
+            response = self.client.get("/color/%s" % slug)
+            self.assertEqual(response.status_code, 301)
+            self.assertTrue(response["Location"].endswith("/color/aabbcc"))
+        self.assertEqual(self.client.get("/color/12345").status_code, 404)
+
+    def test_unknown_color_isnt_saved(self):
+        response = self.client.get("/color/a1b2c3")
+        self.assertContains(response, "not in the system")
+        self.assertFalse(ColorProperty.objects.exists())
+
+        # the same values it would get saved
+        saved = ColorProperty(color_hex = "a1b2c3")
+        saved.save()
+        transient = response.context["color"]
+        for field in COLOR_METRIC_FIELDS:
+            self.assertEqual(getattr(transient, field), getattr(saved, field), field)
+
+    def test_metrics_cache_size(self):
+        size = colorutil.color_metrics_cache_size
+        colorutil.color_metrics_cache_size = 2
+        try:
+            for color_hex in ("000000", "111111", "000000", "222222"):
+                cached_color_metrics(color_hex)
+            self.assertEqual(list(colorutil._color_metrics_cache), ["000000", "222222"])
+        finally:
+            colorutil.color_metrics_cache_size = size
+
+class ColorReportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = ColorPropertyGroup.objects.create(label = "Blues", codename = "blue")
+
+    def make_themes(self, count):
+        layout = DWLayout(name = "Layout", codename = "layout")
+        layout.save()
+        for i in range(count):
+            theme = make_theme("Theme %d" % i, layout, labelid = "theme/r%d" % i)
+            # two colors rounding to the same color, and a near one
+            add_theme_color(theme, "0000ff", "color_page_background", "feature")
+            add_theme_color(theme, "0102fe", "color_page_link", "feature")
+            add_theme_color(theme, "2000ff", "color_page_text")
+        ColorProperty.objects.get(color_hex = "0000ff").groups.add(self.group)
+
+    def test_report(self):
+        self.make_themes(2)
+        report = ColorReport(ColorProperty.objects.get(color_hex = "0000ff"))
+
+        self.assertEqual([color.color_hex for color in report.similar_colors], ["0102fe"])
+        self.assertIn("2000ff", [color.color_hex for color in report.near_colors])
+        self.assertEqual(report.groups, [self.group])
+        self.assertEqual([theme.name for theme in report.feature_themes],
+            ["Theme 0", "Theme 1"])
+        self.assertEqual(report.accent_themes, [])
+
+    @override_settings(DEBUG = True)
+    def test_query_ceiling(self):
+        counts = []
+        for count in (1, 6):
+            DWTheme.objects.all().delete()
+            cache.clear()
+            self.make_themes(count)
+            response = self.client.get("/color/0000ff")
+            self.assertContains(response, "Featured (%d themes)" % count)
+            self.assertContains(response, "Blues")
+            counts.append(len(connection.queries))
+
+        # the data version, the color, and the report's four
+        self.assertEqual(counts, [6, 6])
+
+class ApiTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+        self.layout = DWLayout(name = "Layout", codename = "layout", sysid = 7)
+        self.layout.save()
+        for i in range(5):
+            theme = make_theme("Theme %d" % i, self.layout, labelid = "theme/a%d" % i)
+            add_theme_color(theme, "0000ff", "color_page_background", "feature")
+            add_theme_color(theme, "%02x0000" % (i * 10 + 1), "color_page_link")
+        self.ordered = list(DWTheme.objects.order_by('-pk').values_list('pk', flat = True))
+
+    def test_theme_pages(self):
+        url = "/api/themes.json?layoutselect=7&limit=2"
+        ids = []
+        while url:
+            data = json.loads(self.client.get(url).content)
+            ids.extend(theme["id"] for theme in data["results"])
+            url = data["next"]
+        self.assertEqual(ids, self.ordered)
+
+        theme = data["results"][-1]
+        self.assertEqual(theme["layout"]["sysid"], 7)
+        self.assertEqual([color["hex"] for color in theme["feature_colors"]], ["0000ff"])
+        self.assertEqual(theme["accent_colors"][0]["variables"], "color_page_link")
+
+        self.assertEqual(self.client.get("/api/themes.json?cursor=bad").status_code, 400)
+
+    def test_ndjson(self):
+        size = api.api_stream_chunk_size
+        api.api_stream_chunk_size = 2
+        try:
+            response = self.client.get("/api/themes.json?format=ndjson")
+            lines = "".join(response.streaming_content).splitlines()
+        finally:
+            api.api_stream_chunk_size = size
+        self.assertEqual([json.loads(line)["id"] for line in lines], self.ordered)
+
+        response = self.client.get("/api/colors.json?format=ndjson")
+        hexes = [json.loads(line)["hex"] for line in "".join(
+            response.streaming_content).splitlines()]
+        self.assertEqual(sorted(hexes), sorted(ColorProperty.objects.values_list(
+            'color_hex', flat = True)))
+
+    def test_ndjson_past_deleted_themes(self):
+        get_facet_index()
+        version = get_data_version()
+        # deleted behind the index's back, as if the index were built just before
+        DWTheme.objects.filter(pk__in = self.ordered[1:3]).delete()
+        DataVersion.objects.update(version = version)
+
+        size = api.api_stream_chunk_size
+        api.api_stream_chunk_size = 2
+        try:
+            response = self.client.get("/api/themes.json?format=ndjson")
+            lines = "".join(response.streaming_content).splitlines()
+        finally:
+            api.api_stream_chunk_size = size
+        self.assertEqual([json.loads(line)["id"] for line in lines],
+            self.ordered[:1] + self.ordered[3:])
+
+    def test_etag(self):
+        response = self.client.get("/api/layouts.json")
+        self.assertEqual(json.loads(response.content)["results"][0]["codename"], "layout")
+        self.assertEqual(self.client.get("/api/layouts.json",
+            HTTP_IF_NONE_MATCH = response["ETag"]).status_code, 304)
+
+    def test_color(self):
+        data = json.loads(self.client.get("/api/colors/0000FF.json").content)
+        self.assertEqual(data["color"]["rgb"], [0, 0, 255])
+        self.assertEqual(sorted(data["feature_themes"]), sorted(self.ordered))
+        self.assertEqual(json.loads(self.client.get("/api/colorgroups.json").content)[
+            "results"], [])
+
+class StaticExportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+        self.directory = tempfile.mkdtemp()
+        layout = DWLayout(name = "Layout", codename = "layout", sysid = 3)
+        layout.save()
+        for i in range(4):
+            theme = make_theme("Theme %d" % i, layout, labelid = "theme/e%d" % i)
+            add_theme_color(theme, "%02x0000" % (i * 10 + 1), "color_page_link")
+        for codename in StatsView.tally_properties:
+            StyleProperty.objects.create(label = codename, codename = codename,
+                theme_use = True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self):
+        page_size = DWThemeListView.paginate_by
+        DWThemeListView.paginate_by = 3
+        try:
+            return export_static_site(self.directory, processes = 1)
+        finally:
+            DWThemeListView.paginate_by = page_size
+
+    def test_export(self):
+        counts = self.export()
+        self.assertEqual(counts["failed"], 0)
+        self.assertEqual(counts["written"], counts["rendered"])
+
+        theme = DWTheme.objects.order_by('pk')[0]
+        filename = os.path.join(self.directory, page_filename("/theme/%d" % theme.pk))
+        with open(filename) as f:
+            self.assertIn(theme.name, f.read())
+        import gzip
+        with closing(gzip.open(filename + ".gz")) as f:
+            self.assertIn(theme.name, f.read())
+
+        # the second page of each theme list was found through its next link
+        manifest = read_manifest(self.directory)
+        second = manifest["/themes"]["links"]
+        self.assertEqual(len(second), 1)
+        self.assertIn(second[0], manifest)
+        self.assertIn("/themes?layoutselect=3", manifest)
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+            page_filename(second[0]))))
+
+        # nothing changed, so nothing is rendered again
+        self.assertEqual(self.export()["rendered"], 0)
+
+        # and a theme that's gone has its page removed, along with its color's
+        # and the theme list's second page
+        theme.delete()
+        self.assertEqual(self.export()["removed"], 3)
+        self.assertFalse(os.path.exists(filename))
+        self.assertNotIn(second[0], read_manifest(self.directory))
+
+    def test_failed_page_keeps_its_file(self):
+        self.export()
+        theme = DWTheme.objects.order_by('pk')[0]
+        path = "/theme/%d" % theme.pk
+        filename = os.path.join(self.directory, page_filename(path))
+
+        def broken(view, **kwargs):
+            raise RuntimeError("Render failed")
+        DWThemeDetailView.get_context_data = broken
+        try:
+            # every page is rendered again after a change
+            theme.name = "Renamed"
+            theme.save()
+            counts = self.export()
+        finally:
+            del DWThemeDetailView.get_context_data
+
+        self.assertEqual(counts["failed"], 4)
+        self.assertEqual(counts["removed"], 0)
+        self.assertTrue(os.path.exists(filename))
+        self.assertIn(path, read_manifest(self.directory))
+
+        # and it's tried again next time
+        counts = self.export()
+        self.assertEqual((counts["rendered"], counts["failed"]), (4, 0))
+        with open(filename) as f:
+            self.assertIn("Renamed", f.read())
+
+    def test_command(self):
+        out = StringIO()
+        call_command("export_static_site", self.directory, processes = 1, stdout = out)
+        self.assertIn("0 failed", out.getvalue())
+
+class FilterChoicesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_no_choices_until_made(self):
+        # so importing the forms doesn't query
+        self.assertEqual(ThemePropertyFilterForm.base_fields["themefilter"].choices, [])
+
+    @override_settings(DEBUG = True)
+    def test_choices_follow_the_data(self):
+        StyleProperty.objects.create(label = "Cute", codename = "cute", theme_use = True)
+        form = ThemePropertyFilterForm()
+        self.assertEqual(form.fields["themefilter"].choices, [("cute", "Cute")])
+
+        # cached until something changes
+        version = get_data_version()
+        with self.assertNumQueries(0):
+            ThemePropertyFilterForm(data_version = version)
+
+        StyleProperty.objects.create(label = "Dark", codename = "dark", theme_use = True)
+        self.assertEqual(get_filter_choices("theme_property"), [("cute", "Cute"),
+            ("dark", "Dark")])
+
+class AdminQueriesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username = "admin", password = "password")
+
+    def page_queries(self, url):
+        self.client.get(url)
+        return len(connection.queries)
+
+    @override_settings(DEBUG = True)
+    def test_theme_colors_inline(self):
+        counts = []
+        # the first load of the page looks up its content types
+        theme = make_theme("Warm")
+        add_theme_color(theme, "ffffff", "color_page_background")
+        self.client.get("/admin/DWStyles/dwtheme/%d/" % theme.pk)
+        for count in (2, 8):
+            theme = make_theme("Theme %d" % count)
+            for i in range(count):
+                add_theme_color(theme, "%02x%02x00" % (count, i * 20), "color_%d" % i)
+            response = self.client.get("/admin/DWStyles/dwtheme/%d/" % theme.pk)
+            self.assertContains(response, "background-color: #%02x0000" % count)
+            counts.append(len(connection.queries))
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(DEBUG = True)
+    def test_color_distance_list(self):
+        counts = []
+        for count in (2, 8):
+            ColorDistance.objects.all().delete()
+            for i in range(count):
+                a = ColorProperty(color_hex = "%02x00%02x" % (count, i))
+                b = ColorProperty(color_hex = "00%02x%02x" % (count, i))
+                a.save()
+                b.save()
+                ColorDistance(color_a = a, color_b = b).save()
+            counts.append(self.page_queries("/admin/DWStyles/colordistance/"))
+        self.assertEqual(counts[0], counts[1])
+
+class BatchJobTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username = "admin", password = "password")
+
+    def test_contrast_action_queues_job(self):
+        for codename in ("dark-on-light", "light-on-dark", "high-contrast", "low-contrast"):
+            StyleProperty.objects.create(label = codename, codename = codename, theme_use = True)
+        dark = make_theme("Dark")
+        add_theme_color(dark, "eeeeee", "color_page_text")
+        add_theme_color(dark, "111111", "color_page_background", "feature")
+        other = make_theme("Other", dark.layout)
+
+        response = self.client.post("/admin/DWStyles/dwtheme/", {
+            "action": "set_light_dark_contrast", "_selected_action": [dark.pk, other.pk]})
+        job = BatchJob.objects.get()
+        self.assertRedirects(response, "/admin/batch_job/%d" % job.pk)
+        self.assertEqual((job.kind, job.status, job.total, job.get_ids()),
+            ("theme_contrast", "queued", 2, sorted([dark.pk, other.pk])))
+        # nothing happens until the worker runs
+        self.assertFalse(DWTheme.objects.get(pk = dark.pk).properties.exists())
+        self.assertContains(self.client.get("/admin/batch_job/%d" % job.pk), "Queued")
+
+        output = StringIO()
+        call_command("run_batch_jobs", stdout = output)
+        self.assertIn("done", output.getvalue())
+
+        job = BatchJob.objects.get()
+        self.assertEqual((job.status, job.done), ("done", 2))
+        self.assertEqual(job.message, "Added 2 and removed 0 properties.")
+        self.assertEqual(sorted(p.codename for p in DWTheme.objects.get(
+            pk = dark.pk).properties.all()), ["high-contrast", "light-on-dark"])
+
+        response = self.client.get("/admin/batch_job/%d" % job.pk)
+        self.assertContains(response, "2 of 2 rows (100%)")
+        self.assertContains(response, "rows a second")
+        self.assertNotContains(response, 'http-equiv="refresh"')
+
+    def test_color_jobs(self):
+        use_distance_matrix(self)
+        group = ColorPropertyGroup(label = "Red", codename = "red", category = "hue")
+        group.save()
+        colors = []
+        for hex_value in ("000000", "200000", "ff0000"):
+            color = ColorProperty(color_hex = hex_value)
+            color.save()
+            colors.append(color)
+        pks = [color.pk for color in colors]
+
+        ColorProperty.objects.filter(pk = pks[2]).update(H = 123)
+        ColorDistance(color_a = colors[0], color_b = colors[1]).save()
+        ColorDistance.objects.update(distance = 0)
+
+        for kind in ("color_metrics", "categorize_colors", "color_distances"):
+            enqueue_job(kind, pks)
+        ran = run_queued_jobs()
+        self.assertEqual([(job.kind, job.status, job.done) for job in ran],
+            [("color_metrics", "done", 3), ("categorize_colors", "done", 3),
+            ("color_distances", "done", 3)])
+
+        self.assertEqual(ColorProperty.objects.get(pk = pks[2]).H, 0)
+        self.assertEqual(sorted(group.colorproperty_set.values_list('pk', flat = True)),
+            pks[1:])
+        self.assertEqual(ColorDistance.objects.count(), 3)
+        matrix = get_distance_matrix()
+        for distance in ColorDistance.objects.select_related('color_a', 'color_b'):
+            self.assertLess(distance.color_a.color_hex, distance.color_b.color_hex)
+            self.assertAlmostEqual(distance.distance, matrix[
+                grid_index(distance.color_a.color_hex),
+                grid_index(distance.color_b.color_hex)], places = 4)
+
+    def test_failed_job_doesnt_stop_the_worker(self):
+        theme = make_theme("No properties")
+        failing = enqueue_job("theme_contrast", [theme.pk])
+        enqueue_job("categorize_colors", [])
+
+        ran = run_queued_jobs()
+        self.assertEqual([job.status for job in ran], ["failed", "done"])
+        self.assertIn("Missing style properties", BatchJob.objects.get(
+            pk = failing.pk).message)
+        self.assertEqual(run_queued_jobs(), [])
+
+    def test_stale_running_job_fails(self):
+        stale = enqueue_job("categorize_colors", [])
+        fresh = enqueue_job("categorize_colors", [])
+        self.assertEqual(claim_job().pk, stale.pk)
+        self.assertEqual(claim_job().pk, fresh.pk)
+        BatchJob.objects.filter(pk = stale.pk).update(updated = timezone.now() -
+            datetime.timedelta(seconds = batch_job_timeout + 1))
+
+        self.assertEqual(run_queued_jobs(), [])
+        stale = BatchJob.objects.get(pk = stale.pk)
+        self.assertEqual(stale.status, "failed")
+        self.assertTrue(stale.finished)
+        # still saving progress, so still running
+        self.assertEqual(BatchJob.objects.get(pk = fresh.pk).status, "running")
+
+        response = self.client.get("/admin/batch_job/%d" % stale.pk)
+        self.assertContains(response, "The worker stopped")
+        self.assertNotContains(response, 'http-equiv="refresh"')
+
+    def test_failed_as_stale_stays_failed(self):
+        job = enqueue_job("color_metrics", [])
+        job = claim_job()
+        old = timezone.now() - datetime.timedelta(seconds = batch_job_timeout + 1)
+        BatchJob.objects.filter(pk = job.pk).update(updated = old)
+        seen = []
+
+        def copy_theme_color_values():
+            # the progress time was saved before this step
+            seen.append(BatchJob.objects.get(pk = job.pk).updated)
+            # and another worker gives up on the job while it runs anyway
+            BatchJob.objects.filter(pk = job.pk).update(updated = old)
+            fail_stale_jobs()
+            return 0
+
+        original = jobs.copy_theme_color_values
+        jobs.copy_theme_color_values = copy_theme_color_values
+        try:
+            job = run_job(job)
+        finally:
+            jobs.copy_theme_color_values = original
+
+        self.assertTrue(seen[0] > old)
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(BatchJob.objects.get(pk = job.pk).message,
+            "The worker stopped before finishing this job.")
+
+def context_value(response, name):
+    return response.context[name] if name in response.context else None
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_facet_index()
+        self.views = (DWThemeListView, ColorPropertyListView)
+        self.page_sizes = [view.paginate_by for view in self.views]
+        for view in self.views:
+            view.paginate_by = 3
+
+    def tearDown(self):
+        for view, page_size in zip(self.views, self.page_sizes):
+            view.paginate_by = page_size
+
+    def walk(self, url, name):
+        """Every page forwards, then every page before the last backwards, as
+        lists of primary keys."""
+        pages = []
+        query = ""
+        while query is not None:
+            response = self.client.get(url + "?" + query)
+            pages.append([obj.pk for obj in response.context[name]])
+            query = context_value(response, "next_query")
+
+        backwards = []
+        query = context_value(response, "previous_query")
+        while query is not None:
+            response = self.client.get(url + "?" + query)
+            backwards.insert(0, [obj.pk for obj in response.context[name]])
+            query = context_value(response, "previous_query")
+
+        return pages, backwards
+
+    def test_tokens(self):
+        token = encode_token((1, 2.5, 3), backwards = True)
+        self.assertEqual(decode_token(token, 3), ((1, 2.5, 3), True))
+        for bad in ("nonsense", token[:-2], encode_token(("a", 1))):
+            self.assertRaises(InvalidToken, decode_token, bad, 3)
+
+    def test_queryset_pages(self):
+        for i in range(10):
+            ColorProperty(color_hex = "%02x%02x%02x" % (i * 25, 255 - i * 25, 128)).save()
+        queryset = ColorProperty.objects.all()
+        ordered = list(queryset.order_by('H', 'S', 'V', 'pk'))
+        paginator = KeysetPaginator(QuerySetKeyset(queryset, ("H", "S", "V", "pk")), 4,
+            count = queryset.count)
+
+        page = paginator.page()
+        seen = list(page)
+        while page.has_next():
+            page = paginator.page(page.next_token)
+            seen.extend(page)
+        self.assertEqual(seen, ordered)
+        self.assertEqual(paginator.count, 10)
+
+        page = paginator.page(page.previous_token)
+        self.assertEqual(list(page), ordered[4:8])
+        self.assertTrue(page.has_previous())
+
+    def test_color_list(self):
+        for hex_value in grid_hexes()[1:40:5]:
+            ColorProperty(color_hex = hex_value).save()
+        ColorProperty.objects.update(in_themes = True)
+        ordered = [color.pk for color in ColorProperty.get_colors_in_themes()]
+        self.assertEqual(len(ordered), 8)
+
+        pages, backwards = self.walk("/colors", "colorproperty_list")
+        self.assertEqual(sum(pages, []), ordered)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(backwards, pages[:-1])
+
+        # old page number links still work, and bad cursors are not found
+        response = self.client.get("/colors?page=2")
+        self.assertEqual([color.pk for color in response.context["colorproperty_list"]],
+            ordered[3:6])
+        self.assertEqual(self.client.get("/colors?cursor=bogus").status_code, 404)
+
+    def test_theme_list(self):
+        layout = DWLayout(name = "Layout", codename = "layout")
+        layout.save()
+        for i in range(7):
+            make_theme("Theme %d" % i, layout, labelid = "theme/t%d" % i,
+                date_added = datetime.date(2012, 1, 1 + i % 3))
+        ordered = list(DWTheme.objects.order_by('-date_added', '-pk').values_list(
+            'pk', flat = True))
+
+        pages, backwards = self.walk("/themes", "theme_list")
+        self.assertEqual(sum(pages, []), ordered)
+        self.assertEqual(backwards, pages[:-1])
+
+        # the filters are kept in the cursor links
+        response = self.client.get("/themes?layoutselect=layout")
+        self.assertIn("layoutselect=layout", response.context["next_query"])
+        self.assertEqual(response.context["paginator"].count, 7)
+
+def make_layer(redist_unique, colors):
+    lines = ['layerinfo type = "theme";', 'layerinfo redist_uniq = "%s";' % redist_unique, ""]
+    for i, hex_value in enumerate(colors):
+        lines.append('set color_var_%s = "#%s";' % ("abcdefghijklmnopqrstuvwxyz"[i % 26] * 
+            (i // 26 + 1), hex_value))
+    lines.append('set color_page_background="#FFF" ; set color_page_text = "#000";')
+    lines.append('set color_entry_background =  "#fff";')
+    lines.append('set font_base = "Verdana";')
+    return "\n".join(lines)
+
+class S2LayerParseTest(TestCase):
+
+    def line_parse(self, text):
+        """The original line by line parse."""
+        redist_unique = None
+        color_variables = []
+        for line in text.split("\n"):
+            if not redist_unique:
+                m = S2LayerParse.find_redist_unique.search(line)
+                if m:
+                    redist_unique = m.groups()[0]
+                    continue
+            m = S2LayerParse.set_color_variable.search(line)
+            if m:
+                color_variables.append(m.groups())
+        return redist_unique, color_variables
+
+    def test_parse_matches_line_parse(self):
+        text = make_layer("theme/test", ["%06x" % (i * 9973) for i in range(100)])
+        text += '\nset color_split = \n"#123456";\nlayerinfo redist_uniq = "theme/other";'
+        text = text.replace('layerinfo type = "theme";',
+            'layerinfo type = "theme"; set color_before = "#111";')
+        text = text.replace('"theme/test";', '"theme/test"; set color_skipped = "#222";')
+        self.assertEqual(S2LayerParse.parse(text), self.line_parse(text))
+
+    def test_load(self):
+        theme = make_theme("Test", labelid = "theme/test")
+        ColorProperty(color_hex = "abcdef").save()
+        add_theme_color(theme, "ffffff", "old", "feature")
+
+        layer = S2LayerParse(make_layer("theme/test", ["abcdef", "ABC", "123456", "abcdef"]))
+
+        self.assertEqual(layer.theme, theme)
+        # only the first statement on a line counts, like it always has
+        self.assertEqual(sorted(layer.colors), ["123456", "aabbcc", "abcdef", "ffffff"])
+        self.assertEqual(layer.colors["abcdef"], ["color_var_a", "color_var_d"])
+
+        theme_colors = dict((tc.color.color_hex, tc) for tc in theme.dwthemecolor_set.all())
+        self.assertEqual(len(theme_colors), 4)
+        self.assertEqual(theme_colors["abcdef"].variables, "color_var_a, color_var_d")
+        self.assertEqual(theme_colors["abcdef"].category, "accent")
+        # existing assignments keep their category but get the new variables
+        self.assertEqual(theme_colors["ffffff"].variables,
+            "color_page_background, color_entry_background")
+
+        # new colors get the same values saving them would
+        for color_hex in ("aabbcc", "123456"):
+            created = ColorProperty.objects.get(color_hex = color_hex)
+            expected = ColorProperty(color_hex = color_hex)
+            expected.refresh_values()
+            for field in COLOR_METRIC_FIELDS:
+                prep = ColorProperty._meta.get_field(field).get_prep_value
+                self.assertEqual(getattr(created, field), prep(getattr(expected, field)))
+
+    @override_settings(DEBUG = True)
+    def test_load_query_count(self):
+        """Loading takes the same handful of queries however big the layer is."""
+
+        counts = []
+        for size in (10, 300):
+            make_theme("Test", labelid = "theme/test%d" % size)
+            # distinct rounded colors, which all have their counts bumped by one
+            colors = grid_hexes()[size % 2:-1:2][:size]
+            start = len(connection.queries)
+            S2LayerParse(make_layer("theme/test%d" % size, colors))
+            counts.append(len(connection.queries) - start)
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(DEBUG = True)
+    def test_reimport_changed_variables(self):
+        theme = make_theme("Test", labelid = "theme/test")
+        S2LayerParse(make_layer("theme/test", ["abcdef", "abcdef", "123456"]))
+
+        layer = S2LayerParse(make_layer("theme/test", ["abcdef", "654321", "123456"]))
+        self.assertEqual(layer.changed_variables, 1)
+        self.assertEqual(sorted(layer.colors), ["123456", "654321", "abcdef", "ffffff"])
+        self.assertEqual(sorted(layer.existing_colors), ["654321", "abcdef"])
+        self.assertEqual(sorted(theme.dwthemecolor_set.values_list(
+            "color__color_hex", "variables")), [("123456", "color_var_c"),
+            ("654321", "color_var_b"), ("abcdef", "color_var_a"),
+            ("ffffff", "color_page_background, color_entry_background")])
+
+        # an identical layer only costs finding its theme
+        start = len(connection.queries)
+        layer = S2LayerParse(make_layer("theme/test", ["abcdef", "654321", "123456"]))
+        self.assertEqual(len(connection.queries) - start, 1)
+        self.assertEqual(layer.changed_variables, None)
+
+        # editing the theme's colors by hand means the next import isn't skipped
+        add_theme_color(theme, "000000", "color_extra")
+        layer = S2LayerParse(make_layer("theme/test", ["abcdef", "654321", "123456"]))
+        self.assertEqual(layer.changed_variables, 5)
+
+    def test_import_s2_layers(self):
+        theme = make_theme("Test", labelid = "theme/test")
+        make_theme("Shared", labelid = "theme/shared")
+        make_theme("Shared", labelid = "theme/shared")
+
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, "theme"))
+            for name, redist, colors in (("test", "theme/test", ["abcdef", "123"]),
+                    ("shared", "theme/shared", ["aaaaaa"]),
+                    ("missing", "theme/missing", ["bbbbbb"])):
+                with open(os.path.join(directory, "theme", name + ".s2"), "w") as layer:
+                    layer.write(make_layer(redist, colors))
+
+            tarball = os.path.join(directory, "layers.tar.gz")
+            with closing(tarfile.open(tarball, "w:gz")) as archive:
+                archive.add(os.path.join(directory, "theme"), "theme")
+
+            for path, changed in ((os.path.join(directory, "theme"), 1), (tarball, 0)):
+                output = StringIO()
+                call_command("import_s2_layers", path, processes = 1, stdout = output)
+                self.assertIn("Imported 1 layers", output.getvalue())
+                self.assertIn("%d changed" % changed, output.getvalue())
+                self.assertIn("%d skipped as unchanged" % (1 - changed), output.getvalue())
+                self.assertIn("skipped 1 without a theme and 1 with a shared", output.getvalue())
+
+                self.assertEqual(sorted(theme.dwthemecolor_set.values_list(
+                    "color__color_hex", "variables")), [("112233", "color_var_b"),
+                    ("abcdef", "color_var_a"),
+                    ("ffffff", "color_page_background, color_entry_background")])
+        finally:
+            shutil.rmtree(directory)
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
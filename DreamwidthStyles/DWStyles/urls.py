@@ -6,6 +6,7 @@ from .views import DWThemeDetailView
 
 from .views import DWLayoutListView
 from .views import DWThemeListView
+from .views import ThemeFacetCountsView
 from .views import ColorGroupListView
 from .views import ColorGroupColorListView
 from .views import ColorPropertyListView
@@ -13,8 +14,12 @@ from .views import ColorPropertyListView
 from .views import StatsView
 from .views import HomeView
 
+from .api import ColorApiView, ColorDetailApiView, ColorGroupApiView
+from .api import LayoutApiView, ThemeApiView
+
 urlpatterns = patterns('DWStyles.views',
     url(r'^admin/color_layer_copy$', "color_layer_copy", name="color_layer_copy"),
+    url(r'^admin/batch_job/(?P<pk>\d+)$', "batch_job_progress", name="batch_job"),
 )
 
 # Class based generic views
@@ -27,6 +32,7 @@ urlpatterns += patterns('',
     # list views
     url(r'^layouts/?$', DWLayoutListView.as_view(), name="layout_list"),
     url(r'^themes/?$', DWThemeListView.as_view(), name="theme_list"),
+    url(r'^themes/facets\.json$', ThemeFacetCountsView.as_view(), name="theme_facets"),
     url(r'^colors/?$', ColorPropertyListView.as_view(), name="color_list"),
 
     # detail views
@@ -36,4 +42,12 @@ urlpatterns += patterns('',
     url(r'^colorgroup/(?P<slug>[a-zA-Z0-9_s]+)$', 
         ColorGroupColorListView.as_view(), name="colorgroup_colorlist"),
 
+    # read-only JSON API
+    url(r'^api/themes\.json$', ThemeApiView.as_view(), name="api_themes"),
+    url(r'^api/layouts\.json$', LayoutApiView.as_view(), name="api_layouts"),
+    url(r'^api/colors\.json$', ColorApiView.as_view(), name="api_colors"),
+    url(r'^api/colors/(?P<slug>[a-fA-F0-9]+)\.json$', ColorDetailApiView.as_view(),
+        name="api_color"),
+    url(r'^api/colorgroups\.json$', ColorGroupApiView.as_view(), name="api_colorgroups"),
+
 )
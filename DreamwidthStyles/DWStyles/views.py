@@ -1,26 +1,35 @@
+import json
+
 from django.db.models import Count
 
 from django.http import HttpResponse
 from django.template import RequestContext
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponsePermanentRedirect, HttpResponseRedirect
 from django.core.exceptions import ObjectDoesNotExist
 
 from django.core.urlresolvers import reverse
-from django.shortcuts import redirect, render_to_response
+from django.shortcuts import get_object_or_404, redirect, render_to_response
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.views.generic import DetailView, ListView, TemplateView
+from django.views.generic import DetailView, ListView, TemplateView, View
 
 from .models import *
 from .forms import *
 
 from .S2LayerParse import S2LayerParse
+from .caching import VersionedCacheMixin
+from .colorutil import canonical_hex
+from .facets import get_facet_index
+from .jobs import job_kinds
+from .pagination import KeysetPaginationMixin
+from .reports import ColorReport
 
-class HomeView(TemplateView):
+class HomeView(VersionedCacheMixin, TemplateView):
 
     template_name = "home.html"
 
-class StatsView(TemplateView):
+class StatsView(VersionedCacheMixin, TemplateView):
 
     template_name = "DWStyles/stats.html"
 
@@ -58,14 +67,14 @@ class StatsView(TemplateView):
         context['property_counts'] = property_counts
         return context
 
-class DWLayoutListView(ListView):
+class DWLayoutListView(VersionedCacheMixin, ListView):
 
     model = DWLayout
     context_object_name = "layout_list"
     paginate_by = 25
 
     def get_queryset(self):
-        layout_list = DWLayout.objects.all()
+        layout_list = DWLayout.objects.select_related('example_theme')
 
         self.filters = []
 
@@ -85,16 +94,19 @@ class DWLayoutListView(ListView):
         c = super(DWLayoutListView, self).get_context_data(**kwargs)
 
         filterform = LayoutPropertyFilterForm(initial = {
-            "filter": [filter.codename for filter in self.filters] })
+            "filter": [filter.codename for filter in self.filters] },
+            data_version = self.data_version)
 
         c.update({
             "filterform": filterform,
             "applied_filters": self.filters,
         })
 
+        prefetch_colorbars([layout.example_theme for layout in c["layout_list"]])
+
         return c
 
-class DWLayoutDetailView(DetailView):
+class DWLayoutDetailView(VersionedCacheMixin, DetailView):
 
     context_object_name = "layout"
     queryset = DWLayout.objects.all()
@@ -102,35 +114,25 @@ class DWLayoutDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super(DWLayoutDetailView, self).get_context_data(**kwargs)
 
-        context["editlinks"] = self.request.user.is_staff
+        context["themes"] = prefetch_colorbars(list(
+            self.object.get_themes().select_related('layout')))
 
         return context
 
-class DWThemeDetailView(DetailView):
+class DWThemeDetailView(VersionedCacheMixin, DetailView):
 
     context_object_name = "theme"
     queryset = DWTheme.objects.all()
 
-    def get_context_data(self, **kwargs):
-        context = super(DWThemeDetailView, self).get_context_data(**kwargs)
-
-        context["editlinks"] = self.request.user.is_staff
-
-        return context
-
-class DWThemeListView(ListView):
-
-    model = DWTheme
-    context_object_name = "theme_list"
-    paginate_by = 25
-
-    def get_queryset(self):
-        theme_list = DWTheme.objects.order_by('-date_added')
+class ThemeFilterMixin(object):
+    """Reads the theme list filters out of the query string."""
 
+    def parse_filters(self):
         self.layoutfilters = []
         self.layoutselects = []
         self.colorfilters = []
         self.themefilters = []
+        self.min_contrast = None
         self.filters = []
 
         if "layoutfilter" in self.request.GET:
@@ -175,99 +177,140 @@ class DWThemeListView(ListView):
             self.filters.append("Theme property filters: " + ", ".join(
                 [p.label for p in self.themefilters]))
 
-        for filter in self.themefilters:
-            theme_list = theme_list.filter(properties__pk = filter.pk)
-        
-        for filter in self.layoutfilters:
-            theme_list = theme_list.filter(layout__properties__pk = filter.pk)
-        
-        for filter in self.colorfilters:
-            theme_list = theme_list.filter(colors__groups__pk = filter.pk, dwthemecolor__category = "feature")
-        
-        if len(self.layoutselects):
-            theme_list = theme_list.filter( layout__in = self.layoutselects )
-        
-        # want to make sure only distinct themes are chosen
-        theme_list = theme_list.distinct()
+        if self.request.GET.get("min_contrast"):
+            try:
+                self.min_contrast = float(self.request.GET["min_contrast"])
+                self.filters.append("Minimum entry text contrast: %g:1" % self.min_contrast)
+            except ValueError:
+                pass
+
+    def facet_filters(self):
+        """The filters, as arguments for the facet index."""
+
+        return {
+            "theme_properties": [filter.pk for filter in self.themefilters],
+            "layout_properties": [filter.pk for filter in self.layoutfilters],
+            "color_groups": [filter.pk for filter in self.colorfilters],
+            "layouts": [layout.pk for layout in self.layoutselects],
+            "min_contrast": self.min_contrast,
+        }
+
+class DWThemeListView(VersionedCacheMixin, ThemeFilterMixin, KeysetPaginationMixin,
+    ListView):
+
+    model = DWTheme
+    context_object_name = "theme_list"
+    template_name = "DWStyles/dwtheme_list.html"
+    paginate_by = 25
+
+    def get_queryset(self):
+        self.parse_filters()
+
+        # answered from the in-memory facet index, so only the page of themes
+        # shown is fetched from the database
+        self.facet_index = get_facet_index()
         
-        return theme_list
+        return self.facet_index.result(**self.facet_filters())
+
+    def get_keyset_source(self, queryset):
+
+        # the facet result seeks through its own sort keys
+        return queryset
+
+    def get_keyset_count(self, queryset):
+
+        return len(queryset)
 
     def get_context_data(self, **kwargs):
         context = super(DWThemeListView, self).get_context_data(**kwargs)
 
         filterform = ThemePropertyFilterForm(initial = {
             "layoutfilter": [filter.codename for filter in self.layoutfilters],
-            "layoutselects": [layout.sysid for layout in self.layoutselects],
+            "layoutselect": [layout.sysid for layout in self.layoutselects],
             "colorfilter": [filter.codename for filter in self.colorfilters],
             "themefilter": [filter.codename for filter in self.themefilters],
-        })
+            "min_contrast": self.request.GET.get("min_contrast", ""),
+        }, data_version = self.data_version)
+        filterform.set_facet_counts(self.facet_index.counts(**self.facet_filters()))
+        prefetch_colorbars(context["theme_list"])
 
         context.update({
             "filterform": filterform,
             "applied_filters": self.filters,
-            "editlinks": self.request.user.is_staff,
             "query": self.request.GET.copy(),
         })
 
         return context
 
-class ColorPropertyListView(ListView):
+class ThemeFacetCountsView(VersionedCacheMixin, ThemeFilterMixin, View):
+    """The facet counts for the theme list filters in the query string, as JSON:
+    the number of themes matching now, and for every filter form option, the
+    number that would match with it added."""
+
+    def get(self, request, *args, **kwargs):
+        self.parse_filters()
+        index = get_facet_index()
+        filters = self.facet_filters()
+
+        return HttpResponse(json.dumps({
+            "total": int(index.mask(**filters).sum()),
+            "facets": index.counts(**filters),
+        }), content_type = "application/json")
+
+class ColorPropertyListView(VersionedCacheMixin, KeysetPaginationMixin, ListView):
 
     model = ColorProperty
     paginate_by = 200
     context_object_name = "colorproperty_list"
+    keyset_keys = ("H", "S", "V", "pk")
 
     def get_queryset(self):
 
         return ColorProperty.get_colors_in_themes()
         
-class ColorPropertyDetailView(DetailView):
+class ColorPropertyDetailView(VersionedCacheMixin, DetailView):
 
     slug_field = "color_hex"
     context_object_name = "color"
     queryset = ColorProperty.objects.all()
 
-    def get_object(self, queryset = None):
-        """Overriding the default function; if a color property does not exist, it means that
-           it should be created and the values refreshed.  All hex colors exist, they just
-           might not be in the database yet."""
+    def get(self, request, *args, **kwargs):
 
-        # Use a custom queryset if provided; this is required for subclasses
-        # like DateDetailView
-        if queryset is None:
-            queryset = self.get_queryset()
+        # /color/FFF and the like are the same page as /color/ffffff
+        slug = kwargs.get(self.slug_url_kwarg)
+        color_hex = canonical_hex(slug)
 
-        # Next, try looking up by primary key.
-        pk = self.kwargs.get(self.pk_url_kwarg, None)
-        slug = self.kwargs.get(self.slug_url_kwarg, None)
+        if color_hex is None:
+            raise Http404("Not a hex color: %s" % slug)
+        if color_hex != slug:
+            return HttpResponsePermanentRedirect(reverse("dwstyles:color_view",
+                kwargs = {"slug": color_hex}))
 
-        if pk is not None:
-            queryset = queryset.filter(pk=pk)
+        return super(ColorPropertyDetailView, self).get(request, *args, **kwargs)
 
-        # Next, try looking up by slug.
-        elif slug is not None:
-            #CHANGED -- we are expecting a hex color; normalize to all lowercase
-            slug = slug.lower()
-            slug_field = self.get_slug_field()
-            queryset = queryset.filter(**{slug_field: slug})
+    def get_object(self, queryset = None):
+        """Overriding the default function; if a color property does not exist, it
+           gets a transient one with its values worked out, which isn't saved.  All
+           hex colors exist, they just might not be in the database."""
 
-        # If none of those are defined, it's an error.
-        else:
-            raise AttributeError("Generic detail view %s must be called with "
-                                 "either an object pk or a slug."
-                                 % self.__class__.__name__)
+        if queryset is None:
+            queryset = self.get_queryset()
+
+        color_hex = self.kwargs.get(self.slug_url_kwarg)
 
         try:
-            # Get the single item from the filtered queryset
-            obj = queryset.get()
+            return queryset.get(color_hex = color_hex)
         except ObjectDoesNotExist:
-            # CHANGED -- if it doesn't exist, create it
-            obj = ColorProperty(**{slug_field: slug})
-            obj.save() # saving runs the refresh_values bit
+            return ColorProperty.transient(color_hex)
+
+    def get_context_data(self, **kwargs):
+        context = super(ColorPropertyDetailView, self).get_context_data(**kwargs)
 
-        return obj
+        context["report"] = ColorReport(self.object)
 
-class ColorGroupListView(TemplateView):
+        return context
+
+class ColorGroupListView(VersionedCacheMixin, TemplateView):
 
     template_name = "DWStyles/colorgroup_list.html"
 
@@ -281,11 +324,12 @@ class ColorGroupListView(TemplateView):
         
         return context
 
-class ColorGroupColorListView(ListView):
+class ColorGroupColorListView(VersionedCacheMixin, KeysetPaginationMixin, ListView):
     model = ColorProperty
     context_object_name = "color_list"
     paginate_by = 200
     template_name = "DWStyles/colorgroup_colorlist.html"
+    keyset_keys = ("H", "S", "V", "pk")
 
     def get_queryset(self):
         
@@ -295,7 +339,8 @@ class ColorGroupColorListView(ListView):
         except ObjectDoesNotExist:
             return None
         
-        return ColorProperty.objects.filter(groups__id = self.colorgroup.pk)
+        return ColorProperty.objects.filter(groups__id = self.colorgroup.pk).order_by(
+            'H', 'S', 'V', 'pk')
         
     def get_context_data(self, **kwargs):
         c = super(ColorGroupColorListView, self).get_context_data(**kwargs)
@@ -306,6 +351,21 @@ class ColorGroupColorListView(ListView):
 
         return c
         
+##############
+# batch jobs #
+##############
+
+@staff_member_required
+def batch_job_progress(request, pk):
+    """Shows how far along a batch job queued from the admin is, and how many rows
+    a second it's getting through.  Refreshes itself until the job is finished."""
+    
+    job = get_object_or_404(BatchJob, pk = pk)
+    
+    return render_to_response("batchjobs/batch_job_progress.html",
+        {"title": "%s #%d" % (job_kinds[job.kind][0], job.pk), "job": job},
+        RequestContext(request))
+
 #########################################
 # color_layer_copy processing functions #
 #########################################
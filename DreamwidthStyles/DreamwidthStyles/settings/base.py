@@ -86,6 +86,30 @@ STATICFILES_FINDERS = (
 #    'django.contrib.staticfiles.finders.DefaultStorageFinder',
 )
 
+# Where generated data files, like the color distance matrix, are kept.
+DWSTYLES_DATA_ROOT = root('data')
+
+# Size of the color rounding grid in RGB units (32, 16 or 8).  After changing it,
+# run recompute_color_metrics and build_color_neighbours with the new size.
+DWSTYLES_ROUND_COLOR_SEGMENT = 32
+
+# The cache for the colorbars, counts, and public pages and fragments.  Local
+# memory is per process, so with several processes set DWSTYLES_CACHE_BACKEND to
+# a shared one, like django.core.cache.backends.memcached.MemcachedCache with
+# DWSTYLES_CACHE_LOCATION 127.0.0.1:11211, or
+# django.core.cache.backends.filebased.FileBasedCache with a directory.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get("DWSTYLES_CACHE_BACKEND",
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get("DWSTYLES_CACHE_LOCATION", 'dwstyles'),
+    }
+}
+
+# How long public pages and fragments stay cached, in seconds; 0 turns it off.
+# They're keyed on the data version, so any edit or import moves past them.
+DWSTYLES_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = get_env_variable("STYLE_SECRET_KEY") 
 
@@ -0,0 +1,53 @@
+"""
+bench_cold_start.py
+
+Times what a new worker process does before it can answer its first request:
+importing the URLconf, which imports the views and forms, and building the
+theme list filter form the first time and again.  Each run is a fresh Python
+process, against the configured database.
+
+DJANGO_SETTINGS_MODULE must be properly set and in PYTHONPATH.
+
+Usage: python bench_cold_start.py [number of processes to start]
+"""
+
+import json
+import subprocess
+import sys
+
+worker = """
+import json, time
+start = time.time()
+from django.conf import settings
+settings.DEBUG = True
+from django.db import connection
+import DWStyles.urls
+imported = time.time()
+import_queries = len(connection.queries)
+from DWStyles.forms import ThemePropertyFilterForm
+ThemePropertyFilterForm()
+first = time.time()
+first_queries = len(connection.queries) - import_queries
+ThemePropertyFilterForm()
+print json.dumps({"import": imported - start, "import_queries": import_queries,
+    "first_form": first - imported, "first_form_queries": first_queries,
+    "next_form": time.time() - first,
+    "next_form_queries": len(connection.queries) - import_queries - first_queries})
+"""
+
+if __name__ == "__main__":
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    results = [json.loads(subprocess.check_output([sys.executable, "-c", worker]))
+        for i in range(runs)]
+
+    def best(key):
+        return min(result[key] for result in results)
+
+    print "Best of %d cold starts:" % runs
+    print "Import URLconf: %.3fs, %d queries" % (best("import"), best("import_queries"))
+    print "First filter form: %.4fs, %d queries" % (best("first_form"),
+        best("first_form_queries"))
+    print "Next filter form: %.4fs, %d queries" % (best("next_form"),
+        best("next_form_queries"))
@@ -0,0 +1,93 @@
+"""
+bench_layer_parse.py
+
+Times S2LayerParse on a large generated theme layer: the single pass scan against
+the old line by line scan, and the number of queries a full load takes against
+a throwaway test copy of the configured database.
+
+DJANGO_SETTINGS_MODULE must be properly set and in PYTHONPATH.
+
+Usage: python bench_layer_parse.py [number of color statements]
+"""
+
+import sys
+import time
+
+def variable_name(i):
+    """S2 variable names in layers only use letters and underscores."""
+
+    letters = []
+    while True:
+        i, remainder = divmod(i, 26)
+        letters.append("abcdefghijklmnopqrstuvwxyz"[remainder])
+        if not i:
+            return "".join(letters)
+
+def make_layer(redist_unique, statements):
+    lines = ['layerinfo type = "theme";', 'layerinfo redist_uniq = "%s";' % redist_unique]
+    for i in range(statements):
+        lines.append('# a comment line to skip')
+        lines.append('set color_bench_%s = "#%06x";' % (variable_name(i), (i * 7919) % 0xffffff))
+        lines.append('set font_bench_%s = "Verdana";' % variable_name(i))
+    return "\n".join(lines)
+
+def line_parse(text):
+    """The original scan: two regexes run on every line."""
+
+    from DWStyles.S2LayerParse import S2LayerParse
+
+    redist_unique = None
+    color_variables = list()
+    for line in text.split('\n'):
+        if not redist_unique:
+            m = S2LayerParse.find_redist_unique.search(line)
+            if m:
+                redist_unique = m.groups()[0]
+                continue
+        m = S2LayerParse.set_color_variable.search(line)
+        if m:
+            color_variables.append(m.groups())
+    return redist_unique, color_variables
+
+def best_of(function, *args):
+    times = []
+    for i in range(5):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__ == "__main__":
+
+    from django.conf import settings
+    from django.db import connection
+
+    from DWStyles.S2LayerParse import S2LayerParse
+    from DWStyles.models import DWLayout, DWTheme
+
+    statements = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    text = make_layer("bench/layer", statements)
+
+    print "Layer: %d color statements, %d lines, %d bytes" % (statements,
+        text.count("\n") + 1, len(text))
+    print "Line by line scan: %.4fs" % best_of(line_parse, text)
+    print "Single pass scan:  %.4fs" % best_of(S2LayerParse.parse, text)
+
+    settings.DEBUG = True
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity = 0)
+    try:
+        layout = DWLayout(name = "Bench", codename = "bench")
+        layout.save()
+        theme = DWTheme(name = "Bench", layout = layout, labelid = "bench/layer",
+            thumbnail_width = 0, thumbnail_height = 0)
+        theme.save()
+
+        for run in ("first load", "reload"):
+            queries = len(connection.queries)
+            start = time.time()
+            S2LayerParse(text)
+            print "Full %s: %.3fs, %d queries" % (run, time.time() - start,
+                len(connection.queries) - queries)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
@@ -0,0 +1,82 @@
+"""
+explain_color_queries.py
+
+Prints the query plans of the color page and colorbar queries, both the old way
+through a join on the colors and the new way through the values copied onto the
+theme colors, against a throwaway test copy of the configured database.  Works
+with SQLite, MySQL and PostgreSQL.
+
+DJANGO_SETTINGS_MODULE must be properly set and in PYTHONPATH.
+
+Usage: python explain_color_queries.py [number of themes]
+"""
+
+import sys
+
+explain_prefixes = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "mysql": "EXPLAIN ",
+    "postgresql": "EXPLAIN ",
+}
+
+def explain(connection, queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(explain_prefixes[connection.vendor] + sql, params)
+    return cursor.fetchall()
+
+if __name__ == "__main__":
+
+    from django.db import connection
+
+    from DWStyles.S2LayerParse import import_layers
+    from DWStyles.models import DWLayout, DWTheme, DWThemeColor
+
+    themes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity = 0)
+    try:
+        layout = DWLayout(name = "Explain", codename = "explain")
+        layout.save()
+
+        layers = []
+        for i in range(themes):
+            theme = DWTheme(name = "Explain %d" % i, layout = layout,
+                labelid = "explain/%d" % i, thumbnail_width = 0, thumbnail_height = 0)
+            theme.save()
+            colors = dict(("%06x" % ((i * 40 + j) * 7919 % 0xffffff),
+                ["color_explain_%d" % j]) for j in range(40))
+            layers.append((theme.labelid, theme.labelid, colors, str(i), {}))
+        import_layers(layers)
+
+        # the analyzer statistics help the planners pick the composite indexes
+        if connection.vendor == "sqlite":
+            connection.cursor().execute("ANALYZE")
+
+        theme = DWTheme.objects.all()[0]
+        color = theme.dwthemecolor_set.select_related()[0].color
+
+        queries = [
+            ("color page (ColorProperty.feature_in_themes)",
+                DWThemeColor.objects.filter(color__rounded_hex = color.rounded_hex,
+                    category = "feature").select_related(),
+                color.feature_in_themes()),
+            ("colorbar (DWTheme.get_accent_colors)",
+                theme.dwthemecolor_set.select_related().filter(
+                    category = "accent").order_by('color__H', 'color__S', 'color__V'),
+                theme.get_accent_colors()),
+        ]
+
+        print "%s, %d themes, %d theme colors" % (connection.vendor, themes,
+            DWThemeColor.objects.count())
+
+        for name, old, new in queries:
+            print
+            print name
+            for label, queryset in (("joined", old), ("copied", new)):
+                print "  %s:" % label
+                for row in explain(connection, queryset):
+                    print "    %s" % (row,)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)